@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Adding books to the library and series databases, with hashing and extraction of the book files
+
+    sync    hash, extract, then BkSeriesDb and BkLibraryDb writes, book after book on one thread
+    async   AsyncBkLibraryDb and AsyncBkSeriesDb on the in-tree thread backed sqlite driver: the files are
+            hashed and extracted on executor threads while the writes of the previous books are awaited,
+            and the library and series writes of a book are awaited together
+
+Each run starts from a copy of the fixture databases and an empty destination folder. The fixture books are read
+from the page cache, --read-delay-ms adds a wait per book file to model a library on a network share or a disk.
+
+The async mode needs greenlet (SQLAlchemy asyncio). The copy under packages/ is a CPython 3.9 macOS build, elsewhere
+install greenlet for the Python running the benchmark (pip install greenlet): it is imported before the bundled one.
+
+    python benchmarks/bench_async_db.py [--books 1000] [--runs 3] [--read-delay-ms 0] [--output results.json]
+"""
+import sys
+import json
+import asyncio
+import hashlib
+import zipfile
+from os import path, makedirs
+from shutil import copy2, rmtree
+from time import perf_counter, sleep
+from statistics import median
+from argparse import ArgumentParser
+
+from fixtures import make_fixture
+
+# An installed greenlet, imported before the bundled packages path is set up, is used in place of packages/greenlet
+try:
+    import greenlet  # noqa: F401
+except ImportError:
+    pass
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import headless  # noqa: E402
+
+MODES = ('sync', 'async')
+
+
+def place(record, books_path, read_delay=0):
+    """Asset id (md5 of the first 32k, as IbooksApi) and extracted or copied path of a book file"""
+    if read_delay:
+        sleep(read_delay)
+    with open(record.path, 'rb') as fp:
+        asset_id = hashlib.md5(fp.read(32768)).hexdigest().upper()
+    if record.path.endswith('.epub'):
+        output_path = path.join(books_path, asset_id + '.epub')
+        with zipfile.ZipFile(record.path, 'r') as epub_file:
+            epub_file.extractall(output_path)
+    else:
+        output_path = path.join(books_path, path.basename(record.path))
+        copy2(record.path, output_path)
+    return asset_id, output_path
+
+
+def book_args(record, asset_id, output_path, series_id):
+    return dict(book_id=record.book_id, title=record.title, author=record.author, asset_id=asset_id,
+                filepath=output_path, size=0, series_name=record.series, series_id=series_id,
+                series_number=record.series_index,
+                collection_name=record.series if record.series is not None else u"Books")
+
+
+def series_args(record, asset_id, series_id):
+    return dict(series_name=record.series, series_id=series_id, series_number=record.series_index,
+                author=record.author, adam_id=asset_id, title=record.title)
+
+
+def run_sync(records, books_path, read_delay):
+    from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import BkLibraryDb, BkSeriesDb, series_adam_id
+    library, series = BkLibraryDb(), BkSeriesDb()
+    for record in records:
+        asset_id, output_path = place(record, books_path, read_delay)
+        series_id = None
+        if record.series is not None:
+            series_id = series_adam_id(record.series)
+            series.add_book_to_series(**series_args(record, asset_id, series_id))
+        library.add_book(**book_args(record, asset_id, output_path, series_id))
+    series.commit()
+    library.commit()
+
+
+async def write_books(placed, library, series):
+    from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import series_adam_id
+    while True:
+        item = await placed.get()
+        if item is None:
+            return
+        record, asset_id, output_path = item
+        series_id = None if record.series is None else series_adam_id(record.series)
+        writes = [library.add_book(**book_args(record, asset_id, output_path, series_id))]
+        if series_id is not None:
+            writes.append(series.add_book_to_series(**series_args(record, asset_id, series_id)))
+        await asyncio.gather(*writes)
+
+
+async def run_async(records, books_path, read_delay):
+    from calibre_plugins.apple_ibooks.ibooks_api.ibooks_asyncsql import AsyncBkLibraryDb, AsyncBkSeriesDb
+    library, series = await asyncio.gather(AsyncBkLibraryDb.open(), AsyncBkSeriesDb.open())
+    loop = asyncio.get_running_loop()
+    placed = asyncio.Queue(maxsize=64)
+    writer = asyncio.ensure_future(write_books(placed, library, series))
+    try:
+        for record in records:
+            asset_id, output_path = await loop.run_in_executor(None, place, record, books_path, read_delay)
+            await placed.put((record, asset_id, output_path))
+        await placed.put(None)
+        await writer
+        await asyncio.gather(series.commit(), library.commit())
+    finally:
+        writer.cancel()
+        await asyncio.gather(library.close(), series.close())
+
+
+def run_once(mode, fixture, records, workdir, read_delay=0):
+    prefs = sys.modules['calibre_plugins.apple_ibooks.config'].prefs
+    for pref, source in (('dbbookcatalog', fixture['library_db']), ('dbseriescatalog', fixture['series_db'])):
+        prefs[pref] = path.join(workdir, path.basename(source))
+        copy2(source, prefs[pref])
+    books_path = path.join(workdir, 'Books')
+    rmtree(books_path, ignore_errors=True)
+    makedirs(books_path)
+
+    start = perf_counter()
+    if mode == 'sync':
+        run_sync(records, books_path, read_delay)
+    else:
+        asyncio.run(run_async(records, books_path, read_delay))
+    return perf_counter() - start
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Sync and asyncio database writes with hashing and extraction')
+    parser.add_argument('--books', type=int, default=1000, help='books in the fixture')
+    parser.add_argument('--runs', type=int, default=3, help='runs per mode, the median is reported')
+    parser.add_argument('--read-delay-ms', type=float, default=0, help='wait added to the read of each book file')
+    parser.add_argument('--workdir', default='/tmp/ibooks-async-bench', help='fixture and databases, replaced')
+    parser.add_argument('--output', help='write the results as JSON')
+    options = parser.parse_args(argv)
+
+    headless.install_plugin_modules({'debug': False, 'backup': False})
+    try:
+        from greenlet import getcurrent  # noqa: F401
+    except ImportError as error:
+        parser.error('the async mode needs a greenlet built for this Python (pip install greenlet), '
+                     'packages/greenlet is a CPython 3.9 macOS build: ' + str(error))
+    fixture = make_fixture(path.join(options.workdir, 'fixture'), options.books)
+    records = headless.load_records(fixture['records'])
+
+    results = []
+    for mode in MODES:
+        seconds = median(run_once(mode, fixture, records, options.workdir, options.read_delay_ms / 1000.0)
+                         for run in range(options.runs))
+        results.append({'mode': mode, 'books': options.books, 'runs': options.runs, 'seconds': round(seconds, 3),
+                        'read_delay_ms': options.read_delay_ms, 'books_per_second': round(options.books / seconds, 1)})
+        sys.stderr.write('%-6s %7d books  %8.3f s  %9.1f books/s\n' % (
+            mode, options.books, seconds, options.books / seconds))
+
+    rmtree(options.workdir, ignore_errors=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Import time of the bundled packages, each run in a fresh interpreter
+
+    extract_cold  the former loader: extract the whole plugin zip, import from the folder
+    extract_warm  the former loader with the zip already extracted (and its bytecode cached)
+    zip_cold      ibooks_loader with an empty cache: extract the native modules, zipimport the rest
+    zip_warm      ibooks_loader with the native modules already extracted
+    zip_nopyc     zip_warm from a zip without bytecode, zipimport compiles every module on every start
+    source        the packages folder of the source tree, as headless.py runs
+
+The plugin zip is built from the packages folder the way make dist does, with legacy .pyc files next to the
+sources (zipimport cannot write bytecode caches).
+
+    python benchmarks/bench_import.py [--runs 5] [--workdir /tmp/ibooks-import-bench] [--output results.json]
+"""
+import sys
+import json
+import zipfile
+import py_compile
+import subprocess
+from os import path, walk, environ, remove
+from shutil import rmtree
+from statistics import median
+from argparse import ArgumentParser
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+LOADER = path.join(ROOT, 'ibooks_api', 'ibooks_loader.py')
+
+MODES = ('extract_cold', 'extract_warm', 'zip_cold', 'zip_warm', 'zip_nopyc', 'source')
+
+# Modules the sync imports from the bundled packages
+IMPORTS = ('sqlalchemy', 'sqlalchemy.orm', 'sqlalchemy.ext.automap', 'pypsutil')
+
+RUNNER = '''
+import sys, os, json, zipfile
+from time import perf_counter
+from importlib import import_module, util
+mode, plugin_zip, cache_dir, source = sys.argv[1:5]
+spec = util.spec_from_file_location('ibooks_loader', sys.argv[5])
+loader = util.module_from_spec(spec)
+spec.loader.exec_module(loader)
+
+start = perf_counter()
+if mode.startswith('extract'):
+    if not os.path.isdir(cache_dir):
+        with zipfile.ZipFile(plugin_zip, 'r') as packages:
+            packages.extractall(cache_dir)
+    sys.path.insert(0, cache_dir + '/packages')
+elif mode == 'source':
+    loader.load_packages(plugin_zip='', source_packages=source)
+else:
+    loader.load_packages(plugin_zip=plugin_zip, cache_dir=cache_dir)
+loaded = perf_counter()
+for module in sys.argv[6:]:
+    import_module(module)
+print(json.dumps({'load_ms': (loaded - start) * 1000, 'import_ms': (perf_counter() - loaded) * 1000,
+                  'native': loader.LOAD_STATS.get('native', 0)}))
+'''
+
+
+def build_zip(zip_path, bytecode=True):
+    """Plugin zip with the packages folder, with legacy .pyc files instead of __pycache__ folders"""
+    pyc_file = zip_path + '.pyc'
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as plugin_zip:
+        for folder, folders, files in walk(path.join(ROOT, 'packages')):
+            folders[:] = [name for name in folders if name != '__pycache__']
+            for name in files:
+                file_path = path.join(folder, name)
+                plugin_zip.write(file_path, path.relpath(file_path, ROOT))
+                if bytecode and name.endswith('.py'):
+                    py_compile.compile(file_path, cfile=pyc_file, doraise=True)
+                    plugin_zip.write(pyc_file, path.relpath(file_path, ROOT) + 'c')
+    return zip_path
+
+
+def run_once(mode, plugin_zip, cache_dir):
+    # Bytecode caches are part of what warm runs measure
+    env = dict(environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.run([sys.executable, '-c', RUNNER, mode, plugin_zip, cache_dir,
+                             path.join(ROOT, 'packages'), LOADER] + list(IMPORTS),
+                            stdout=subprocess.PIPE, env=env, check=True, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Cold and warm import time of the bundled packages')
+    parser.add_argument('--runs', type=int, default=5, help='runs per mode, the median is reported')
+    parser.add_argument('--workdir', default='/tmp/ibooks-import-bench', help='plugin zip and caches, replaced')
+    parser.add_argument('--output', help='write the results as JSON')
+    options = parser.parse_args(argv)
+
+    rmtree(options.workdir, ignore_errors=True)
+    plugin_zip = build_zip(options.workdir + '.zip')
+    source_zip = build_zip(options.workdir + '-nopyc.zip', bytecode=False)
+
+    results = []
+    for mode in MODES:
+        runs = []
+        for run in range(options.runs):
+            cache_dir = path.join(options.workdir, mode)
+            # Cold runs start without extracted files, warm ones after a first run that is not counted
+            if mode.endswith('_cold'):
+                rmtree(cache_dir, ignore_errors=True)
+            elif not mode.endswith('_cold') and run == 0:
+                rmtree(cache_dir, ignore_errors=True)
+                run_once(mode, source_zip if mode == 'zip_nopyc' else plugin_zip, cache_dir)
+            runs.append(run_once(mode, source_zip if mode == 'zip_nopyc' else plugin_zip, cache_dir))
+        result = {
+            'mode': mode,
+            'runs': options.runs,
+            'native': runs[-1]['native'],
+            'load_ms': round(median(run['load_ms'] for run in runs), 2),
+            'import_ms': round(median(run['import_ms'] for run in runs), 2),
+        }
+        result['total_ms'] = round(result['load_ms'] + result['import_ms'], 2)
+        results.append(result)
+        sys.stderr.write('%-13s load %8.1f ms  import %8.1f ms  total %8.1f ms  (%d native modules)\n' % (
+            mode, result['load_ms'], result['import_ms'], result['total_ms'], result['native']))
+
+    rmtree(options.workdir, ignore_errors=True)
+    for file_path in (plugin_zip, plugin_zip + '.pyc', source_zip):
+        if path.exists(file_path):
+            remove(file_path)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
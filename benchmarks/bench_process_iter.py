@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Cost per process of reading the attributes the iBooks kill step filters on, with the bundled pypsutil
+
+    getters       Process objects from process_iter(), each getter called on its own (one read each)
+    attrs         process_iter(attrs=...), the getters of a process read in one oneshot()
+    find          find_processes(), names and users filtered from the process table snapshot
+
+    python benchmarks/bench_process_iter.py [--runs 20] [--output results.json]
+"""
+import sys
+import json
+from os import path
+from time import perf_counter
+from statistics import median
+from argparse import ArgumentParser
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.join(ROOT, 'packages'))
+
+import pypsutil  # noqa: E402
+
+ATTRS = ('name', 'uids', 'cmdline', 'ppid', 'status')
+
+MODES = ('getters', 'attrs', 'find')
+
+
+def scan_getters():
+    found = 0
+    for proc in pypsutil.process_iter():
+        info = {}
+        for name in ATTRS:
+            try:
+                info[name] = getattr(proc, name)()
+            except pypsutil.NoSuchProcess:
+                break
+            except pypsutil.AccessDenied:
+                info[name] = None
+        found += 1
+    return found
+
+
+def scan_attrs():
+    found = 0
+    for proc in pypsutil.process_iter(attrs=ATTRS):
+        found += 1
+    return found
+
+
+def scan_find():
+    # The query of the kill step, matching nothing here is fine: it is the scan that is measured
+    pypsutil.find_processes(name=('Books', 'iBooks'), uid=0, cmdline_contains='Books.app')
+    return len(pypsutil.pids())
+
+
+SCANS = {'getters': scan_getters, 'attrs': scan_attrs, 'find': scan_find}
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Per process cost of the process table scans of pypsutil')
+    parser.add_argument('--runs', type=int, default=20, help='scans per mode, the median is reported')
+    parser.add_argument('--output', help='write the results as JSON')
+    options = parser.parse_args(argv)
+
+    results = []
+    for mode in MODES:
+        scan = SCANS[mode]
+        scan()
+        timings = []
+        for _ in range(options.runs):
+            start = perf_counter()
+            processes = scan()
+            timings.append((perf_counter() - start, processes))
+        seconds = median(timing[0] for timing in timings)
+        processes = timings[-1][1]
+        result = {
+            'mode': mode,
+            'runs': options.runs,
+            'processes': processes,
+            'scan_ms': round(seconds * 1000, 3),
+            'per_process_us': round(seconds * 1000000 / max(processes, 1), 2),
+        }
+        results.append(result)
+        sys.stderr.write('%-8s scan %8.2f ms  %8.1f us per process  (%d processes)\n' % (
+            mode, result['scan_ms'], result['per_process_us'], processes))
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Whole process table scans of the bundled pypsutil on Linux, names, parents and start times (and user IDs)
+
+    paths         the former scan: os.listdir() of /proc, then open() of /proc/<pid>/stat and status by full path
+    scanner       _pslinux.ProcfsScanner: os.scandir() and per-PID files opened relative to the /proc directory fd
+
+Sleeping child processes can be started first to measure a busy host.
+
+    python benchmarks/bench_procfs_scan.py [--processes 2000] [--runs 20] [--output results.json]
+"""
+import sys
+import json
+import subprocess
+from os import path, listdir
+from time import perf_counter
+from statistics import median
+from argparse import ArgumentParser
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.join(ROOT, 'packages'))
+
+from pypsutil import _pslinux  # noqa: E402
+
+MODES = ('paths', 'scanner')
+
+
+def scan_paths(uids):
+    found = 0
+    for name in listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(path.join('/proc', name, 'stat'), encoding='utf8', errors='surrogateescape') as fp:
+                fields = _pslinux._parse_procfs_stat_fields(fp.readline().strip())
+            int(fields[3]), _pslinux._extract_create_time(fields)
+            if uids:
+                with open(path.join('/proc', name, 'status'), encoding='utf8', errors='surrogateescape') as fp:
+                    for line in fp:
+                        if line.startswith('Uid:'):
+                            break
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+        found += 1
+    return found
+
+
+def scan_scanner(uids):
+    return sum(1 for _ in _pslinux.iter_proc_snapshot(uids=uids, skip_perm_error=True))
+
+
+SCANS = {'paths': scan_paths, 'scanner': scan_scanner}
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Whole process table scans of pypsutil on Linux')
+    parser.add_argument('--processes', type=int, default=0, help='sleeping child processes to start first')
+    parser.add_argument('--runs', type=int, default=20, help='scans per mode, the median is reported')
+    parser.add_argument('--output', help='write the results as JSON')
+    options = parser.parse_args(argv)
+
+    children = [subprocess.Popen(['sleep', '600']) for _ in range(options.processes)]
+    results = []
+    try:
+        for uids in (False, True):
+            for mode in MODES:
+                scan = SCANS[mode]
+                scan(uids)
+                timings = []
+                for _ in range(options.runs):
+                    start = perf_counter()
+                    processes = scan(uids)
+                    timings.append(perf_counter() - start)
+                result = {
+                    'mode': mode,
+                    'uids': uids,
+                    'runs': options.runs,
+                    'processes': processes,
+                    'scan_ms': round(median(timings) * 1000, 3),
+                }
+                result['per_process_us'] = round(result['scan_ms'] * 1000 / max(processes, 1), 2)
+                results.append(result)
+                sys.stderr.write('%-8s %-9s scan %8.2f ms  %6.1f us per process  (%d processes)\n' % (
+                    mode, 'uids' if uids else 'stat only', result['scan_ms'], result['per_process_us'], processes))
+    finally:
+        for child in children:
+            child.kill()
+        for child in children:
+            child.wait()
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
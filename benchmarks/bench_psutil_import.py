@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Cost of importing the bundled pypsutil, each run in a fresh interpreter
+
+    import        import pypsutil, what every sync start pays
+    first_call    import pypsutil and the first find_processes(), what the kill step pays
+
+Another copy of the packages (a checkout of an older revision for instance) can be measured with --packages.
+
+    python benchmarks/bench_psutil_import.py [--runs 20] [--packages DIR] [--output results.json]
+"""
+import sys
+import json
+import subprocess
+from os import path, environ
+from statistics import median
+from argparse import ArgumentParser
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+MODES = ('import', 'first_call')
+
+RUNNER = '''
+import sys, json
+from time import perf_counter
+mode, packages = sys.argv[1:3]
+sys.path.insert(0, packages)
+before = set(sys.modules)
+start = perf_counter()
+import pypsutil
+imported = perf_counter()
+if mode == 'first_call':
+    pypsutil.find_processes(name='BKAgentService')
+print(json.dumps({'import_ms': (imported - start) * 1000, 'total_ms': (perf_counter() - start) * 1000,
+                  'modules': len(set(sys.modules) - before)}))
+'''
+
+
+def run_once(mode, packages):
+    # Measured with bytecode caches, as the plugin zip ships them
+    env = dict(environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.run([sys.executable, '-c', RUNNER, mode, packages], stdout=subprocess.PIPE, env=env,
+                            check=True, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Import time of the bundled pypsutil')
+    parser.add_argument('--runs', type=int, default=20, help='runs per mode, the median is reported')
+    parser.add_argument('--packages', default=path.join(ROOT, 'packages'), help='folder holding pypsutil')
+    parser.add_argument('--output', help='write the results as JSON')
+    options = parser.parse_args(argv)
+
+    results = []
+    for mode in MODES:
+        # The first run fills the bytecode caches, it is not counted
+        run_once(mode, options.packages)
+        runs = [run_once(mode, options.packages) for _ in range(options.runs)]
+        result = {
+            'mode': mode,
+            'runs': options.runs,
+            'modules': runs[-1]['modules'],
+            'import_ms': round(median(run['import_ms'] for run in runs), 2),
+            'total_ms': round(median(run['total_ms'] for run in runs), 2),
+        }
+        results.append(result)
+        sys.stderr.write('%-10s import %7.1f ms  total %7.1f ms  (%d modules imported)\n' % (
+            mode, result['import_ms'], result['total_ms'], result['modules']))
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Sync throughput benchmark on synthetic fixtures, runs on Linux
+
+For each library size a fresh fixture is generated and headless.py is run in its own process for:
+
+    add      every book is new
+    resync   nothing changed, the plan is all noop
+    delete   every calibre book is pruned from Books
+
+Commit time is the total of the IbooksApi commit timer of each run: for delete it also counts the commit done by
+the removal itself, before the final commit phase of headless.py.
+
+    python benchmarks/bench_sync.py [--sizes 1000,10000,50000] [--workdir /tmp/ibooks-bench] [--output results.json]
+"""
+import sys
+import json
+import subprocess
+from os import path
+from argparse import ArgumentParser
+
+from fixtures import make_fixture
+
+HEADLESS = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'headless.py')
+
+STEPS = ('add', 'resync', 'delete')
+
+
+def run_headless(fixture, records, extra_args):
+    command = [sys.executable, HEADLESS, '--records', records,
+               '--plist', fixture['plist'], '--library-db', fixture['library_db'],
+               '--series-db', fixture['series_db'], '--no-kill', '--no-backup'] + extra_args
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    events = [json.loads(line) for line in output.splitlines() if line.startswith('{')]
+    return next(event for event in events if event['event'] == 'summary'), \
+        dict((event['phase'], event['seconds']) for event in events if event['event'] == 'phase')
+
+
+def bench_size(workdir, size, store_books, extra_args):
+    fixture = make_fixture(path.join(workdir, str(size)), size, store_books=store_books)
+    empty_records = path.join(fixture['root'], 'empty.json')
+    with open(empty_records, 'w') as fp:
+        json.dump([], fp)
+
+    results = []
+    for step in STEPS:
+        if step == 'delete':
+            summary, phases = run_headless(fixture, empty_records, ['--prune'] + extra_args)
+            books = summary['plan']['delete']
+        else:
+            summary, phases = run_headless(fixture, fixture['records'], extra_args)
+            books = summary['books']
+        sync_seconds = summary['seconds']
+        commit_seconds = summary['timers'].get('commit', {}).get('total_ms', 0) / 1000.0
+        results.append({
+            'size': size,
+            'step': step,
+            'books': books,
+            'plan': summary['plan'],
+            'seconds': sync_seconds,
+            'books_per_second': round(books / sync_seconds, 1) if sync_seconds else None,
+            'commit_seconds': round(commit_seconds, 6),
+            'commits': summary['timers'].get('commit', {}).get('count', 0),
+            'phases': phases,
+            'slowest_stage': summary['slowest_stage'],
+        })
+        sys.stderr.write('%7d books  %-7s %9.3f s  %9.1f books/s  commit %7.3f s  (%s)\n' % (
+            size, step, sync_seconds, results[-1]['books_per_second'] or 0, commit_seconds,
+            ', '.join('%s %.3f' % (phase, seconds) for phase, seconds in sorted(phases.items()))))
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark add, re-sync, delete and commit throughput')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='comma separated library sizes')
+    parser.add_argument('--workdir', default='/tmp/ibooks-bench', help='fixtures folder, replaced per size')
+    parser.add_argument('--store-books', type=int, default=100, help='non calibre books in each fixture')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('headless_args', nargs='*', help='extra headless.py flags, after --')
+    options = parser.parse_args(argv)
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        results.extend(bench_size(options.workdir, size, options.store_books, options.headless_args))
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
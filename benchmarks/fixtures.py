@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Synthetic Apple Books container for running the plugin off macOS
+
+Creates a BKLibrary and a BKSeries sqlite file with the Core Data tables the plugin reads and writes, a binary
+books.plist, N EPUB/PDF source books and a records.json for headless.py:
+
+    python benchmarks/fixtures.py /tmp/ibooks-fixture --books 1000 [--store-books 50]
+
+Store books stand in for books bought from Apple, they are not calibre books and must survive every sync.
+"""
+import sys
+import json
+import sqlite3
+import zipfile
+import plistlib
+from os import path, makedirs
+from shutil import rmtree
+from argparse import ArgumentParser
+from uuid import uuid4, uuid5, NAMESPACE_URL
+
+# Core Data entity numbers, the plugin writes collections as 1, members as 3 and assets as 5
+LIBRARY_ENTITIES = ((1, 'BKCollection'), (3, 'BKCollectionMember'), (5, 'BKLibraryAsset'))
+SERIES_ENTITIES = ((1, 'BKSeriesCheck'), (2, 'BKSeriesItem'))
+
+DEFAULT_COLLECTIONS = (
+    ('All_Collection_ID', 'All'),
+    ('Books_Collection_ID', 'Books'),
+    ('Pdfs_Collection_ID', 'PDFs'),
+    ('Finished_Collection_ID', 'Finished'),
+    ('WantToRead_Collection_ID', 'Want to Read'),
+)
+
+CORE_DATA_TABLES = """
+CREATE TABLE Z_PRIMARYKEY (Z_ENT INTEGER PRIMARY KEY, Z_NAME VARCHAR, Z_SUPER INTEGER, Z_MAX INTEGER);
+CREATE TABLE Z_METADATA (Z_VERSION INTEGER PRIMARY KEY, Z_UUID VARCHAR(255), Z_PLIST BLOB);
+CREATE TABLE Z_MODELCACHE (Z_CONTENT BLOB);
+"""
+
+LIBRARY_SCHEMA = CORE_DATA_TABLES + """
+CREATE TABLE ZBKCOLLECTION (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZDELETEDFLAG INTEGER,
+    ZHIDDEN INTEGER, ZSORTKEY INTEGER, ZSORTMODE INTEGER, ZLASTMODIFICATION TIMESTAMP, ZCOLLECTIONDESCRIPTION VARCHAR,
+    ZCOLLECTIONID VARCHAR, ZTITLE VARCHAR);
+CREATE TABLE ZBKCOLLECTIONMEMBER (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZSORTKEY INTEGER,
+    ZASSET INTEGER, ZCOLLECTION INTEGER, ZASSETID VARCHAR);
+CREATE TABLE ZBKLIBRARYASSET (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZBOOKTYPE INTEGER,
+    ZCANREDOWNLOAD INTEGER, ZCONTENTTYPE INTEGER, ZDESKTOPSUPPORTLEVEL INTEGER, ZFILESIZE INTEGER,
+    ZGENERATION INTEGER, ZISDEVELOPMENT INTEGER, ZISEPHEMERAL INTEGER, ZISHIDDEN INTEGER, ZISLOCKED INTEGER,
+    ZISNEW INTEGER, ZISPROOF INTEGER, ZISSAMPLE INTEGER, ZPAGECOUNT INTEGER, ZRATING INTEGER,
+    ZSERIESCONTAINER INTEGER, ZSERIESSORTKEY INTEGER, ZSORTKEY INTEGER, ZSTATE INTEGER, ZSTOREID VARCHAR,
+    ZCREATIONDATE TIMESTAMP, ZLASTOPENDATE TIMESTAMP, ZMODIFICATIONDATE TIMESTAMP, ZASSETID VARCHAR, ZAUTHOR VARCHAR,
+    ZBOOKHIGHWATERMARKPROGRESS VARCHAR, ZCOLLECTIONID VARCHAR, ZCOMMENTS VARCHAR, ZCOVERURL VARCHAR,
+    ZDATASOURCEIDENTIFIER VARCHAR, ZGENRE VARCHAR, ZPATH VARCHAR, ZSERIESID VARCHAR, ZSORTAUTHOR VARCHAR,
+    ZSORTTITLE VARCHAR, ZTITLE VARCHAR, ZVERSIONNUMBER VARCHAR);
+CREATE INDEX ZBKCOLLECTIONMEMBER_ZASSET_INDEX ON ZBKCOLLECTIONMEMBER (ZASSET);
+CREATE INDEX ZBKCOLLECTIONMEMBER_ZCOLLECTION_INDEX ON ZBKCOLLECTIONMEMBER (ZCOLLECTION);
+CREATE INDEX Z_BKCollectionMember_assetID ON ZBKCOLLECTIONMEMBER (ZASSETID);
+CREATE INDEX Z_BKLibraryAsset_assetID ON ZBKLIBRARYASSET (ZASSETID);
+"""
+
+SERIES_SCHEMA = CORE_DATA_TABLES + """
+CREATE TABLE ZBKSERIESCHECK (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZDATECHECKED TIMESTAMP,
+    ZADAMID VARCHAR);
+CREATE TABLE ZBKSERIESITEM (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZISCONTAINER INTEGER,
+    ZISEXPLICIT INTEGER, ZPOSITION INTEGER, ZPOPULARITY INTEGER, ZADAMID VARCHAR, ZAUTHOR VARCHAR, ZGENRE VARCHAR,
+    ZSEQUENCEDISPLAYNAME VARCHAR, ZSERIESADAMID VARCHAR, ZSERIESTITLE VARCHAR, ZSORTAUTHOR VARCHAR,
+    ZSORTTITLE VARCHAR, ZTITLE VARCHAR);
+CREATE INDEX Z_BKSeriesCheck_adamID ON ZBKSERIESCHECK (ZADAMID);
+CREATE INDEX Z_BKSeriesItem_adamID ON ZBKSERIESITEM (ZADAMID);
+CREATE INDEX Z_BKSeriesItem_seriesAdamID ON ZBKSERIESITEM (ZSERIESADAMID);
+"""
+
+CONTAINER_XML = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+"""
+
+CONTENT_OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>%(title)s</dc:title><dc:creator>%(author)s</dc:creator>
+    <dc:identifier id="uid">urn:uuid:%(uuid)s</dc:identifier><dc:language>en</dc:language>
+  </metadata>
+  <manifest><item id="c1" href="chapter1.xhtml" media-type="application/xhtml+xml"/></manifest>
+  <spine><itemref idref="c1"/></spine>
+</package>
+"""
+
+CHAPTER = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%(title)s</title></head><body>
+<h1>%(title)s</h1>
+%(text)s
+</body></html>
+"""
+
+
+# Fixed entry dates keep the books, and so their asset ids, identical across fixtures
+ZIP_DATE = (2020, 1, 1, 0, 0, 0)
+
+
+def write_epub(file_path, title, author, payload_kb):
+    paragraph = '<p>' + ('Lorem ipsum dolor sit amet %s. ' % title) * 8 + '</p>\n'
+    text = paragraph * max(1, (payload_kb * 1024) // len(paragraph))
+    entries = (
+        # The mimetype must be the first entry and stored uncompressed
+        ('mimetype', 'application/epub+zip', zipfile.ZIP_STORED),
+        ('META-INF/container.xml', CONTAINER_XML, zipfile.ZIP_DEFLATED),
+        ('OEBPS/content.opf', CONTENT_OPF % {'title': title, 'author': author,
+                                             'uuid': uuid5(NAMESPACE_URL, title)}, zipfile.ZIP_DEFLATED),
+        ('OEBPS/chapter1.xhtml', CHAPTER % {'title': title, 'text': text}, zipfile.ZIP_DEFLATED),
+    )
+    with zipfile.ZipFile(file_path, 'w') as epub:
+        for name, content, compress_type in entries:
+            epub.writestr(zipfile.ZipInfo(name, date_time=ZIP_DATE), content, compress_type=compress_type)
+
+
+def write_pdf(file_path, title, payload_kb):
+    stream = ('BT /F1 12 Tf 72 720 Td (%s) Tj ET\n' % title).encode('latin-1', 'replace')
+    stream += b'% ' + b'x' * (payload_kb * 1024) + b'\n'
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R >>',
+        b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'endstream',
+    ]
+    content = b'%PDF-1.4\n'
+    offsets = []
+    for n, body in enumerate(objects):
+        offsets.append(len(content))
+        content += str(n + 1).encode() + b' 0 obj\n' + body + b'\nendobj\n'
+    xref = len(content)
+    content += b'xref\n0 ' + str(len(objects) + 1).encode() + b'\n0000000000 65535 f \n'
+    content += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    content += b'trailer\n<< /Size ' + str(len(objects) + 1).encode() + b' /Root 1 0 R >>\nstartxref\n' + \
+        str(xref).encode() + b'\n%%EOF\n'
+    with open(file_path, 'wb') as fp:
+        fp.write(content)
+
+
+def create_databases(library_db, series_db):
+    library = sqlite3.connect(library_db)
+    library.executescript(LIBRARY_SCHEMA)
+    library.executemany('INSERT INTO Z_PRIMARYKEY VALUES (?, ?, 0, 0)', LIBRARY_ENTITIES)
+    library.executemany(
+        'INSERT INTO ZBKCOLLECTION (Z_ENT, Z_OPT, ZDELETEDFLAG, ZHIDDEN, ZSORTKEY, ZLASTMODIFICATION, '
+        'ZCOLLECTIONID, ZTITLE) VALUES (1, 1, 0, 0, ?, 0, ?, ?)',
+        [(n, collection_id, title) for n, (collection_id, title) in enumerate(DEFAULT_COLLECTIONS)])
+    library.execute("UPDATE Z_PRIMARYKEY SET Z_MAX = (SELECT max(Z_PK) FROM ZBKCOLLECTION) WHERE Z_ENT = 1")
+    library.execute("INSERT INTO Z_METADATA VALUES (1, ?, NULL)", (str(uuid4()).upper(),))
+    library.commit()
+
+    series = sqlite3.connect(series_db)
+    series.executescript(SERIES_SCHEMA)
+    series.executemany('INSERT INTO Z_PRIMARYKEY VALUES (?, ?, 0, 0)', SERIES_ENTITIES)
+    series.execute("INSERT INTO Z_METADATA VALUES (1, ?, NULL)", (str(uuid4()).upper(),))
+    series.commit()
+    return library, series
+
+
+def add_store_books(library, series, books_path, count):
+    """Books bought from Apple: library assets in Books and All, plist entries and a store series"""
+    plist_books = []
+    if not count:
+        return plist_books
+
+    collections = dict(library.execute('SELECT ZCOLLECTIONID, Z_PK FROM ZBKCOLLECTION'))
+    store_series_id = '1000000000'
+    series.execute("INSERT INTO ZBKSERIESCHECK (Z_ENT, Z_OPT, ZDATECHECKED, ZADAMID) VALUES (1, 3, 0, ?)",
+                   (store_series_id,))
+    series.execute("INSERT INTO ZBKSERIESITEM (Z_ENT, Z_OPT, ZISCONTAINER, ZPOSITION, ZADAMID, ZSERIESADAMID, "
+                   "ZSERIESTITLE, ZTITLE) VALUES (2, 1, 1, 0, ?, ?, 'Store Series', 'Store Series')",
+                   (store_series_id, store_series_id))
+
+    for n in range(count):
+        adam_id = str(1000000001 + n)
+        title = 'Store Book %d' % n
+        book_path = path.join(books_path, adam_id + '.epub')
+        cursor = library.execute(
+            'INSERT INTO ZBKLIBRARYASSET (Z_ENT, Z_OPT, ZCONTENTTYPE, ZSTATE, ZGENERATION, ZISNEW, ZSORTKEY, '
+            'ZSTOREID, ZASSETID, ZTITLE, ZSORTTITLE, ZAUTHOR, ZSORTAUTHOR, ZPATH, ZCOLLECTIONID, ZSERIESID, '
+            'ZCREATIONDATE, ZMODIFICATIONDATE, ZLASTOPENDATE) '
+            'VALUES (5, 1, 1, 1, 1, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0, 0)',
+            (n, adam_id, adam_id, title, title, 'Apple Author', 'Apple Author', book_path,
+             'Books_Collection_ID', store_series_id if n % 2 else None))
+        for collection_id in ('All_Collection_ID', 'Books_Collection_ID'):
+            library.execute('INSERT INTO ZBKCOLLECTIONMEMBER (Z_ENT, Z_OPT, ZSORTKEY, ZASSET, ZCOLLECTION, ZASSETID) '
+                            'VALUES (3, 1, ?, ?, ?, ?)', (n, cursor.lastrowid, collections[collection_id], adam_id))
+        if n % 2:
+            series.execute("INSERT INTO ZBKSERIESCHECK (Z_ENT, Z_OPT, ZDATECHECKED, ZADAMID) VALUES (1, 1, 0, ?)",
+                           (adam_id,))
+            series.execute("INSERT INTO ZBKSERIESITEM (Z_ENT, Z_OPT, ZISCONTAINER, ZPOSITION, ZADAMID, "
+                           "ZSERIESADAMID, ZSERIESTITLE, ZTITLE) VALUES (2, 1, 0, ?, ?, ?, 'Store Series', ?)",
+                           (n, adam_id, store_series_id, title))
+        plist_books.append({
+            'BKGeneratedItemId': adam_id,
+            'BKInsertionDate': 0,
+            'itemName': title,
+            'artistName': 'Apple Author',
+            'path': book_path,
+            'storeId': adam_id,
+            'isPurchasedBook': True,
+        })
+
+    for ent, table, pk in ((3, 'ZBKCOLLECTIONMEMBER', 'Z_PK'), (5, 'ZBKLIBRARYASSET', 'Z_PK')):
+        library.execute('UPDATE Z_PRIMARYKEY SET Z_MAX = (SELECT max(' + pk + ') FROM ' + table + ') WHERE Z_ENT = ?',
+                        (ent,))
+    for ent, table in ((1, 'ZBKSERIESCHECK'), (2, 'ZBKSERIESITEM')):
+        series.execute('UPDATE Z_PRIMARYKEY SET Z_MAX = (SELECT max(Z_PK) FROM ' + table + ') WHERE Z_ENT = ?',
+                       (ent,))
+    library.commit()
+    series.commit()
+    return plist_books
+
+
+def make_fixture(root, books, store_books=0, pdf_every=4, series_every=3, series_size=10, payload_kb=16):
+    """Create a fresh fixture under root, returns the paths to pass to headless.py
+
+    Every pdf_every-th book is a PDF, every series_every-th book belongs to a series of series_size books."""
+    rmtree(root, ignore_errors=True)
+    books_path = path.join(root, 'BKAgentService', 'Books')
+    sources_path = path.join(root, 'calibre')
+    makedirs(books_path)
+    makedirs(sources_path)
+
+    fixture = {
+        'root': root,
+        'plist': path.join(books_path, 'books.plist'),
+        'library_db': path.join(root, 'BKLibrary-1-091020131601.sqlite'),
+        'series_db': path.join(root, 'BKSeries-1-012820141020.sqlite'),
+        'records': path.join(root, 'records.json'),
+        'books': books,
+    }
+
+    library, series = create_databases(fixture['library_db'], fixture['series_db'])
+    plist_books = add_store_books(library, series, books_path, store_books)
+    library.close()
+    series.close()
+
+    with open(fixture['plist'], 'wb') as fp:
+        plistlib.dump({'Books': plist_books}, fp, fmt=plistlib.FMT_BINARY)
+
+    records = []
+    for book_id in range(1, books + 1):
+        title = 'Synthetic Book %d' % book_id
+        author = 'Author %d' % (book_id % 97)
+        is_pdf = pdf_every and book_id % pdf_every == 0
+        book_path = path.join(sources_path, '%d.%s' % (book_id, 'pdf' if is_pdf else 'epub'))
+        if is_pdf:
+            write_pdf(book_path, title, payload_kb)
+        else:
+            write_epub(book_path, title, author, payload_kb)
+
+        record = {'book_id': book_id, 'title': title, 'author': author, 'path': book_path}
+        if series_every and book_id % series_every == 0:
+            number = book_id // series_every
+            record['series'] = 'Synthetic Series %d' % (number // series_size)
+            record['series_index'] = float(number % series_size + 1)
+        records.append(record)
+
+    with open(fixture['records'], 'w') as fp:
+        json.dump(records, fp)
+    return fixture
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Create a synthetic Apple Books container and calibre sources')
+    parser.add_argument('root', help='fixture folder, replaced if it exists')
+    parser.add_argument('--books', type=int, default=1000, help='calibre books to generate')
+    parser.add_argument('--store-books', type=int, default=0, help='non calibre books already in Books')
+    parser.add_argument('--pdf-every', type=int, default=4, help='one PDF every N books (0: EPUB only)')
+    parser.add_argument('--series-every', type=int, default=3, help='one book in a series every N (0: none)')
+    parser.add_argument('--payload-kb', type=int, default=16, help='approximate text payload of each book')
+    options = parser.parse_args(argv)
+
+    fixture = make_fixture(path.abspath(options.root), options.books, store_books=options.store_books,
+                           pdf_every=options.pdf_every, series_every=options.series_every,
+                           payload_kb=options.payload_kb)
+    print(json.dumps(fixture, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,6 +11,7 @@ from PyQt5.Qt import QWidget, QVBoxLayout, QLabel, QLineEdit, QFileDialog, QLayo
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from calibre.utils.config import JSONConfig
+from calibre_plugins.apple_ibooks.defaults import set_defaults
 
 # This is where all preferences for this plugin will be stored
 # Remember that this name (i.e. plugins/interface_demo) is also
@@ -20,16 +21,7 @@ from calibre.utils.config import JSONConfig
 prefs = JSONConfig('plugins/apple_ibooks')
 
 # Set defaults
-prefs.defaults['bookcatalog'] = \
-    path.expanduser("~/Library/Containers/com.apple.BKAgentService/Data/Documents/iBooks/Books/books.plist")
-prefs.defaults['dbbookcatalog'] = \
-    path.expanduser("~/Library/Containers/com.apple.iBooksX/Data/Documents/BKLibrary/BKLibrary-1-091020131601.sqlite")
-prefs.defaults['dbseriescatalog'] = \
-    path.expanduser("~/Library/Containers/com.apple.iBooksX/Data/Documents/BKSeriesDatabase/BKSeries-1-012820141020.sqlite")
-
-prefs.defaults['backup'] = True
-prefs.defaults['debug'] = False
-prefs.defaults['remove_last_synced'] = False
+set_defaults(prefs.defaults)
 
 class Ui_qWidget(object):
 
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+from os import path
+
+
+def set_defaults(defaults):
+    """Fill the plugin preference defaults, kept free of calibre and Qt imports for the headless runner"""
+    defaults['bookcatalog'] = \
+        path.expanduser("~/Library/Containers/com.apple.BKAgentService/Data/Documents/iBooks/Books/books.plist")
+    defaults['dbbookcatalog'] = \
+        path.expanduser("~/Library/Containers/com.apple.iBooksX/Data/Documents/BKLibrary/BKLibrary-1-091020131601.sqlite")
+    defaults['dbseriescatalog'] = \
+        path.expanduser("~/Library/Containers/com.apple.iBooksX/Data/Documents/BKSeriesDatabase/BKSeries-1-012820141020.sqlite")
+
+    defaults['backup'] = True
+    defaults['debug'] = False
+    defaults['remove_last_synced'] = False
+    # Remove from iBooks the calibre books that are no longer in the calibre library (off: books synced from
+    # another library are kept)
+    defaults['prune_deleted'] = False
+    # Only plan the sync and report what would change
+    defaults['dry_run'] = False
+    # Quit Books.app and BKAgentService before touching their files
+    defaults['kill_ibooks'] = True
+    # Abort the sync (nothing is committed) when one of them is started again, checked every watch_interval seconds
+    defaults['watch_ibooks'] = True
+    defaults['watch_interval'] = 1.0
+    # Books written between two intermediate commits
+    defaults['batch_size'] = 1000
+
+    # Profile every SQL statement and log the sql_profile_top slowest ones after the sync
+    defaults['sql_profile'] = False
+    defaults['sql_profile_top'] = 10
+
+    # Memory checkpoints (tracemalloc and RSS) at phase boundaries and every memory_profile_every books,
+    # reporting the memory_profile_top allocation sites that grew the most
+    defaults['memory_profile'] = False
+    defaults['memory_profile_every'] = 1000
+    defaults['memory_profile_frames'] = 1
+    defaults['memory_profile_top'] = 10
+
+    # Bounded memory: drop ORM objects after each commit and look up existing rows by compact keys
+    defaults['streaming_sync'] = False
+
+    # Stage the books of each batch in TEMP tables and merge them into BKLibrary with set based statements at
+    # commit (off: per book ORM lookups and inserts)
+    defaults['staged_merge'] = True
+
+    # Open BKSeries attached to the BKLibrary connection and commit both databases in one transaction, then
+    # books.plist. Ignored, with a warning in the log, when either database is in WAL mode
+    defaults['attach_series'] = False
+
+    # Import the sync modules, reflect the databases and parse books.plist on a background thread warmup_delay
+    # seconds after calibre starts, so the first sync starts at once
+    defaults['warmup'] = True
+    defaults['warmup_delay'] = 5
+
+    # Sync log: lines kept for the dialog between two refreshes (every log_flush_ms), lines shown in the dialog,
+    # and size/backups of the rotating log file next to the preferences
+    defaults['log_ring_size'] = 5000
+    defaults['log_flush_ms'] = 100
+    defaults['log_view_rows'] = 20000
+    defaults['log_file_kb'] = 1024
+    defaults['log_file_backups'] = 3
+
+    # Run the dialog sync as a greenlet on the GUI thread, one book at a time, handing the event loop a turn every
+    # coop_slice_ms (off: the threaded pipeline, the dialog refreshing every 0.1% of the books)
+    defaults['cooperative_sync'] = True
+    defaults['coop_slice_ms'] = 30
+
+    # Sync pipeline: workers per stage (DB and plist writers always run with one) and queue depth between stages
+    defaults['pipeline_workers'] = {'metadata': 1, 'fingerprint': 2, 'placement': 2}
+    defaults['pipeline_queue_depth'] = 64
+
+    # Removed books are moved to a trash folder (empty: CalibreTrash next to the BKAgent Books folder)
+    # and purged in background by trash_workers threads
+    defaults['deferred_delete'] = True
+    defaults['trashdir'] = ''
+    defaults['trash_workers'] = 4
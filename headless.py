@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+"""Headless sync runner: drives IbooksApi without calibre's GUI, for scripting and benchmarking
+
+From a JSON list of book records (objects with the BookRecord fields, fmt defaults to the file extension):
+
+    python headless.py --plist books.plist --library-db BKLibrary.sqlite --series-db BKSeries.sqlite \\
+        --records books.json [--batch-size N] [--workers N|stage=N,...] [--dry-run]
+
+From a calibre library:
+
+    calibre-debug -e headless.py -- --calibre-library ~/Calibre\\ Library --book-ids 1,2,3 ...
+
+Prints one JSON object per line to stdout: a "phase" line with the wall time of each step, then a "summary".
+"""
+import sys
+import json
+import logging
+from os import path
+from argparse import ArgumentParser
+from importlib import import_module
+from time import perf_counter
+from types import ModuleType
+
+PLUGIN_PACKAGE = 'calibre_plugins.apple_ibooks'
+PLUGIN_PATH = path.dirname(path.abspath(__file__))
+
+
+class HeadlessPrefs(dict):
+    """Plain dict standing in for the plugin JSONConfig, unset keys fall back to defaults"""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.defaults = {}
+
+    def __missing__(self, key):
+        return self.defaults[key]
+
+
+def install_plugin_modules(settings):
+    """Make the source tree importable as the plugin package, with settings as its prefs
+
+    Must run before ibooks_api is imported, IbooksApi reads the catalog paths at import time."""
+    if 'calibre_plugins' not in sys.modules:
+        namespace = ModuleType('calibre_plugins')
+        namespace.__path__ = []
+        sys.modules['calibre_plugins'] = namespace
+
+    # Bypass the plugin __init__, it needs calibre's plugin base classes
+    plugin = ModuleType(PLUGIN_PACKAGE)
+    plugin.__path__ = [PLUGIN_PATH]
+    sys.modules[PLUGIN_PACKAGE] = plugin
+    setattr(sys.modules['calibre_plugins'], 'apple_ibooks', plugin)
+
+    from calibre_plugins.apple_ibooks.defaults import set_defaults
+
+    prefs = HeadlessPrefs()
+    set_defaults(prefs.defaults)
+    prefs.update(settings)
+
+    config = ModuleType(PLUGIN_PACKAGE + '.config')
+    config.prefs = prefs
+    sys.modules[PLUGIN_PACKAGE + '.config'] = config
+    plugin.config = config
+    return prefs
+
+
+def load_records(records_file):
+    """BookRecords from a JSON list of objects ('-' reads stdin)"""
+    from calibre_plugins.apple_ibooks.ibooks_api import BookRecord
+    from calibre_plugins.apple_ibooks.ibooks_api.ibooks_prefetch import SYNC_FORMATS
+
+    if records_file == '-':
+        entries = json.load(sys.stdin)
+    else:
+        with open(records_file, 'r') as fp:
+            entries = json.load(fp)
+
+    records = []
+    for n, entry in enumerate(entries):
+        book_path = entry.get('path')
+        fmt = entry.get('fmt')
+        if fmt is None and book_path:
+            fmt = path.splitext(book_path)[1][1:].upper() or None
+        if fmt not in SYNC_FORMATS:
+            fmt = None
+        author = entry.get('author')
+        if isinstance(author, list):
+            author = ', '.join(author)
+        records.append(BookRecord(
+            book_id=int(entry.get('book_id', n + 1)),
+            title=entry.get('title') or path.splitext(path.basename(book_path or ''))[0],
+            author=author or '',
+            series=entry.get('series'),
+            series_index=entry.get('series_index'),
+            fmt=fmt,
+            path=path.expanduser(book_path) if fmt is not None else None,
+        ))
+    return records
+
+
+def load_calibre_library(library_path, book_ids=None):
+    """BookRecords of a calibre library, only available when run by calibre-debug -e"""
+    from calibre.library import db as calibre_db
+    from calibre_plugins.apple_ibooks.ibooks_api import prefetch_books
+
+    db = calibre_db(path.expanduser(library_path)).new_api
+    known_ids = db.all_book_ids()
+    return prefetch_books(db, book_ids if book_ids else sorted(known_ids)), known_ids
+
+
+def parse_workers(value):
+    """'N' for every parallel stage or 'stage=N,...'"""
+    stages = ('metadata', 'fingerprint', 'placement')
+    if '=' not in value:
+        return dict((stage, int(value)) for stage in stages)
+    workers = {}
+    for item in value.split(','):
+        stage, count = item.split('=')
+        if stage.strip() not in stages:
+            raise ValueError('unknown stage ' + stage)
+        workers[stage.strip()] = int(count)
+    return workers
+
+
+class PhaseTimer:
+    """Times the runner phases, each one printed as a JSON line when it ends"""
+
+    def __init__(self, out):
+        self.out = out
+        self.phases = {}
+
+    def emit(self, event):
+        self.out.write(json.dumps(event, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def run(self, phase, func, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = perf_counter() - start
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+            self.emit({'event': 'phase', 'phase': phase, 'seconds': round(seconds, 6)})
+
+
+def sync(records, known_ids=None, remove_last_synced=False, timer=None):
+    """Run a sync of records the way the plugin dialog does, returns the summary dict
+
+    install_plugin_modules() must have been called, outside calibre."""
+    from calibre_plugins.apple_ibooks.config import prefs
+    from calibre_plugins.apple_ibooks.ibooks_api import IbooksApi, SyncPipeline
+
+    timer = PhaseTimer(sys.stdout) if timer is None else timer
+    start = perf_counter()
+
+    books = timer.run('open', IbooksApi)
+    try:
+        if remove_last_synced and not prefs['dry_run']:
+            timer.run('remove_all', books.del_all_books_from_calibre, commit=False)
+
+        plan = timer.run('plan', books.plan, records, known_ids=known_ids)
+        if prefs['dry_run']:
+            to_sync = []
+        else:
+            to_sync = timer.run('remove', books.remove_planned, plan)
+
+        pipeline = SyncPipeline(books)
+        skipped = {}
+
+        def run_pipeline():
+            for item in pipeline.run(to_sync):
+                if books.app_launched() is not None and not pipeline.stop_event.is_set():
+                    print (books.app_launched() + " was launched during the sync, interrupting it", file=sys.stderr)
+                    pipeline.stop()
+                if 'skipped' in item:
+                    skipped[item['skipped']] = skipped.get(item['skipped'], 0) + 1
+                    if prefs['debug']:
+                        print ("Book id " + str(item['record'].book_id) + ": " + item['skipped'], file=sys.stderr)
+
+        timer.run('pipeline', run_pipeline)
+        timer.run('commit', books.commit)
+        sweeper = books.purge_trash()
+        books.memory.stop()
+    except Exception:
+        books.rollback()
+        raise
+
+    seconds = perf_counter() - start
+    synced = len(to_sync) - sum(skipped.values())
+    summary = {
+        'event': 'summary',
+        'dry_run': prefs['dry_run'],
+        'books': len(records),
+        'synced': synced,
+        'skipped': skipped,
+        'plan': plan.report(),
+        'phases': dict((phase, round(value, 6)) for phase, value in timer.phases.items()),
+        'stages': pipeline.stats(),
+        'timers': books.timers.summary(),
+        'memory': books.memory.summary(),
+        'sql': books.sql_statements()[:prefs['sql_profile_top']] if prefs['sql_profile'] else [],
+        'slowest_stage': pipeline.slowest_stage(),
+        'seconds': round(seconds, 6),
+        'books_per_second': round(synced / seconds, 2) if seconds > 0 else None,
+    }
+    timer.emit(summary)
+    # Removed book files are purged in background, not part of the sync time but done before exiting
+    if sweeper is not None:
+        sweeper.join()
+    return summary
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Sync books to Apple Books without the calibre GUI')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--records', help='JSON list of book records, - for stdin')
+    source.add_argument('--calibre-library', help='calibre library folder (run with calibre-debug -e)')
+    parser.add_argument('--book-ids', help='comma separated calibre ids to sync (default: the whole library)')
+    parser.add_argument('--prune', action='store_true',
+                        help='remove calibre books from iBooks that are not in --records or the calibre library')
+    parser.add_argument('--remove-last-synced', action='store_true',
+                        help='remove every calibre book from iBooks before syncing')
+    parser.add_argument('--plist', required=True, help='BKAgentService books.plist')
+    parser.add_argument('--library-db', required=True, help='BKLibrary sqlite file')
+    parser.add_argument('--series-db', required=True, help='BKSeries sqlite file')
+    parser.add_argument('--trash-dir', help='trash folder (default: CalibreTrash next to the plist folder)')
+    parser.add_argument('--batch-size', type=int, help='books between intermediate commits')
+    parser.add_argument('--workers', type=parse_workers, help="workers per parallel stage: N or 'stage=N,...'")
+    parser.add_argument('--queue-depth', type=int, help='queue depth between pipeline stages')
+    parser.add_argument('--dry-run', action='store_true', help='only plan the sync')
+    parser.add_argument('--streaming', action='store_true', help='bounded memory streaming sync mode')
+    parser.add_argument('--no-staged-merge', action='store_true',
+                        help='per book library inserts instead of the set based merge of each batch')
+    parser.add_argument('--attach-series', action='store_true',
+                        help='commit both databases in one transaction, BKSeries attached to BKLibrary '
+                             '(ignored when either one is in WAL mode)')
+    parser.add_argument('--sql-profile', action='store_true', help='report the slowest SQL statements')
+    parser.add_argument('--memory-profile', type=int, metavar='N', nargs='?', const=1000,
+                        help='memory checkpoints at phase boundaries and every N books (default 1000)')
+    parser.add_argument('--no-backup', action='store_true', help='do not keep a .bkp of books.plist')
+    parser.add_argument('--no-kill', action='store_true', help='do not quit Books.app and BKAgentService')
+    parser.add_argument('--debug', action='store_true', help='plugin debug output on stderr')
+    parser.add_argument('--log-file', help='also write the plugin log to this rotating file')
+    options = parser.parse_args(argv)
+
+    settings = {
+        'bookcatalog': path.abspath(path.expanduser(options.plist)),
+        'dbbookcatalog': path.abspath(path.expanduser(options.library_db)),
+        'dbseriescatalog': path.abspath(path.expanduser(options.series_db)),
+        'dry_run': options.dry_run,
+        'debug': options.debug,
+        'sql_profile': options.sql_profile,
+        'streaming_sync': options.streaming,
+        'attach_series': options.attach_series,
+        'staged_merge': not options.no_staged_merge,
+        'memory_profile': options.memory_profile is not None,
+    }
+    if options.memory_profile:
+        settings['memory_profile_every'] = options.memory_profile
+    if options.trash_dir:
+        settings['trashdir'] = path.abspath(path.expanduser(options.trash_dir))
+    if options.batch_size:
+        settings['batch_size'] = max(1, options.batch_size)
+    if options.queue_depth:
+        settings['pipeline_queue_depth'] = options.queue_depth
+    if options.no_backup:
+        settings['backup'] = False
+    if options.no_kill:
+        settings['kill_ibooks'] = False
+
+    prefs = install_plugin_modules(settings)
+    if options.workers:
+        workers = dict(prefs['pipeline_workers'])
+        workers.update(options.workers)
+        prefs['pipeline_workers'] = workers
+
+    # The plugin prints to stdout, keep it apart from the JSON lines
+    timer = PhaseTimer(sys.stdout)
+    sys.stdout = sys.stderr
+
+    plugin = timer.run('import', import_module, PLUGIN_PACKAGE + '.ibooks_api')
+    plugin.setup_logging(options.log_file and path.abspath(path.expanduser(options.log_file)), view=False)
+    if options.debug:
+        console = logging.StreamHandler(sys.stderr)
+        console.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
+        plugin.log.addHandler(console)
+
+    book_ids = [int(book_id) for book_id in options.book_ids.split(',')] if options.book_ids else None
+    if options.calibre_library:
+        records, known_ids = timer.run('load', load_calibre_library, options.calibre_library, book_ids)
+        known_ids = known_ids if options.prune else None
+    else:
+        records = timer.run('load', load_records, options.records)
+        known_ids = [record.book_id for record in records] if options.prune else None
+        if book_ids:
+            records = [record for record in records if record.book_id in book_ids]
+
+    try:
+        sync(records, known_ids=known_ids, remove_last_synced=options.remove_last_synced, timer=timer)
+    finally:
+        plugin.flush_logging()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
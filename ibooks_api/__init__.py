@@ -1,32 +1,30 @@
 #!/usr/bin/python
 # -*- coding=utf-8 -*-
-import sys
 import os
-import zipfile
-import tempfile
 
 try:
     from calibre_plugins.apple_ibooks.config import prefs
+    from calibre_plugins.apple_ibooks.ibooks_api.ibooks_loader import load_packages, LOAD_STATS
 except ImportError:
     from config import prefs
+    from ibooks_loader import load_packages, LOAD_STATS
 
 
-# Ugly hack to manipulate sys path to add allow import of complex packages, needed for pslist and sqlalchemy so far
-packages_path = os.path.join(tempfile.gettempdir(), 'calibre_ibooks_plugin')
-
-# Extract packges to temp dir if it does not exist
-if not os.path.isdir(packages_path) or prefs['debug']:
-    with zipfile.ZipFile(os.path.expanduser("~/Library/Preferences/calibre/plugins/Apple_iBooks.zip"), 'r') as packages:
-        packages.extractall(packages_path)
-
-packages_path = os.path.join(packages_path)
-sys.path.insert(0, os.path.join(packages_path, 'packages'))
-sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'packages'))
+# Bundled packages (sqlalchemy, pypsutil, greenlet): the source tree packages folder when run from it (headless),
+# else zipimport from the plugin zip with only the extension modules extracted, once per version of them
+load_packages(source_packages=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'packages'))
+if prefs['debug']:
+    print ("Packages loaded from " + str(LOAD_STATS.get('path')) + " (" + str(LOAD_STATS.get('mode')) + ", " +
+           str(LOAD_STATS.get('native')) + " native modules" +
+           (", extracted" if LOAD_STATS.get('extracted') else "") + ")")
 
 
 from .ibooks_api import IbooksApi
-
-# Recover os.path
-sys.path.pop(0)
+from .ibooks_prefetch import BookRecord, prefetch_books
+from .ibooks_pipeline import SyncPipeline
+from .ibooks_planner import SyncPlan, plan_sync
+from .ibooks_log import log, setup_logging, flush_logging
+from .ibooks_cache import prepare_caches
+from .ibooks_coop import CooperativeTask, cooperate
 
 
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sqlite3
+from functools import partial
+from queue import SimpleQueue
+from threading import Thread
+from asyncio import get_running_loop
+
+# Stdlib only: the aiosqlite API the SQLAlchemy aiosqlite dialect uses, over sqlite3 running on one thread per
+# connection. Module attributes below are copied by the dialect onto its DBAPI adapter.
+from sqlite3 import DatabaseError, Error, IntegrityError, NotSupportedError, OperationalError, ProgrammingError, \
+    Binary, PARSE_COLNAMES, PARSE_DECLTYPES, sqlite_version, sqlite_version_info
+
+# Queued to the connection thread to end it
+_STOP = (None, None)
+
+# Rows fetched on the connection thread along with execute(), SQLAlchemy fetches them all right after
+PREFETCH_ROWS = 1000
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+
+def _resolve(future, callback, value):
+    """Hand a result over to the event loop of future, dropped when that loop is already closed"""
+    try:
+        future.get_loop().call_soon_threadsafe(callback, future, value)
+    except RuntimeError:
+        pass
+
+
+class Connection(Thread):
+    """sqlite3 connection owned by its own thread, every call is queued to it and awaited
+
+    Awaiting the connection (as aiosqlite.connect() returns it) starts the thread and opens the database on it.
+    The sqlite3 connection is only ever used from that thread."""
+
+    def __init__(self, connector):
+        super().__init__(name='ibooks_aiosqlite', daemon=True)
+        self._connector = connector
+        self._conn_ = None
+        self._tx = SimpleQueue()
+        self._running = True
+
+    def run(self):
+        while True:
+            future, function = self._tx.get()
+            if function is None:
+                break
+            try:
+                result = function()
+            except BaseException as error:
+                if future is None:
+                    continue
+                _resolve(future, _set_exception, error)
+            else:
+                if future is not None:
+                    _resolve(future, _set_result, result)
+
+    @property
+    def _conn(self):
+        if self._conn_ is None:
+            raise ValueError("no active connection")
+        return self._conn_
+
+    def __submit(self, function):
+        future = get_running_loop().create_future()
+        self._tx.put_nowait((future, function))
+        return future
+
+    async def _execute(self, function, *args, **kwargs):
+        if not self._running:
+            raise ValueError("Connection closed")
+        return await self.__submit(partial(function, *args, **kwargs))
+
+    def _post(self, function, *args):
+        """Queue a call without waiting for it, its errors are dropped"""
+        if self._running:
+            self._tx.put_nowait((None, partial(function, *args)))
+
+    async def _connect(self):
+        if self._conn_ is None:
+            if not self.is_alive():
+                self.start()
+            try:
+                self._conn_ = await self.__submit(self._connector)
+            except Exception:
+                self._running = False
+                self._tx.put_nowait(_STOP)
+                raise
+        return self
+
+    def __await__(self):
+        return self._connect().__await__()
+
+    async def __aenter__(self):
+        return await self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def isolation_level(self):
+        return self._conn.isolation_level
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    async def cursor(self):
+        # Created on the connection thread by its first execute()
+        self._conn
+        return Cursor(self)
+
+    async def execute(self, sql, parameters=None):
+        return await Cursor(self).execute(sql, parameters)
+
+    async def executemany(self, sql, seq_of_parameters):
+        return await Cursor(self).executemany(sql, seq_of_parameters)
+
+    async def commit(self):
+        await self._execute(self._conn.commit)
+
+    async def rollback(self):
+        await self._execute(self._conn.rollback)
+
+    async def create_function(self, name, num_params, func, deterministic=False):
+        await self._execute(self._conn.create_function, name, num_params, func, deterministic=deterministic)
+
+    async def close(self):
+        if self._conn_ is None:
+            return
+        try:
+            await self._execute(self._conn_.close)
+        finally:
+            self._running = False
+            self._conn_ = None
+            self._tx.put_nowait(_STOP)
+
+
+class Cursor:
+    """sqlite3 cursor of a Connection, its calls run on the connection thread
+
+    One round trip per statement: the cursor is created, the statement executed and the first PREFETCH_ROWS
+    rows fetched by a single call on the thread, closing is queued without waiting."""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = None
+        self._rows = []
+        self._exhausted = True
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.arraysize = 1
+
+    def __run(self, method, sql, parameters):
+        if self._cursor is None:
+            self._cursor = self._connection._conn.cursor()
+        getattr(self._cursor, method)(sql, parameters)
+        rows = self._cursor.fetchmany(PREFETCH_ROWS) if self._cursor.description else []
+        return self._cursor.description, self._cursor.rowcount, self._cursor.lastrowid, rows
+
+    async def __statement(self, method, sql, parameters):
+        self.description, self.rowcount, self.lastrowid, self._rows = \
+            await self._connection._execute(self.__run, method, sql, parameters)
+        self._exhausted = len(self._rows) < PREFETCH_ROWS
+        return self
+
+    async def execute(self, sql, parameters=None):
+        return await self.__statement('execute', sql, () if parameters is None else parameters)
+
+    async def executemany(self, sql, seq_of_parameters):
+        return await self.__statement('executemany', sql, seq_of_parameters)
+
+    async def __fetch(self, size):
+        """Up to size rows (all when None), from the prefetched ones first"""
+        while not self._exhausted and (size is None or len(self._rows) < size):
+            rows = await self._connection._execute(self._cursor.fetchmany, PREFETCH_ROWS)
+            self._exhausted = len(rows) < PREFETCH_ROWS
+            self._rows.extend(rows)
+        if size is None or size >= len(self._rows):
+            rows, self._rows = self._rows, []
+        else:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    async def fetchone(self):
+        rows = await self.__fetch(1)
+        return rows[0] if rows else None
+
+    async def fetchmany(self, size=None):
+        return await self.__fetch(self.arraysize if size is None else size)
+
+    async def fetchall(self):
+        return await self.__fetch(None)
+
+    async def close(self):
+        self._rows = []
+        self._exhausted = True
+        if self._cursor is not None:
+            self._connection._post(self._cursor.close)
+            self._cursor = None
+
+
+def connect(database, **kwargs):
+    """Connection to database, to be awaited: sqlite3.connect(database, **kwargs) runs on its thread"""
+    return Connection(partial(sqlite3.connect, database, **kwargs))
@@ -1,37 +1,49 @@
 #!/usr/bin/python
 # -*- coding=utf-8 -*-
 import sys
+import struct
 import hashlib
 from os import path, getuid, remove
 from shutil import copy2, rmtree, move
 import zipfile
-import zlib
 import re
 from time import time
-from datetime import datetime
+from threading import RLock
 
 import pypsutil as psutil
 #from biplist import readPlist, writePlist, InvalidPlistException, NotBinaryPlistException
-from plistlib import load, dump, FMT_BINARY
-from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import BkLibraryDb, BkSeriesDb
+from plistlib import dump, FMT_BINARY
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import BkLibraryDb, BkSeriesDb, AttachedDb, can_attach, \
+    series_adam_id as series_id_for
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_trash import BookTrash
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_planner import plan_sync
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_timing import PhaseTimers
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sqlprofile import SqlProfiler, sql_report
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_memory import MemoryProfiler
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_log import log
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_cache import take_catalog
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_watch import LaunchWatcher, AppLaunched
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_coop import cooperate
 from pprint import pprint
 # from fsevents import Observer, Stream
-from profilehooks import profile
 
 from calibre_plugins.apple_ibooks.config import prefs
 
-def my_profile(func):
-    def profile_it(*args, **kwargs):
-        if prefs['debug']:
-            profile(func)(*args, **kwargs)
-        else:
-            func(*args, **kwargs)
-    return profile_it
+# Process names of the Books app (iBooks before macOS 10.15) and of its agent
+IBOOKS_PROCESS_NAMES = ('Books', 'iBooks')
+BKAGENT_PROCESS_NAME = 'BKAgentService'
+
+# Seconds all of them together get to quit after SIGTERM, and to go away after the SIGKILL of the survivors
+KILL_TIMEOUT = 5
+KILL_REAP_TIMEOUT = 1
+
 
 class IbooksApi:
     catalog = {}
     IBOOKS_BKAGENT_PATH = path.dirname(prefs['bookcatalog'])
     IBOOKS_BKAGENT_CATALOG_FILE = prefs['bookcatalog']
+    IBOOKS_TRASH_PATH = prefs['trashdir'] if prefs['trashdir'] else \
+        path.join(path.dirname(IBOOKS_BKAGENT_PATH), 'CalibreTrash')
     
     @staticmethod
     def __file_as_bytes(file_to_read, size=None):
@@ -40,39 +52,39 @@ class IbooksApi:
 
     @staticmethod
     def __kill_ibooks():
+        if not prefs['kill_ibooks']:
+            return
+
         ps_util_fail = False
 
         try:
-            processes = psutil.process_iter(attrs=['pid', 'name'])
+            # Books.app and BKAgentService of the current user, from one snapshot of the process table
+            processes = psutil.find_processes(name=IBOOKS_PROCESS_NAMES, uid=getuid(),
+                                              cmdline_contains='Books.app') + \
+                psutil.find_processes(name=BKAGENT_PROCESS_NAME, uid=getuid())
         except:
             ps_util_fail = True
             pass
 
         try:
             if not ps_util_fail:
-                # Kill any running ibooks process from the current user using pslist
+                # Terminate every running ibooks process from the current user first, then wait for all of
+                # them with one deadline and only kill the ones still running
                 for process in processes:
-                    if getuid() == process.uids()[1]:
-                        if 'Books' in process.info['name']:
-                            if 'Books.app' in process.cmdline()[0]:
-                                try:
-                                    if prefs['debug']:
-                                        print (str(datetime.now()) + ": Killing (i)Books.app")
-
-                                    process.terminate()
-                                    process.wait(5)
-                                except Exception:
-                                    process.kill()
-                                    pass
-                        if 'BKAgentService' in process.info['name']:
-                            try:
-                                if prefs['debug']:
-                                    print (str(datetime.now()) + ": Killing BKAgentService")
-                                process.terminate()
-                                process.wait(5)
-                            except Exception:
-                                process.kill()
-                                pass
+                    try:
+                        log.debug("Terminating %s", process.name())
+                        process.terminate()
+                    except psutil.NoSuchProcess:
+                        pass
+                gone, alive = psutil.wait_procs(processes, timeout=KILL_TIMEOUT)
+                for process in alive:
+                    try:
+                        log.debug("Killing %s", process.pid)
+                        process.kill()
+                    except psutil.NoSuchProcess:
+                        pass
+                if alive:
+                    psutil.wait_procs(alive, timeout=KILL_REAP_TIMEOUT)
             else:
                 # Kill any running ibooks process from the current user using ps -Au and os.kill
                 from os import kill, waitpid, WNOHANG
@@ -87,8 +99,7 @@ class IbooksApi:
                     print (type(line))
                     if 'Books.app' in line or 'BKAgentService' in line:
                         pid = int(split(r"\s+", line)[2])
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Killing " + str(pid)) #split(r"\t+", line)[4])
+                        log.debug("Killing %s", pid)
 
                         tries = 0
                         try:
@@ -114,6 +125,21 @@ class IbooksApi:
             raise
 
 
+    @staticmethod
+    def __is_ibooks_process(snapshot, pid):
+        # Same processes as __kill_ibooks quits, the name comes from the snapshot, the rest is only read for
+        # the processes bearing one of the names
+        name = snapshot.name(pid)
+        if name not in IBOOKS_PROCESS_NAMES and name != BKAGENT_PROCESS_NAME:
+            return False
+        try:
+            process = snapshot.process(pid)
+            if process.uids().effective != getuid():
+                return False
+            return name == BKAGENT_PROCESS_NAME or 'Books.app' in " ".join(process.cmdline())
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return False
+
     def __init__(self):
 
         # # Start file watcher to ensure no one else opens database files -- maybe add something to lock them
@@ -123,20 +149,52 @@ class IbooksApi:
         # self.stream = Stream(self.ObserverCallback, IBOOKS_BKAGENT_CATALOG_FILE, file_events=True )
         # self.observer.schedule(self.stream)
 
+        # Phase timings of this sync, see ibooks_timing.PHASES
+        self.timers = PhaseTimers()
+        # Memory checkpoints, only when memory_profile is on
+        self.memory = MemoryProfiler()
+        self.memory.start()
+
         try:
-            self.__kill_ibooks()
+            with self.timers.phase('kill'):
+                self.__kill_ibooks()
         except Exception:
             raise
 
+        # From here on iBooks must stay closed, commits refuse to go on if it is started again
+        self.watcher = LaunchWatcher(self.__is_ibooks_process, prefs['watch_interval'])
+        if prefs['kill_ibooks'] and prefs['watch_ibooks']:
+            self.watcher.start()
+
         try:
-            self.__library_db = BkLibraryDb()
-            self.__series_db = BkSeriesDb()
+            if prefs['attach_series'] and can_attach(prefs['dbbookcatalog'], prefs['dbseriescatalog']):
+                # Both databases on one connection, committed together
+                self.__attached_db = AttachedDb()
+                self.__library_db = self.__attached_db.library
+                self.__series_db = self.__attached_db.series
+            else:
+                self.__attached_db = None
+                self.__library_db = BkLibraryDb()
+                self.__series_db = BkSeriesDb()
             self.has_changed = 0
             self.has_backup = False
             #self.catalog = readPlist(self.IBOOKS_BKAGENT_CATALOG_FILE)
             self.catalog = None
-            with open(self.IBOOKS_BKAGENT_CATALOG_FILE, 'rb') as fp:
-                self.catalog = load(fp)
+            self.catalog = take_catalog(self.IBOOKS_BKAGENT_CATALOG_FILE)
+            self.__index_catalog()
+
+            # Serializes database/plist writers and commits when the sync runs as a pipeline
+            self.lock = RLock()
+
+            # Books a previous run left in the trash: back in place if that run crashed before committing their
+            # removal, else purged
+            self.__trash = BookTrash(self.IBOOKS_TRASH_PATH)
+            restored = self.__trash.recover(set(book['path'] for book in self.catalog['Books'] if 'path' in book))
+            if restored:
+                log.debug("Restored %s books left in trash", restored)
+            self.__trash.purge()
+
+            self.memory.snapshot('open')
 
         # except InvalidPlistException:
         #     if prefs['debug']:
@@ -152,64 +210,87 @@ class IbooksApi:
             print (sys.exc_info()[0])
             raise
 
+    def __index_catalog(self):
+        self.__catalog_index = {book['BKGeneratedItemId']: book for book in self.catalog['Books']
+                                if 'BKGeneratedItemId' in book}
+
+    def app_launched(self):
+        """Name of the iBooks process started since the sync began, None if none was"""
+        return self.watcher.launched
+
     def rollback(self):
         try:
+            self.watcher.stop()
             if self.has_changed > 0:
-                self.__kill_ibooks()
+                with self.timers.phase('kill'):
+                    self.__kill_ibooks()
 
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Rolling back library DB")
+                log.debug("Rolling back library DB")
                 self.__library_db.rollback()
 
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Rolling back Series DB")
+                log.debug("Rolling back Series DB")
                 self.__series_db.rollback()
 
                 if prefs['backup'] and self.has_backup:
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": Rolling back plist catalog")
+                    log.debug("Rolling back plist catalog")
 
                     for filename in ['bookcatalog']:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Rolling back " + filename)
+                        log.debug("Rolling back %s", filename)
                         move(prefs[filename] + ".bkp", prefs[filename])
                     self.has_backup = False
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Roll back finished")
+                log.debug("Roll back finished")
                 self.has_changed = 0
 
+            # Book files removed since the last purge are listed again by the rolled back catalogs
+            restored = self.__trash.restore()
+            if restored:
+                log.debug("Restored %s books from trash", restored)
+
         except Exception:
             print (sys.exc_info()[0])
             raise
 
-    #@profile
     def commit(self):
         try:
-            if self.has_changed > 0:
-                if prefs['backup'] and not self.has_backup:
-                    for filename in ['bookcatalog']:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Backing up " + filename)
-                        copy2(prefs[filename], prefs[filename] + ".bkp")
-                    self.has_backup = True
-                self.__kill_ibooks()
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Commmiting library DB")
-                self.__library_db.commit()
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Commmiting series DB")
-                self.__series_db.commit()
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Commmiting plist catalog")
+            with self.lock:
+                if self.has_changed > 0:
+                    if self.app_launched() is not None:
+                        raise AppLaunched(self.app_launched())
+                    with self.timers.phase('commit'):
+                        if prefs['backup'] and not self.has_backup:
+                            for filename in ['bookcatalog']:
+                                log.debug("Backing up %s", filename)
+                                copy2(prefs[filename], prefs[filename] + ".bkp")
+                            self.has_backup = True
+                        with self.timers.phase('kill'):
+                            self.__kill_ibooks()
+                        if self.__attached_db is not None:
+                            log.debug("Commmiting library and series DB")
+                            self.__attached_db.commit()
+                            cooperate()
+                        else:
+                            log.debug("Commmiting library DB")
+                            self.__library_db.commit()
+                            cooperate()
+                            log.debug("Commmiting series DB")
+                            self.__series_db.commit()
+                            cooperate()
+                        log.debug("Commmiting plist catalog")
                 
-                #writePlist(self.catalog, self.IBOOKS_BKAGENT_CATALOG_FILE + ".tmp", binary=False)
-                with open(self.IBOOKS_BKAGENT_CATALOG_FILE + ".tmp", 'wb') as fp:
-                    dump(self.catalog, fp, fmt=FMT_BINARY)
-                move(self.IBOOKS_BKAGENT_CATALOG_FILE + ".tmp", self.IBOOKS_BKAGENT_CATALOG_FILE)
-
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Commmit finished")
-                self.has_changed = 0
+                        #writePlist(self.catalog, self.IBOOKS_BKAGENT_CATALOG_FILE + ".tmp", binary=False)
+                        with open(self.IBOOKS_BKAGENT_CATALOG_FILE + ".tmp", 'wb') as fp:
+                            dump(self.catalog, fp, fmt=FMT_BINARY)
+                        move(self.IBOOKS_BKAGENT_CATALOG_FILE + ".tmp", self.IBOOKS_BKAGENT_CATALOG_FILE)
+                        # plistlib packs its offset table with a struct format of one code per object, struct caches
+                        # up to 100 of them: one per commit and each the size of the whole catalog
+                        struct._clearcache()
+
+                        log.debug("Commmit finished")
+                        self.has_changed = 0
+                        # Without backups no rollback lists the removed books again, with them see purge_trash()
+                        if not prefs['backup']:
+                            self.__trash.commit()
+                    self.memory.snapshot('commit')
         except Exception:
             print (sys.exc_info()[0])
             raise
@@ -220,245 +301,343 @@ class IbooksApi:
     #     self.observer.stop()
     #     self.observer.join()
     #     self.commit()
+        self.watcher.stop()
         del self.__series_db
         del self.__library_db
+        del self.__attached_db
         del self.catalog
 
-    #@profile
+    def fingerprint_book(self, input_path):
+        """Return the asset id (md5 of the first 32k) of a book file, None if it does not exist"""
+        with self.timers.phase('hash'):
+            if path.isfile(path.expanduser(input_path)):
+                return str(hashlib.md5(
+                    self.__file_as_bytes(open(path.expanduser(input_path), 'rb'), size=32768)).
+                           hexdigest()).upper()
+            return None
+
+    def place_book(self, input_path, asset_id):
+        """Extract (epub) or copy (pdf) a book to the BKAgent folder, returns destination path and size"""
+        size = 0
+
+        if ".epub" in input_path.lower():
+            output_path = path.join(self.IBOOKS_BKAGENT_PATH, asset_id)
+            output_path = output_path + '.epub'
+        else:
+            output_path = path.join(self.IBOOKS_BKAGENT_PATH,
+                                    # path.splitext(path.basename(path.expanduser(input_path)))[0],
+                                    path.basename(path.expanduser(input_path)))
+
+        if not path.exists(output_path):
+            if ".epub" in input_path.lower():
+                try:
+                    log.debug("Extracting epub file")
+
+                    with self.timers.phase('extract'), zipfile.ZipFile(path.expanduser(input_path), 'r') as epub_file:
+                        zip_info = epub_file.infolist()
+                        for member in zip_info:
+                            size += member.file_size
+
+                        # Member by member as extractall() does, a cooperative sync lets the dialog refresh between
+                        for member in zip_info:
+                            epub_file.extract(member, path.expanduser(output_path))
+                            cooperate()
+                except Exception:
+                    log.error("Cannot extract file to destination")
+                    print (sys.exc_info()[0])
+                    raise
+            else:
+                size = path.getsize(path.expanduser(input_path))
+                try:
+                    log.debug("Copying pdf file")
+                    with self.timers.phase('copy'):
+                        copy2(path.expanduser(input_path), path.expanduser(output_path))
+                except Exception:
+                    log.error("Cannot copy file to destination")
+                    print (sys.exc_info()[0])
+                    raise
+        else:
+            log.debug("Will not copy/extract file as it already exists -- update metadata only")
+
+        return output_path, size
+
+    def write_book_db(self, book_id=None, title=None, collection=None, genre=None, series_name=None,
+                      series_number=0, author=None, asset_id=None, output_path=None, size=0):
+        """Add or update a placed book on the series and library databases, returns the series adam id"""
+        with self.lock:
+            series_adam_id = None
+
+            if series_name is not None:
+                # series_number *= 100
+                series_adam_id = series_id_for(series_name)
+
+                log.debug("Adding to series DB")
+
+                with self.timers.phase('series_db'):
+                    self.__series_db.add_book_to_series(series_name=series_name, series_id=series_adam_id,
+                                                        series_number=series_number, author=author,
+                                                        genre=genre, adam_id=asset_id, title=title)
+            log.debug("Adding to asset DB")
+
+            with self.timers.phase('library_db'):
+                # Staged books are merged into the library by the next commit, with a few set based statements
+                write_book = self.__library_db.stage_book if prefs['staged_merge'] else self.__library_db.add_book
+                write_book(book_id=book_id, title=title, collection_name=collection, filepath=output_path,
+                           asset_id=asset_id, series_name=series_name, series_id=series_adam_id,
+                           series_number=series_number, genre=genre, author=author, size=size)
+            return series_adam_id
+
+    def write_book_plist(self, book_id=None, title=None, series_name=None, series_number=0, author=None,
+                         input_path=None, asset_id=None, output_path=None, size=0, series_adam_id=None):
+        """Add or update a placed book on the books.plist catalog"""
+        with self.lock:
+            with self.timers.phase('plist'):
+                log.debug("Checking if exists on Books.plist")
+
+                new_plist = self.__catalog_index.get(asset_id)
+                if new_plist is None:
+                    log.debug("Adding new entry to Books.plist")
+
+                    new_plist = {
+                        'BKGeneratedItemId': asset_id,
+                        'BKAllocatedSize': size,
+                        'BKBookType': u'epub' if ".epub" in input_path.lower() else u'pdf',
+                        'BKDisplayName': path.basename(path.expanduser(input_path)),
+                        'BKGenerationCount': 1,
+                        'BKInsertionDate': int(time()),
+                        'BKIsLocked': False,
+                        # 'BKPercentComplete': 1.0,
+                        'comment': 'Calibre #' + str(book_id),
+                        'artistName': author,
+                        # 'book-info': {'package-file-hash': book_hash,
+                        #               'cover-image-path': u'file:/tmp/cover.jpg'},
+                        # 'cover-writing-mqode': 'horizontal',
+                        # 'cover-url': 'file:/tmp/cover.jpg',
+                        # 'explicit': False if is_explicit is None else bool(is_explicit),
+                        # 'genre': genre,
+                        # 'isPreview': False,
+                        'itemName': title,
+                        'path': path.expanduser(output_path),
+                        'sourcePath': path.expanduser(input_path),
+                    }
+
+                    self.catalog['Books'].append(new_plist)
+                    self.__catalog_index[asset_id] = new_plist
+
+                else:
+                    log.debug("Modifying entry to Books.plist")
+
+                    new_plist['BKAllocatedSize'] = size
+                    new_plist['BKDisplayName'] = path.basename(path.expanduser(input_path))
+                    new_plist['BKBookType'] = u'epub' if ".epub" in input_path.lower() else u'pdf'
+                    new_plist['BKGenerationCount'] += 1
+                    new_plist['BKInsertionDate'] = int(time())
+                    new_plist['comment'] = 'Calibre #' + str(book_id)
+                    new_plist['artistName'] = author
+                    # new_plist['book-info'] = {'package-file-hash': book_hash}
+                    # new_plist['explicit'] = False if is_explicit is None else bool(is_explicit),
+                    # new_plist['genre'] = genre
+                    new_plist['itemName'] = title
+                    new_plist['path'] = path.expanduser(output_path)
+                    new_plist['sourcePath'] = path.expanduser(input_path)
+
+                # Add to series if needed
+                if series_name is not None:
+                    new_plist['seriesAdamId'] = series_adam_id
+                    new_plist['seriesTitle'] = series_name
+                    new_plist['seriesSequenceNumber'] = str(series_number)
+                    new_plist['playlistName'] = series_name
+                    new_plist['itemId'] = asset_id
+
+                self.has_changed += 1
+            self.memory.book_done()
+
+            if self.has_changed >= prefs['batch_size']:
+                self.commit()
+                cooperate()
+
     def add_book(self, book_id=None, title=None, collection=None, genre=None, is_explicit=None,
                  series_name=None, series_number=0, sequence_display_name=None,
                  input_path=None, author=None):
 
         try:
-            # Calculate fields and file stats, including destination collection
-            size = 0
-
             # Check if file already exists on destination
             if input_path is not None:
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Adding " + title + " to calibre")
-
-                if path.isfile(path.expanduser(input_path)):
-                    asset_id = str(hashlib.md5(
-                        self.__file_as_bytes(open(path.expanduser(input_path), 'rb'), size=32768)).
-                                   hexdigest()).upper()
-                    book_hash = asset_id
-
-                    if ".epub" in input_path.lower():
-                        output_path = path.join(self.IBOOKS_BKAGENT_PATH, asset_id)
-                        output_path = output_path + '.epub'
-                    else:
-                        output_path = path.join(self.IBOOKS_BKAGENT_PATH,
-                                                # path.splitext(path.basename(path.expanduser(input_path)))[0],
-                                                path.basename(path.expanduser(input_path)))
-
-                    if not path.exists(output_path):
-                        if ".epub" in input_path.lower():
-                            try:
-                                if prefs['debug']:
-                                    print (str(datetime.now()) + ": Extracting epub file")
-
-                                with zipfile.ZipFile(path.expanduser(input_path), 'r') as epub_file:
-                                    zip_info = epub_file.infolist()
-                                    for member in zip_info:
-                                        size += member.file_size
-
-                                    epub_file.extractall(path.expanduser(output_path))
-                            except Exception:
-                                if prefs['debug']:
-                                    print (str(datetime.now()) + ": Cannot extract file to destination")
-                                print (sys.exc_info()[0])
-                                raise
-                        else:
-                            size = path.getsize(path.expanduser(input_path))
-                            try:
-                                if prefs['debug']:
-                                   print (str(datetime.now()) + ": Copying pdf file")
-                                copy2(path.expanduser(input_path), path.expanduser(output_path))
-                            except Exception:
-                                if prefs['debug']:
-                                    print (str(datetime.now()) + ": Cannot copy file to destination")
-                                print (sys.exc_info()[0])
-                                raise
-                    else:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Will not copy/extract file as it already exists -- update metadata only")
-
-                    # Add book to database
-                    series_adam_id = None
-
-                    if series_name is not None:
-                        # series_number *= 100
-                        adam_id = zlib.crc32(asset_id.encode('utf-8'))
-                        adam_id = adam_id % (1<<32) if adam_id < 0 else adam_id
-                        series_adam_id = zlib.crc32(series_name.encode('utf-8'))
-                        series_adam_id = series_adam_id % (1 << 32) if series_adam_id < 0 else series_adam_id
+                log.debug("Adding %s to calibre", title)
 
-                        sequence_display_name = str(series_number/100) \
-                            if sequence_display_name is None else sequence_display_name
+                asset_id = self.fingerprint_book(input_path)
+                if asset_id is not None:
+                    output_path, size = self.place_book(input_path, asset_id)
 
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Adding to series DB")
-
-                        self.__series_db.add_book_to_series(series_name=series_name, series_id=series_adam_id,
-                                                            series_number=series_number, author=author,
-                                                            genre=genre, adam_id=asset_id, title=title)
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": Adding to asset DB")
-
-                    self.__library_db.add_book(book_id=book_id, title=title, collection_name=collection,
-                                               filepath=output_path, asset_id=asset_id, series_name=series_name,
-                                               series_id=series_adam_id, series_number=series_number, genre=genre,
-                                               author=author, size=size)
+                    # Add book to database
+                    series_adam_id = self.write_book_db(book_id=book_id, title=title, collection=collection,
+                                                        genre=genre, series_name=series_name,
+                                                        series_number=series_number, author=author,
+                                                        asset_id=asset_id, output_path=output_path, size=size)
 
                     # Add asset to plist file
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": Checking if exists on Books.plist")
-
-                    if asset_id not in [book['BKGeneratedItemId'] for book in self.catalog['Books']]:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Adding new entry to Books.plist")
-
-                        new_plist = {
-                            'BKGeneratedItemId': asset_id,
-                            'BKAllocatedSize': size,
-                            'BKBookType': u'epub' if ".epub" in input_path.lower() else u'pdf',
-                            'BKDisplayName': path.basename(path.expanduser(input_path)),
-                            'BKGenerationCount': 1,
-                            'BKInsertionDate': int(time()),
-                            'BKIsLocked': False,
-                            # 'BKPercentComplete': 1.0,
-                            'comment': 'Calibre #' + str(book_id),
-                            'artistName': author,
-                            # 'book-info': {'package-file-hash': book_hash,
-                            #               'cover-image-path': u'file:/tmp/cover.jpg'},
-                            # 'cover-writing-mqode': 'horizontal',
-                            # 'cover-url': 'file:/tmp/cover.jpg',
-                            # 'explicit': False if is_explicit is None else bool(is_explicit),
-                            # 'genre': genre,
-                            # 'isPreview': False,
-                            'itemName': title,
-                            'path': path.expanduser(output_path),
-                            'sourcePath': path.expanduser(input_path),
-                        }
-
-                        # Add to series if needed
-                        if series_name is not None:
-                            new_plist['seriesAdamId'] = series_adam_id
-                            new_plist['seriesTitle'] = series_name
-                            new_plist['seriesSequenceNumber'] = str(series_number)
-                            new_plist['playlistName'] = series_name
-                            new_plist['itemId'] = asset_id
-
-                        self.catalog['Books'].append(new_plist)
-
-                    else:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Modifying entry to Books.plist")
-
-                        new_plist = self.catalog['Books'][
-                            next((i for i, book in enumerate(self.catalog['Books'])
-                                  if book['BKGeneratedItemId'] == asset_id), -1)
-                        ]
-                        new_plist['BKAllocatedSize'] = size
-                        new_plist['BKDisplayName'] = path.basename(path.expanduser(input_path)),
-                        new_plist['BKBookType'] = u'epub' if ".epub" in input_path.lower() else u'pdf',
-                        new_plist['BKGenerationCount'] += 1
-                        new_plist['BKInsertionDate'] = int(time())
-                        new_plist['comment'] = 'Calibre #' + str(book_id)
-                        new_plist['artistName'] = author
-                        # new_plist['book-info'] = {'package-file-hash': book_hash}
-                        # new_plist['explicit'] = False if is_explicit is None else bool(is_explicit),
-                        # new_plist['genre'] = genre
-                        new_plist['itemName'] = title
-                        new_plist['path'] = path.expanduser(output_path)
-                        new_plist['sourcePath'] = path.expanduser(input_path)
-
-                        # Add to series if needed
-                        if series_name is not None:
-                            new_plist['seriesAdamId'] = series_adam_id
-                            new_plist['seriesTitle'] = series_name
-                            new_plist['seriesSequenceNumber'] = str(series_number)
-                            new_plist['playlistName'] = series_name
-                            new_plist['itemId'] = asset_id
-
-                    self.has_changed += 1
+                    self.write_book_plist(book_id=book_id, title=title, series_name=series_name,
+                                          series_number=series_number, author=author, input_path=input_path,
+                                          asset_id=asset_id, output_path=output_path, size=size,
+                                          series_adam_id=series_adam_id)
 
                 else:
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": File not found!")
+                    log.warning("File not found!")
                     print (sys.exc_info()[0])
                     return -1
 
             else:
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Path is invalid")
+                log.warning("Path is invalid")
                 return -1
 
-            if prefs['debug']:
-                print (str(datetime.now()) + ": Done adding new book\n")
+            log.debug("Done adding new book")
 
-            # Todo: add batch size as a configuration option
-            if (self.has_changed % 1000 == 0):
-                self.commit()
             return 0
 
         except Exception:
             print (sys.exc_info()[0])
             raise
 
-    def del_all_books_from_calibre(self):
+    def __delete_book_file(self, file_path):
+        if prefs['deferred_delete'] and self.__trash.discard(file_path):
+            return
+
+        if (path.isdir(file_path)):
+            try:
+                rmtree(file_path)
+            except OSError:
+                pass
+        else:
+            try:
+                remove(file_path)
+            except OSError:
+                pass
+
+    def del_all_books_from_calibre(self, commit=True):
         deleted = 0
-        self.__library_db.del_all_books_from_calibre()
+        series_adam_ids = []
+        with self.timers.phase('library_db'):
+            self.__library_db.del_all_books_from_calibre()
 
         count = len(self.catalog['Books'])
 
-        if prefs['debug']:
-                    print (str(datetime.now()) + ": Deletting all books from calibre")
+        log.debug("Deletting all books from calibre")
 
         for i in range(len(self.catalog['Books']) - 1, -1, -1):
             book = self.catalog['Books'][i]
 
             if 'comment' not in book:
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Not deleting " + str(i) + ': Book not added by calibre, skipping')
+                log.debug("Not deleting %s: Book not added by calibre, skipping", i)
                 continue
 
-            if prefs['debug']:
-                print (str(datetime.now()) + ": Deleting " + str(i) + ": " + book['comment'])
+            log.debug("Deleting %s: %s", i, book['comment'])
 
             if "Calibre #" in book['comment']:
-                file_path = book['path']
-                if (path.isdir(file_path)):
-                    try:
-                        rmtree(file_path)
-                    except OSError:
-                        pass
-                else:
-                    try:
-                        remove(file_path)
-                    except OSError:
-                        pass
+                self.__delete_book_file(book['path'])
 
                 if 'seriesAdamId' in book:
-                    adam_id = book['itemId']
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": Removed " +str(adam_id) + " from series table")
-                    self.__series_db.del_book_from_series(adam_id=adam_id)
+                    series_adam_ids.append(book['itemId'])
 
                 del (self.catalog['Books'][i])
                 self.has_changed=1
                 deleted += 1
+                cooperate()
 
-        if prefs['debug']:
-            print (str(datetime.now()) + ": Deleted " + str(deleted) + "/" + str(count) + " books from plist, kept " +\
-              str(len(self.catalog['Books'])) + " books")
+        log.debug("Removing %d books from series table", len(series_adam_ids))
+        with self.timers.phase('series_db'):
+            self.__series_db.del_books_from_series(adam_ids=series_adam_ids)
+
+        self.__index_catalog()
+
+        # Catalog changes are committed right away, book files are purged from the trash in background
+        if prefs['deferred_delete'] and deleted > 0 and commit:
+            self.commit()
+            self.__trash.purge()
+
+        log.debug("Deleted %s/%s books from plist, kept %d books", deleted, count, len(self.catalog['Books']))
         # if deleted > 0:
         #     writePlist(self.catalog, self.IBOOKS_BKAGENT_CATALOG_FILE)
 
         return deleted
 
 
+    def remove_books(self, calibre_ids, commit=True):
+        """Remove the given calibre books from the library and series databases, books.plist and disk
+
+        With commit=False the removal is committed along with the sync and the files stay in the trash
+        until purge_trash(), a rollback restores them."""
+        comments = set('Calibre #' + str(calibre_id) for calibre_id in calibre_ids)
+        if not comments:
+            return 0
+
+        log.debug("Removing %d books from calibre", len(comments))
+
+        kept = []
+        asset_ids = []
+        series_adam_ids = []
+        for book in self.catalog['Books']:
+            if book.get('comment') not in comments:
+                kept.append(book)
+                continue
+
+            asset_ids.append(book['BKGeneratedItemId'])
+            if 'seriesAdamId' in book:
+                series_adam_ids.append(book['itemId'])
+            self.__delete_book_file(book['path'])
+            cooperate()
+
+        # Books may be missing from either the plist or the library DB
+        with self.timers.phase('library_db'):
+            deleted = max(self.__library_db.del_books(asset_ids=asset_ids, calibre_ids=calibre_ids), len(asset_ids))
+        with self.timers.phase('series_db'):
+            self.__series_db.del_books_from_series(adam_ids=series_adam_ids)
+
+        if deleted:
+            self.catalog['Books'] = kept
+            self.__index_catalog()
+            self.has_changed = 1
+
+            if prefs['deferred_delete'] and commit:
+                self.commit()
+                self.__trash.purge()
+
+        log.debug("Removed %s books, kept %d books on plist", deleted, len(self.catalog['Books']))
+
+        return deleted
+
+    def sql_report(self, top=None):
+        """Top SQL statements of both databases for the dialog log, empty unless sql_profile is on"""
+        if not SqlProfiler.enabled():
+            return []
+        return sql_report([self.__library_db.profiler, self.__series_db.profiler], top)
+
+    def sql_statements(self):
+        """Aggregated stats of every SQL statement run on both databases, slowest total first"""
+        return sorted(self.__library_db.profiler.statements() + self.__series_db.profiler.statements(),
+                      key=lambda stats: -stats['total_ms'])
+
+    def plan(self, records, known_ids=None):
+        """Plan the sync of the given calibre records against BKLibrary and books.plist, see plan_sync"""
+        plan = plan_sync(records, self.__library_db.snapshot_calibre_books(), self.catalog['Books'],
+                         known_ids=known_ids)
+        self.memory.snapshot('plan')
+        return plan
+
+    def remove_planned(self, plan):
+        """Remove the books the plan deletes or copies again, returns the records left to add or update"""
+        doomed = plan.actions['delete'] + [record.book_id for record in plan.actions['update']]
+        if len(doomed):
+            # Part of the sync: an interrupted or failed sync must find the former files of updated books
+            self.remove_books(doomed, commit=False)
+        self.memory.snapshot('remove')
+        return plan.records('update', 'add', 'metadata')
+
+    def purge_trash(self):
+        """Purge the removed book files in background, once the sync is committed and will not be rolled back"""
+        if prefs['deferred_delete']:
+            return self.__trash.purge()
+        return None
+
     def add_collection(self, title):
         return self.__library_db.create_collection(title)
 
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sqlite3
+from asyncio import get_running_loop
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.dialects.sqlite.aiosqlite import AsyncAdapt_aiosqlite_dbapi
+
+from calibre_plugins.apple_ibooks.config import prefs
+from calibre_plugins.apple_ibooks.ibooks_api import ibooks_aiosqlite
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import BkLibraryDb, BkSeriesDb, automap_schema
+
+# The aiosqlite dialect DBAPI adapter over the in-tree thread backed driver, aiosqlite itself is not bundled
+_dbapi = None
+
+
+def create_async_sqlite_engine(file_path, **kwargs):
+    """AsyncEngine on a sqlite file, every connection runs sqlite3 on a thread of its own"""
+    global _dbapi
+    if _dbapi is None:
+        _dbapi = AsyncAdapt_aiosqlite_dbapi(ibooks_aiosqlite, sqlite3)
+    return create_async_engine("sqlite+aiosqlite:///" + file_path, module=_dbapi, **kwargs)
+
+
+def reflect_schema(file_path):
+    """Reflect a sqlite file into the automap cache with a sync engine, for a thread outside the event loop"""
+    engine = create_engine("sqlite:///" + file_path)
+    try:
+        automap_schema(engine, file_path)
+    finally:
+        engine.dispose()
+
+
+class AsyncDb:
+    """Sync database class driven from asyncio: its methods run through AsyncSession.run_sync()
+
+    The ORM work still runs on the event loop thread, every statement and commit is awaited on the
+    connection thread, so other coroutines (hashing, extraction) run meanwhile. Calls on one instance
+    must be awaited one after the other, the library and series databases can be awaited together."""
+
+    DB_CLASS = None
+    FILE_PREF = None
+
+    def __init__(self, engine, session, db):
+        self.engine = engine
+        self.session = session
+        self.db = db
+
+    @classmethod
+    async def open(cls):
+        """Open the database of FILE_PREF and build DB_CLASS on the session"""
+        file_path = prefs[cls.FILE_PREF]
+        # Reflected on a thread first, the schema cache lock must not be held across the greenlet switches of
+        # run_sync(): a second database opened meanwhile would block the event loop on it
+        await get_running_loop().run_in_executor(None, reflect_schema, file_path)
+        engine = create_async_sqlite_engine(file_path)
+        # Mapped objects stay loaded after commit, they may be read outside run_sync()
+        session = AsyncSession(engine, expire_on_commit=False)
+        try:
+            db = await session.run_sync(lambda sync_session: cls.DB_CLASS(session=sync_session))
+        except Exception:
+            await session.close()
+            await engine.dispose()
+            raise
+        return cls(engine, session, db)
+
+    async def call(self, method, *args, **kwargs):
+        """Await DB_CLASS.method(*args, **kwargs)"""
+        return await self.session.run_sync(lambda sync_session: getattr(self.db, method)(*args, **kwargs))
+
+    @property
+    def has_changed(self):
+        return self.db.has_changed
+
+    async def commit(self):
+        await self.call('commit')
+
+    async def rollback(self):
+        await self.call('rollback')
+
+    async def close(self):
+        await self.session.close()
+        await self.engine.dispose()
+
+
+class AsyncBkLibraryDb(AsyncDb):
+    """BkLibraryDb awaitable from asyncio, opened with await AsyncBkLibraryDb.open()"""
+
+    DB_CLASS = BkLibraryDb
+    FILE_PREF = 'dbbookcatalog'
+
+    async def add_book(self, **kwargs):
+        return await self.call('add_book', **kwargs)
+
+    async def stage_book(self, **kwargs):
+        return await self.call('stage_book', **kwargs)
+
+    async def del_books(self, asset_ids=None, calibre_ids=None):
+        return await self.call('del_books', asset_ids=asset_ids, calibre_ids=calibre_ids)
+
+    async def del_all_books_from_calibre(self):
+        return await self.call('del_all_books_from_calibre')
+
+    async def snapshot_calibre_books(self):
+        return await self.call('snapshot_calibre_books')
+
+    async def list_books(self):
+        return await self.call('list_books')
+
+
+class AsyncBkSeriesDb(AsyncDb):
+    """BkSeriesDb awaitable from asyncio, opened with await AsyncBkSeriesDb.open()"""
+
+    DB_CLASS = BkSeriesDb
+    FILE_PREF = 'dbseriescatalog'
+
+    async def add_book_to_series(self, **kwargs):
+        return await self.call('add_book_to_series', **kwargs)
+
+    async def del_books_from_series(self, adam_ids=None):
+        return await self.call('del_books_from_series', adam_ids=adam_ids)
+
+    async def list_series_items(self):
+        return await self.call('list_series_items')
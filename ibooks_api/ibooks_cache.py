@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+from os import path, stat
+from threading import Lock
+from importlib import import_module
+from plistlib import load
+
+from sqlalchemy import create_engine
+
+from calibre_plugins.apple_ibooks.config import prefs
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_log import log
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import automap_schema, create_attached_engine, \
+    can_attach, SERIES_SCHEMA
+
+# Parsed books.plist waiting for the next sync, {file: ((inode, mtime, size), catalog)}
+_catalogs = {}
+_catalogs_lock = Lock()
+
+# Imported lazily by SQLAlchemy on the first engine or query, and by pypsutil on the first process lookup of the
+# kill step, import them ahead with the rest
+LAZY_MODULES = ('sqlalchemy.dialects.sqlite', 'sqlalchemy.dialects.sqlite.pysqlite', 'sqlalchemy.ext.automap',
+                'sqlite3', 'pypsutil._process')
+
+
+def _stamp(file_path):
+    file_stat = stat(file_path)
+    return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+
+def prepare_catalog(file_path):
+    """Parse a books.plist ahead of the sync that will take it"""
+    stamp = _stamp(file_path)
+    with open(file_path, 'rb') as fp:
+        catalog = load(fp)
+    with _catalogs_lock:
+        _catalogs[file_path] = (stamp, catalog)
+
+
+def take_catalog(file_path):
+    """Parsed books.plist, the prepared one when the file did not change since, else read now
+
+    A prepared catalog is handed over once, the sync modifies it in place."""
+    with _catalogs_lock:
+        cached = _catalogs.pop(file_path, None)
+    if cached is not None and cached[0] == _stamp(file_path):
+        return cached[1]
+    with open(file_path, 'rb') as fp:
+        return load(fp)
+
+
+def prepare_caches():
+    """Import what a sync imports lazily, reflect both databases and parse books.plist"""
+    for module in LAZY_MODULES:
+        import_module(module)
+
+    # Attached, the series tables are mapped qualified by their schema
+    attached = prefs['attach_series'] and path.isfile(prefs['dbbookcatalog']) and \
+        path.isfile(prefs['dbseriescatalog']) and can_attach(prefs['dbbookcatalog'], prefs['dbseriescatalog'])
+    for file_path in (prefs['dbbookcatalog'],) if attached else (prefs['dbbookcatalog'], prefs['dbseriescatalog']):
+        if path.isfile(file_path):
+            engine = create_engine("sqlite:///" + file_path)
+            try:
+                automap_schema(engine, file_path)
+            finally:
+                engine.dispose()
+
+    if attached:
+        engine = create_attached_engine(prefs['dbbookcatalog'], prefs['dbseriescatalog'])
+        try:
+            automap_schema(engine, prefs['dbseriescatalog'], SERIES_SCHEMA)
+        finally:
+            engine.dispose()
+
+    if path.isfile(prefs['bookcatalog']):
+        prepare_catalog(prefs['bookcatalog'])
+
+    log.debug("Sync caches prepared")
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+from time import perf_counter
+from threading import get_ident
+
+try:
+    from greenlet import greenlet, getcurrent
+except ImportError:
+    greenlet = None
+
+from calibre_plugins.apple_ibooks.config import prefs
+
+# Task resumed on this process right now, cooperate() only acts inside it
+_running = None
+
+
+class CooperativeTask:
+    """Runs func(*args) as a greenlet that hands control back to its caller once its time slice is over
+
+    resume() runs the task until it reaches cooperate() past the end of the slice, or until it finishes. The plugin
+    dialog calls it from a zero timer, so the Qt event loop gets a turn between two slices while the sync stays on
+    the GUI thread. Without greenlet the task runs to the end in one resume() and cooperate() calls idle instead
+    (processEvents for the dialog) at the end of each slice."""
+
+    def __init__(self, func, *args, slice_ms=None, idle=None):
+        self.slice = (prefs['coop_slice_ms'] if slice_ms is None else slice_ms) / 1000.0
+        self.idle = idle
+        self.result = None
+        self.exc_info = None
+        self.done = False
+        self.slices = 0
+        self.__func = func
+        self.__args = args
+        self.__greenlet = None
+        self.__thread = None
+        self.__deadline = 0
+
+    @property
+    def cooperative(self):
+        """True when the task really yields to its caller, False when greenlet is not available"""
+        return greenlet is not None
+
+    def resume(self, slice_seconds=None):
+        """Run the next slice, returns False once the task finished (see result and exc_info)"""
+        global _running
+        if self.done:
+            return False
+
+        self.__thread = get_ident()
+        self.__deadline = perf_counter() + (self.slice if slice_seconds is None else slice_seconds)
+        previous, _running = _running, self
+        try:
+            if greenlet is None:
+                self.__run()
+            else:
+                if self.__greenlet is None:
+                    self.__greenlet = greenlet(self.__run)
+                self.__greenlet.switch()
+        finally:
+            _running = previous
+        self.slices += 1
+        return not self.done
+
+    def inside(self):
+        """True when called from the task itself, which cannot resume or finish itself"""
+        return _running is self
+
+    def finish(self):
+        """Run the task to the end without yielding, when its caller cannot resume it any more"""
+        while self.resume(float('inf')):
+            pass
+
+    def time_left(self):
+        """Seconds left in the current slice, None when called from outside the task"""
+        if self.__thread != get_ident() or (greenlet is not None and getcurrent() is not self.__greenlet):
+            return None
+        return max(self.__deadline - perf_counter(), 0)
+
+    def switch_out(self):
+        """Hand control back to the caller of resume() (or run idle), if the slice is over"""
+        left = self.time_left()
+        if left is None or left > 0:
+            return
+        if greenlet is not None:
+            self.__greenlet.parent.switch()
+        else:
+            if self.idle is not None:
+                self.idle()
+            self.__deadline = perf_counter() + self.slice
+
+    def __run(self):
+        try:
+            self.result = self.__func(*self.__args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done = True
+
+
+def cooperate():
+    """Yield point of a cooperative task: back to the event loop when the time slice is over, else nothing
+
+    Cheap enough for inner loops, and a no-op outside a task or on another thread (pipeline workers)."""
+    task = _running
+    if task is not None:
+        task.switch_out()
+
+
+def time_left():
+    """Seconds left in the time slice of the running task, None outside a task (block as long as needed)"""
+    task = _running
+    return None if task is None else task.time_left()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+import os
+import zipfile
+import hashlib
+import tempfile
+from shutil import rmtree
+from time import perf_counter
+from importlib import util, machinery
+from importlib.abc import MetaPathFinder
+
+# Stdlib only: this runs before the bundled packages are importable
+
+PLUGIN_ZIP = os.path.expanduser("~/Library/Preferences/calibre/plugins/Apple_iBooks.zip")
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'calibre_ibooks_plugin')
+
+PACKAGES = 'packages'
+
+# How the bundled packages were made importable by the last load_packages(), for the debug log
+LOAD_STATS = {}
+
+
+class NativeModuleFinder(MetaPathFinder):
+    """Finds the extension modules of the plugin zip in their extracted copy, zipimport cannot load them"""
+
+    def __init__(self, modules):
+        self.modules = modules
+
+    def find_spec(self, fullname, path=None, target=None):
+        file_path = self.modules.get(fullname)
+        if file_path is None:
+            return None
+        return util.spec_from_file_location(fullname, file_path)
+
+
+def native_members(plugin_zip):
+    """Extension modules of this interpreter under packages/ in the zip, as {dotted module name: ZipInfo}"""
+    members = {}
+    for info in plugin_zip.infolist():
+        if not info.filename.startswith(PACKAGES + '/') or '/tests/' in info.filename:
+            continue
+        # _greenlet.cpython-39-darwin.so is only a module of a CPython 3.9 on macOS
+        folder, _, file_name = info.filename[len(PACKAGES) + 1:].rpartition('/')
+        module, dot, suffix = file_name.partition('.')
+        if dot and dot + suffix in machinery.EXTENSION_SUFFIXES:
+            members[(folder.replace('/', '.') + '.' if folder else '') + module] = info
+    return members
+
+
+def native_key(members):
+    """Short hash of the native members names, sizes and CRCs, read from the zip directory"""
+    digest = hashlib.sha1()
+    for module in sorted(members):
+        info = members[module]
+        digest.update(('%s:%d:%08x\n' % (info.filename, info.file_size, info.CRC)).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def extract_native(plugin_zip, members, cache_dir=CACHE_DIR):
+    """Extract the native members once per key, returns {dotted module name: extracted file}
+
+    The files are extracted into a private folder renamed into place, so a concurrent calibre never sees a
+    partial copy. Copies for other keys are removed."""
+    target = os.path.join(cache_dir, 'native-' + native_key(members))
+    extracted = False
+
+    if not os.path.isdir(target):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        staging = tempfile.mkdtemp(prefix='.native-', dir=cache_dir)
+        try:
+            for info in members.values():
+                plugin_zip.extract(info, staging)
+            os.rename(staging, target)
+            extracted = True
+        except OSError:
+            # Lost the race against another process extracting the same key
+            if not os.path.isdir(target):
+                raise
+        finally:
+            if os.path.isdir(staging):
+                rmtree(staging, ignore_errors=True)
+
+        for name in os.listdir(cache_dir):
+            if name.startswith('native-') and os.path.join(cache_dir, name) != target:
+                rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    LOAD_STATS['extracted'] = extracted
+    return dict((module, os.path.join(target, info.filename)) for module, info in members.items())
+
+
+def load_packages(plugin_zip=PLUGIN_ZIP, source_packages=None, cache_dir=CACHE_DIR):
+    """Make the bundled packages importable, returns the sys.path entry added
+
+    From a source tree the packages folder is used as is. From the plugin zip pure python modules are
+    imported by zipimport straight from the zip and only extension modules are extracted."""
+    start = perf_counter()
+    if source_packages is not None and os.path.isdir(source_packages):
+        packages_path = source_packages
+        LOAD_STATS.update(mode='source', native=0, extracted=False)
+    elif os.path.isfile(plugin_zip):
+        packages_path = os.path.join(plugin_zip, PACKAGES)
+        with zipfile.ZipFile(plugin_zip, 'r') as packages:
+            members = native_members(packages)
+            modules = extract_native(packages, members, cache_dir) if members else {}
+        if modules and not any(getattr(finder, 'modules', None) == modules for finder in sys.meta_path):
+            sys.meta_path.insert(0, NativeModuleFinder(modules))
+        LOAD_STATS.update(mode='zip', native=len(modules))
+    else:
+        return None
+
+    if packages_path not in sys.path:
+        sys.path.insert(0, packages_path)
+    LOAD_STATS.update(path=packages_path, seconds=perf_counter() - start)
+    return packages_path
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+import logging
+from os import path
+from collections import deque
+from threading import Lock
+from datetime import datetime
+from logging.handlers import RotatingFileHandler, MemoryHandler
+
+from calibre_plugins.apple_ibooks.config import prefs
+
+# Plugin logger, call it with %-style arguments so lines below the active level are never formatted
+log = logging.getLogger('calibre_plugins.apple_ibooks')
+log.propagate = False
+
+# Records written to the rotating file in one go, errors are written at once
+_FILE_BATCH = 200
+
+_handlers = {}
+
+
+def log_path():
+    """Log file next to the plugin preferences, None when prefs are not backed by a file"""
+    prefs_file = getattr(prefs, 'file_path', None)
+    if not prefs_file:
+        return None
+    return path.join(path.dirname(prefs_file), path.splitext(path.basename(prefs_file))[0] + '_sync.log')
+
+
+class _Formatter(logging.Formatter):
+    """Same timestamp as the str(datetime.now()) prefix the plugin always logged with"""
+
+    def formatTime(self, record, datefmt=None):
+        return str(datetime.fromtimestamp(record.created))
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the latest records unformatted until the view drains them in one batch
+
+    When the view falls behind the oldest records are dropped, they are still in the log file."""
+
+    def __init__(self, capacity, level=logging.INFO):
+        logging.Handler.__init__(self, level)
+        self.__lock = Lock()
+        self.__records = deque(maxlen=capacity)
+        self.dropped = 0
+
+    def emit(self, record):
+        with self.__lock:
+            if len(self.__records) == self.__records.maxlen:
+                self.dropped += 1
+            self.__records.append(record)
+
+    def drain(self):
+        """Formatted lines logged since the last drain, oldest first"""
+        with self.__lock:
+            records = list(self.__records)
+            self.__records.clear()
+            dropped, self.dropped = self.dropped, 0
+
+        lines = [self.format(record) for record in records]
+        if dropped:
+            lines.insert(0, str(datetime.now()) + ": " + str(dropped) + " lines not shown, see the log file")
+        return lines
+
+
+def setup_logging(file_path=None, view=True):
+    """Attach the ring buffer (for a log view) and rotating file handlers to the plugin logger once,
+    returns the ring buffer or None
+
+    Debug lines are only produced, and only reach the file, with the debug preference on."""
+    log.setLevel(logging.DEBUG if prefs['debug'] else logging.INFO)
+
+    if view and 'ring' not in _handlers:
+        _handlers['ring'] = RingBufferHandler(prefs['log_ring_size'])
+        _handlers['ring'].setFormatter(_Formatter('%(asctime)s: %(message)s'))
+        log.addHandler(_handlers['ring'])
+
+    file_path = file_path or log_path()
+    if file_path is not None and 'file' not in _handlers:
+        try:
+            rotating = RotatingFileHandler(file_path, maxBytes=prefs['log_file_kb'] * 1024,
+                                           backupCount=prefs['log_file_backups'], encoding='utf-8')
+            rotating.setFormatter(_Formatter('%(asctime)s %(levelname)s: %(message)s'))
+            _handlers['file'] = MemoryHandler(_FILE_BATCH, flushLevel=logging.ERROR, target=rotating)
+            log.addHandler(_handlers['file'])
+        except (IOError, OSError):
+            print (sys.exc_info()[0])
+
+    return _handlers.get('ring')
+
+
+def flush_logging():
+    """Write the pending records to the log file"""
+    if 'file' in _handlers:
+        _handlers['file'].flush()
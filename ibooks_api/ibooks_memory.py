@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+import tracemalloc
+from datetime import datetime
+
+import pypsutil as psutil
+
+from calibre_plugins.apple_ibooks.config import prefs
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_log import log
+
+MB = 1048576.0
+
+# Allocations made by the profiler itself or by imports are noise in the top sites
+_IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>',
+                  '<unknown>')
+
+
+class MemoryProfiler:
+    """Memory checkpoints of a sync: tracemalloc snapshots at phase boundaries and every N books, plus RSS
+
+    Only the first and the latest snapshot are kept, top allocation sites are the growth between them.
+    Every method is a no-op unless the memory_profile preference is on."""
+
+    def __init__(self, enabled=None, every=None):
+        self.enabled = prefs['memory_profile'] if enabled is None else enabled
+        self.every = prefs['memory_profile_every'] if every is None else every
+        self.checkpoints = []
+        self.books = 0
+        self.peak_rss = 0
+        self.__process = None
+        self.__started_tracing = False
+        self.__first = None
+        self.__last = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        try:
+            self.__process = psutil.Process()
+        except Exception:
+            print (sys.exc_info()[0])
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(prefs['memory_profile_frames'])
+            self.__started_tracing = True
+        self.snapshot('start')
+
+    def snapshot(self, label):
+        """Record a checkpoint named label"""
+        if not self.enabled or not tracemalloc.is_tracing():
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in _IGNORED_FILES])
+        if self.__first is None:
+            self.__first = snapshot
+        self.__last = snapshot
+
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        rss = self.__rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.checkpoints.append({
+            'label': label,
+            'books': self.books,
+            'time': str(datetime.now()),
+            'traced_mb': traced / MB,
+            'traced_peak_mb': traced_peak / MB,
+            'rss_mb': rss / MB,
+        })
+        log.debug("Memory at %s: %.1f MB traced, %.1f MB RSS", label, traced / MB, rss / MB)
+
+    def book_done(self):
+        """Count a synced book, taking a checkpoint every memory_profile_every books"""
+        if not self.enabled:
+            return
+        self.books += 1
+        if self.every and self.books % self.every == 0:
+            self.snapshot('books')
+
+    def __rss(self):
+        if self.__process is None:
+            return 0
+        try:
+            return self.__process.memory_info().rss
+        except Exception:
+            return 0
+
+    def top_sites(self, top=None):
+        """Allocation sites that grew the most between the first and the latest checkpoint"""
+        top = prefs['memory_profile_top'] if top is None else top
+        if self.__first is None or self.__last is None:
+            return []
+        return [{
+            'site': str(stat.traceback[0]) if len(stat.traceback) else '?',
+            'size_mb': stat.size / MB,
+            'size_diff_mb': stat.size_diff / MB,
+            'count': stat.count,
+            'count_diff': stat.count_diff,
+        } for stat in self.__last.compare_to(self.__first, 'lineno')[:top]]
+
+    def stop(self):
+        """Take the last checkpoint and stop tracing if this profiler started it"""
+        if not self.enabled or not tracemalloc.is_tracing():
+            return
+        self.snapshot('end')
+        if self.__started_tracing:
+            tracemalloc.stop()
+            self.__started_tracing = False
+
+    def summary(self):
+        if not self.enabled:
+            return {}
+        return {
+            'peak_rss_mb': self.peak_rss / MB,
+            'checkpoints': self.checkpoints,
+            'top_sites': self.top_sites(),
+        }
+
+    def report(self):
+        """Checkpoints at phase boundaries, peak RSS and top allocation sites, for the dialog log"""
+        if not self.enabled:
+            return []
+        lines = ["Memory at " + checkpoint['label'] + " (" + str(checkpoint['books']) + " books): " +
+                 "%.1f MB traced, %.1f MB traced peak, %.1f MB RSS" % (
+                     checkpoint['traced_mb'], checkpoint['traced_peak_mb'], checkpoint['rss_mb'])
+                 for checkpoint in self.checkpoints if checkpoint['label'] != 'books']
+        lines.append("Memory peak RSS: %.1f MB" % (self.peak_rss / MB))
+        for site in self.top_sites():
+            lines.append("Memory site %s: %+.2f MB (%.2f MB, %+d blocks)" % (
+                site['site'], site['size_diff_mb'], site['size_mb'], site['count_diff']))
+        return lines
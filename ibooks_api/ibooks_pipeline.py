@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+from threading import Thread, Event, Lock
+from time import perf_counter_ns
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from calibre_plugins.apple_ibooks.config import prefs
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_coop import cooperate, time_left
+
+# Marks the end of the input for one worker of a stage
+_DONE = object()
+
+
+class Stage:
+    """A pipeline stage: a pool of workers reading from a bounded input queue"""
+
+    def __init__(self, name, func, workers=1, queue_depth=64, runs_on_stop=False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.queue = Queue(maxsize=max(1, int(queue_depth)))
+        # Stages past the point of no return (plist writer) must finish the books already written to the DB
+        self.runs_on_stop = runs_on_stop
+        self.items = 0
+        self.busy_ns = 0
+        self.max_depth = 0
+        self.lock = Lock()
+        self.live_workers = self.workers
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def stats(self):
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'items': self.items,
+            'busy_ms': self.busy_ns / 1000000.0,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_depth,
+        }
+
+
+class SyncPipeline:
+    """Runs the sync as metadata -> fingerprint -> placement -> DB writer -> plist writer stages
+
+    Stages are connected by bounded queues, each with its own worker pool. The writer stages share
+    the SQLAlchemy sessions and the plist catalog, so they always run with a single worker."""
+
+    STAGES = ('metadata', 'fingerprint', 'placement', 'db_writer', 'plist_writer')
+    SERIAL_STAGES = ('db_writer', 'plist_writer')
+
+    def __init__(self, api, workers=None, queue_depth=None):
+        self.api = api
+        workers = prefs['pipeline_workers'] if workers is None else workers
+        queue_depth = prefs['pipeline_queue_depth'] if queue_depth is None else queue_depth
+
+        funcs = {
+            'metadata': self.__metadata,
+            'fingerprint': self.__fingerprint,
+            'placement': self.__placement,
+            'db_writer': self.__db_writer,
+            'plist_writer': self.__plist_writer,
+        }
+        self.stages = [
+            Stage(name, funcs[name],
+                  workers=1 if name in self.SERIAL_STAGES else workers.get(name, 1),
+                  queue_depth=queue_depth,
+                  runs_on_stop=(name == 'plist_writer'))
+            for name in self.STAGES
+        ]
+        self.output = Queue(maxsize=max(1, int(queue_depth)))
+        self.stop_event = Event()
+        self.error = None
+        self.threads = []
+
+    @staticmethod
+    def __metadata(item):
+        record = item['record']
+        if record.fmt is None:
+            item['skipped'] = 'has no compatible formats'
+            return item
+
+        item['book'] = {
+            'book_id': record.book_id,
+            'title': record.title,
+            'author': record.author,
+            'input_path': record.path,
+            'collection': record.series if record.series is not None else
+                (u"Books" if record.fmt == "EPUB" else u"PDFs"),
+            'series_name': record.series,
+            'series_number': record.series_index,
+        }
+        return item
+
+    def __fingerprint(self, item):
+        book = item['book']
+        if book['input_path'] is None:
+            item['skipped'] = 'path is invalid'
+            return item
+
+        book['asset_id'] = self.api.fingerprint_book(book['input_path'])
+        if book['asset_id'] is None:
+            item['skipped'] = 'file not found'
+        return item
+
+    def __placement(self, item):
+        book = item['book']
+        book['output_path'], book['size'] = self.api.place_book(book['input_path'], book['asset_id'])
+        return item
+
+    def __db_writer(self, item):
+        book = item['book']
+        book['series_adam_id'] = self.api.write_book_db(
+            book_id=book['book_id'], title=book['title'], collection=book['collection'],
+            series_name=book['series_name'], series_number=book['series_number'], author=book['author'],
+            asset_id=book['asset_id'], output_path=book['output_path'], size=book['size'])
+        return item
+
+    def __plist_writer(self, item):
+        book = item['book']
+        self.api.write_book_plist(
+            book_id=book['book_id'], title=book['title'], series_name=book['series_name'],
+            series_number=book['series_number'], author=book['author'], input_path=book['input_path'],
+            asset_id=book['asset_id'], output_path=book['output_path'], size=book['size'],
+            series_adam_id=book['series_adam_id'])
+        return item
+
+    def __next_put(self, index, item):
+        if index + 1 < len(self.stages):
+            self.stages[index + 1].put(item)
+        else:
+            self.output.put(item)
+
+    def __worker(self, index):
+        stage = self.stages[index]
+        while True:
+            item = stage.queue.get()
+            if item is _DONE:
+                break
+
+            if 'skipped' not in item and 'error' not in item:
+                if self.stop_event.is_set() and not (stage.runs_on_stop and 'book' in item and
+                                                     'series_adam_id' in item['book']):
+                    item['skipped'] = 'interrupted'
+                else:
+                    item = self.__process(stage, item)
+
+            self.__next_put(index, item)
+
+        # Last worker out hands the end of input to the next stage
+        with stage.lock:
+            stage.live_workers -= 1
+            is_last = stage.live_workers == 0
+        if is_last:
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].workers):
+                    self.stages[index + 1].put(_DONE)
+            else:
+                self.output.put(_DONE)
+
+    def __process(self, stage, item):
+        """Run a stage on one item, timing it, the first error stops the pipeline"""
+        start = perf_counter_ns()
+        try:
+            item = stage.func(item)
+        except Exception as error:
+            print (sys.exc_info()[0])
+            item['error'] = error
+            if self.error is None:
+                self.error = error
+            self.stop_event.set()
+        elapsed = perf_counter_ns() - start
+        with stage.lock:
+            stage.items += 1
+            stage.busy_ns += elapsed
+        return item
+
+    def __feed(self, records):
+        first = self.stages[0]
+        for record in records:
+            if self.stop_event.is_set():
+                break
+            first.put({'record': record})
+        for _ in range(first.workers):
+            first.put(_DONE)
+
+    def stop(self):
+        """Stop feeding new books, books already written to the DB are still written to the plist"""
+        self.stop_event.set()
+
+    def run(self, records):
+        """Run the pipeline yielding each processed item on the calling thread
+
+        Items are dicts with the source 'record', the 'book' fields filled by the stages and a
+        'skipped' reason when a book was not synced. Re-raises the first stage error at the end."""
+        self.threads = [Thread(target=self.__feed, args=(records,), name='pipeline-feed')]
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                self.threads.append(Thread(target=self.__worker, args=(index,),
+                                           name='pipeline-' + stage.name + '-' + str(n)))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                # Within a cooperative task wait no longer than the time slice, then let the event loop run
+                try:
+                    item = self.output.get(timeout=time_left())
+                except Empty:
+                    cooperate()
+                    continue
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.stop_event.set()
+            # Keep draining so that no worker stays blocked on a full queue
+            while any(thread.is_alive() for thread in self.threads):
+                while not self.output.empty():
+                    self.output.get_nowait()
+                for thread in self.threads:
+                    thread.join(0.05)
+
+        if self.error is not None:
+            raise self.error
+
+    def run_inline(self, records):
+        """Run the stages one book at a time on the calling thread, yielding each processed item as run() does
+
+        For a cooperative task (ibooks_coop): the sessions and the catalog never leave the calling thread, and the
+        task can give the event loop a turn between two stages of a book."""
+        for record in records:
+            if self.stop_event.is_set():
+                break
+            item = {'record': record}
+            for stage in self.stages:
+                if 'skipped' in item or 'error' in item:
+                    break
+                item = self.__process(stage, item)
+                cooperate()
+            yield item
+
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """Per stage item count, busy time and queue depth"""
+        return [stage.stats() for stage in self.stages]
+
+    def slowest_stage(self):
+        """Name of the stage with the highest busy time per worker"""
+        return max(self.stages, key=lambda stage: stage.busy_ns / stage.workers).name
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+from os import path, stat
+
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sql import series_adam_id
+
+CALIBRE_COMMENT = 'Calibre #'
+
+# Plan actions, in execution order
+ACTIONS = ('delete', 'update', 'add', 'metadata', 'noop')
+
+
+def calibre_id(comment):
+    """Calibre book id stored on a ZCOMMENTS / plist comment, None if the book was not added by calibre"""
+    if comment is None or not comment.startswith(CALIBRE_COMMENT):
+        return None
+    try:
+        return int(comment[len(CALIBRE_COMMENT):])
+    except ValueError:
+        return None
+
+
+class SyncPlan:
+    """What a sync will do to each book: add, update (copy again), metadata (only), delete or noop"""
+
+    def __init__(self):
+        self.actions = dict((action, []) for action in ACTIONS)
+        self.bytes_to_copy = 0
+
+    def records(self, *actions):
+        """Calibre records of the given actions, in plan order"""
+        return [record for action in actions for record in self.actions[action]]
+
+    def report(self):
+        report = dict((action, len(self.actions[action])) for action in ACTIONS)
+        report['bytes_to_copy'] = self.bytes_to_copy
+        return report
+
+    def __str__(self):
+        report = self.report()
+        return ', '.join(str(report[action]) + ' ' + action for action in ACTIONS) + \
+            ', ' + '%.1f' % (self.bytes_to_copy / 1048576.0) + ' MB to copy'
+
+
+def plan_sync(records, library_rows, plist_books, known_ids=None):
+    """Compute the sync plan from keyed snapshots of the three stores
+
+    :param records: BookRecord list of the selected calibre books
+    :param library_rows: BkLibraryDb.snapshot_calibre_books() rows
+    :param plist_books: books.plist 'Books' entries
+    :param known_ids: all calibre book ids, iBooks books not among them are deleted (None to keep them)
+    """
+    plan = SyncPlan()
+
+    # Hash the iBooks side by calibre id, every lookup below is a dict probe
+    library = {}
+    for row in library_rows:
+        book_id = calibre_id(row.ZCOMMENTS)
+        if book_id is not None:
+            library[book_id] = row
+
+    plist = {}
+    for book in plist_books:
+        book_id = calibre_id(book.get('comment'))
+        if book_id is not None:
+            plist[book_id] = book
+
+    for record in records:
+        row = library.get(record.book_id)
+        book = plist.get(record.book_id)
+
+        if record.fmt is None or record.path is None:
+            if row is not None or book is not None:
+                plan.actions['delete'].append(record.book_id)
+            continue
+
+        if row is None and book is None:
+            action = 'add'
+        elif row is None or book is None or _needs_copy(record, book) or _series_changed(record, row, book):
+            action = 'update'
+        elif _metadata_changed(record, row, book):
+            action = 'metadata'
+        else:
+            action = 'noop'
+
+        plan.actions[action].append(record)
+        if action in ('add', 'update'):
+            try:
+                plan.bytes_to_copy += stat(record.path).st_size
+            except OSError:
+                pass
+
+    if known_ids is not None:
+        known_ids = set(known_ids)
+        selected_ids = set(record.book_id for record in records)
+        for book_id in set(library) | set(plist):
+            if book_id not in known_ids and book_id not in selected_ids:
+                plan.actions['delete'].append(book_id)
+
+    return plan
+
+
+def _needs_copy(record, book):
+    """True when the calibre file moved, changed after it was copied or the copy is gone"""
+    if book.get('sourcePath') != record.path or not path.exists(book.get('path', '')):
+        return True
+    try:
+        # BKInsertionDate has a one second resolution
+        return int(stat(record.path).st_mtime) > book.get('BKInsertionDate', 0)
+    except OSError:
+        return True
+
+
+def _series_changed(record, row, book):
+    """True when the book joined, left or moved between series, which takes more than a metadata update"""
+    if record.series is None:
+        return row.ZSERIESID is not None or 'seriesTitle' in book
+    return book.get('seriesTitle') != record.series or str(row.ZSERIESID) != str(series_adam_id(record.series))
+
+
+def _metadata_changed(record, row, book):
+    if record.title != row.ZTITLE or record.title != book.get('itemName'):
+        return True
+    if record.author != row.ZAUTHOR or record.author != book.get('artistName'):
+        return True
+    if record.series is None:
+        return False
+    try:
+        return float(row.ZSERIESSORTKEY) != float(record.series_index)
+    except (TypeError, ValueError):
+        return True
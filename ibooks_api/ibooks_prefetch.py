@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+from os import path
+from collections import namedtuple
+
+# Formats iBooks/Books can import, in order of preference
+SYNC_FORMATS = ('EPUB', 'PDF')
+
+# Compact per book record with only the fields used by the sync
+BookRecord = namedtuple('BookRecord', [
+    'book_id', 'title', 'author', 'series', 'series_index', 'fmt', 'path'
+])
+
+
+def _bulk_format_paths(db, book_ids, book_fmts):
+    """Format file paths of all books under one read lock, from private calibre internals
+
+    Written against calibre 7 (calibre/db/cache.py and calibre/db/fields.py): Cache.backend.library_path,
+    Cache.fields['formats'].format_fname() and Cache.safe_read_lock. Any of them missing or changed raises
+    here, and _format_paths() falls back to the public format_abspath for every book."""
+    paths = {}
+    library_path = db.backend.library_path
+    format_field = db.fields['formats']
+    book_dirs = db.all_field_for('path', book_ids)
+    with db.safe_read_lock:
+        for book_id in book_ids:
+            fmt = book_fmts.get(book_id)
+            if fmt is None or not book_dirs.get(book_id):
+                continue
+            fname = format_field.format_fname(book_id, fmt)
+            if fname:
+                paths[book_id] = path.join(library_path, book_dirs[book_id].replace('/', path.sep),
+                                           fname + '.' + fmt.lower())
+    return paths
+
+
+def _format_paths(db, book_ids, book_fmts):
+    """Resolve format file paths in bulk, falling back to format_abspath per book"""
+    try:
+        paths = _bulk_format_paths(db, book_ids, book_fmts)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        paths = {}
+
+    # The public API for any path the bulk lookup missed or got wrong (not an existing file)
+    for book_id in book_ids:
+        fmt = book_fmts.get(book_id)
+        if fmt is None:
+            continue
+        if book_id not in paths or not path.isfile(paths[book_id]):
+            paths[book_id] = db.format_abspath(book_id, fmt)
+    return paths
+
+
+def prefetch_books(db, book_ids):
+    """Fetch the sync fields of all selected books with a few bulk calls to calibre new_api.
+
+    Returns a list of BookRecord in selection order; books without an EPUB or PDF format
+    have fmt and path set to None."""
+    book_ids = list(book_ids)
+
+    titles = db.all_field_for('title', book_ids)
+    authors = db.all_field_for('authors', book_ids)
+    series = db.all_field_for('series', book_ids)
+    series_indexes = db.all_field_for('series_index', book_ids)
+    formats = db.all_field_for('formats', book_ids)
+
+    book_fmts = {}
+    for book_id in book_ids:
+        fmts = formats.get(book_id) or ()
+        book_fmts[book_id] = next((fmt for fmt in SYNC_FORMATS if fmt in fmts), None)
+
+    paths = _format_paths(db, book_ids, book_fmts)
+
+    return [
+        BookRecord(
+            book_id=book_id,
+            title=titles.get(book_id),
+            author=', '.join(map(str, authors.get(book_id) or ())),
+            series=series.get(book_id),
+            series_index=series_indexes.get(book_id),
+            fmt=book_fmts[book_id],
+            path=paths.get(book_id),
+        )
+        for book_id in book_ids
+    ]
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 # -*- coding=utf-8 -*-
-from os import path, remove
+from os import path, remove, stat
 from shutil import copy2
 
 import sys
@@ -8,6 +8,7 @@ import zlib
 import hashlib
 
 from datetime import datetime, timedelta
+from threading import Lock
 from uuid import uuid5, NAMESPACE_X500
 # import re
 from pprint import pprint
@@ -15,10 +16,13 @@ from pprint import pprint
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session
 from sqlalchemy import create_engine, MetaData, Table, Column, ForeignKey, types, \
-    event, TypeDecorator, Unicode, or_, text, func
+    event, TypeDecorator, Unicode, or_, text, func, select, delete, exists, table, column, insert, update, literal
 from sqlalchemy.inspection import inspect
+from sqlalchemy.sql import Select
 
 from calibre_plugins.apple_ibooks.config import prefs
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_sqlprofile import SqlProfiler
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_log import log
 
 class CoerceUTF8(TypeDecorator):
     """Safely coerce Python bytestrings to Unicode
@@ -64,39 +68,150 @@ def update_pks(session, base):
     try:
         session.flush()
         pks = session.query(base.classes.Z_PRIMARYKEY).all()
-        if prefs['debug']:
-            print (str(datetime.now()) + ": Update pks for " + str(len(pks)) + " tables")
+        log.debug("Update pks for %d tables", len(pks))
         for pk in pks:
             z_name = pk.Z_NAME
             class_name = "Z" + str(z_name).upper()
             max_pk = session.query(func.max(base.classes[class_name].Z_PK)).limit(1).all()[0][0]
             pk.Z_MAX = max_pk if max_pk is not None else 0
-            if prefs['debug']:
-                print ("\tPk for " + z_name + " is " + str(max_pk))
+            log.debug("\tPk for %s is %s", z_name, max_pk)
             session.add(pk)
         session.flush()
 
     except Exception:
+        # The session may be shared by both databases (see AttachedDb), the caller decides what to roll back
         print (sys.exc_info()[0])
-        session.rollback()
+        raise
+
+
+# Automapped bases of the sqlite files, {(file, schema): ((inode, mtime, size), schema_version, base)}
+_schemas = {}
+_schemas_lock = Lock()
+
+# Schema name of BKSeries when attached to the BKLibrary connection
+SERIES_SCHEMA = 'series'
+
+
+def automap_schema(engine, file_path, schema=None):
+    """Automapped base of a sqlite file, reflected again only when its schema changes
+
+    An unchanged stat returns the cached base at once; a moved mtime (any commit) only costs a
+    PRAGMA schema_version. Mapped classes are shared by every session on the file. With schema, the
+    file is the database attached under that name on the engine connections, and its tables are mapped
+    qualified by it."""
+    with _schemas_lock:
+        file_stat = stat(file_path)
+        stamp = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+        cached = _schemas.get((file_path, schema))
+        if cached is not None and cached[0] == stamp:
+            return cached[2]
+
+        with engine.connect() as connection:
+            schema_version = connection.exec_driver_sql(
+                "PRAGMA " + (schema + "." if schema is not None else "") + "schema_version").scalar()
+        if cached is not None and cached[0][0] == stamp[0] and cached[1] == schema_version:
+            _schemas[(file_path, schema)] = (stamp, schema_version, cached[2])
+            return cached[2]
+
+        log.debug("Reflecting %s%s", file_path, ' as ' + schema if schema is not None else '')
+        metadata = MetaData(schema=schema)
+        metadata.reflect(engine)
+        base = automap_base(metadata=metadata)
+        base.prepare()
+        _schemas[(file_path, schema)] = (stamp, schema_version, base)
+        return base
+
+
+def create_attached_engine(library_file, series_file):
+    """Engine on BKLibrary whose connections have BKSeries attached as SERIES_SCHEMA"""
+    engine = create_engine("sqlite:///" + library_file)
+
+    @event.listens_for(engine, "connect")
+    def attach_series(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS " + SERIES_SCHEMA, (series_file,))
+
+    return engine
+
+
+def journal_mode(file_path):
+    """Journal mode of a sqlite file ('delete', 'wal'...), WAL is kept in the file once Core Data switched to it"""
+    engine = create_engine("sqlite:///" + file_path)
+    try:
+        with engine.connect() as connection:
+            return str(connection.exec_driver_sql("PRAGMA journal_mode").scalar()).lower()
+    finally:
+        engine.dispose()
+
+
+def can_attach(library_file, series_file):
+    """Whether both files commit in one transaction when BKSeries is attached to BKLibrary
+
+    SQLite only commits attached databases atomically together when none of them is in WAL mode, with WAL
+    each file still commits on its own and attaching them buys nothing."""
+    modes = [journal_mode(file_path) for file_path in (library_file, series_file)]
+    if 'wal' in modes:
+        log.warning("Journal mode of BKLibrary %s, of BKSeries %s: not attaching BKSeries, committing them separately",
+                    *modes)
+        return False
+    return True
+
+
+def series_adam_id(series_name):
+    """Series id used on both databases and books.plist for a calibre series"""
+    adam_id = zlib.crc32(series_name.encode('utf-8'))
+    return adam_id % (1 << 32) if adam_id < 0 else adam_id
+
+
+def stage_keys(session, name, keys):
+    """Load keys (a list or a select) into a TEMP table, returning a select of them for IN (subquery) clauses"""
+    session.execute(text("CREATE TEMP TABLE IF NOT EXISTS " + name + " (id PRIMARY KEY)"))
+    session.execute(text("DELETE FROM temp." + name))
+    staged = table(name, column('id'), schema='temp')
+    if isinstance(keys, Select):
+        session.execute(staged.insert().prefix_with('OR IGNORE').from_select(['id'], keys))
+    elif len(keys):
+        session.execute(staged.insert().prefix_with('OR IGNORE'), [{'id': key} for key in keys])
+    return select(staged.c.id)
+
+
+def stage_rows(session, name, columns, rows):
+    """Bulk load rows (dicts of columns, keyed by the first one) into a TEMP table, returning it for set based
+    statements. A later row replaces an earlier one with the same key."""
+    session.execute(text("CREATE TEMP TABLE IF NOT EXISTS " + name + " (" + columns[0] + " PRIMARY KEY, " +
+                         ", ".join(columns[1:]) + ")"))
+    session.execute(text("DELETE FROM temp." + name))
+    staged = table(name, *[column(column_name) for column_name in columns], schema='temp')
+    if len(rows):
+        session.execute(staged.insert().prefix_with('OR REPLACE'), rows)
+    return staged
+
+
+# Columns of the books staged by BkLibraryDb.stage_book()
+STAGED_BOOK_COLUMNS = ('asset_id', 'comments', 'title', 'author', 'series_id', 'series_number', 'sort_key', 'size',
+                       'path', 'genre', 'creation_date', 'collection_name', 'series_name', 'default_collection_id')
+
+DATA_SOURCE_IDENTIFIER = 'com.apple.ibooks.plugin.Bookshelf.platformDataSource.BookKit'
 
 
 class BkLibraryDb:
     """Create class to access BKLibrary DB"""
 
-    def __init__(self):
+    def __init__(self, session=None, deferred_commit=False):
         try:
             """ Todo: Create autodetection of BKLibrary sqlite file """
             #IBOOKS_BKLIBRARY_CATALOG = "BKLibrary/BKLibrary-1-091020131601.sqlite"
             #IBOOKS_BKLIBRARY_CATALOG_FILE = path.join(IBOOKS_BKLIBRARY_PATH, IBOOKS_BKLIBRARY_CATALOG)
             IBOOKS_BKLIBRARY_CATALOG_FILE = prefs['dbbookcatalog']
 
-            self.__engine = create_engine("sqlite:///" + IBOOKS_BKLIBRARY_CATALOG_FILE) #, echo='debug')
-            metadata = MetaData()
-            metadata.reflect(self.__engine)
-
-            self.__base = automap_base(metadata=metadata)
-            self.__base.prepare()
+            if session is None:
+                self.__engine = create_engine("sqlite:///" + IBOOKS_BKLIBRARY_CATALOG_FILE) #, echo='debug')
+            else:
+                # Sync side of an AsyncSession (see ibooks_asyncsql), used from its run_sync() calls
+                self.__engine = session.get_bind()
+            self.profiler = SqlProfiler('library')
+            if SqlProfiler.enabled():
+                self.profiler.attach(self.__engine)
+            self.__base = automap_schema(self.__engine, IBOOKS_BKLIBRARY_CATALOG_FILE)
 
             # """ Auto detect relationships """
             # fkeys = {}
@@ -117,7 +232,16 @@ class BkLibraryDb:
             #     relations = inspect(mapped_class).relationships.items()
             #     print (relations)
 
-            self.__session = Session(self.__engine)
+            # Streaming mode: objects are dropped from the session after each commit and existing assets and
+            # collection memberships are looked up in compact key tuples instead of the identity map
+            self.streaming = prefs['streaming_sync']
+            self.__session = Session(self.__engine, expire_on_commit=not self.streaming) if session is None else session
+            self.__asset_keys = {}
+            self.__member_keys = set()
+            # Books waiting for merge_staged(), {asset id: staged row}
+            self.__staged_books = {}
+            # Session shared with BkSeriesDb on one connection (see AttachedDb): commit() leaves the transaction open
+            self.deferred_commit = deferred_commit
             self.has_changed = 0
             self.has_backup = False
         except Exception:
@@ -134,18 +258,24 @@ class BkLibraryDb:
     def rollback(self):
         try:
             self.__session.rollback()
-            update_pks(self.__session, self.__base)
+            self.__staged_books.clear()
+            self.forget_keys()
+            try:
+                update_pks(self.__session, self.__base)
+            except Exception:
+                # Still restore the backup below
+                self.__session.rollback()
             self.has_changed = 0
             if prefs['backup'] and self.has_backup:
-                for file in ['dbbookcatalog']:
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": Rolling back " + filename)
-                    copy2(prefs[file] + ".bkp", prefs[file])
-                    remove(prefs[file] + ".bkp")
+                for filename in ['dbbookcatalog']:
+                    log.debug("Rolling back %s", filename)
+                    copy2(prefs[filename] + ".bkp", prefs[filename])
+                    remove(prefs[filename] + ".bkp")
                 self.has_backup = False
         except Exception:
             print (sys.exc_info()[0])
             self.__session.rollback()
+            self.forget_keys()
             self.has_changed = 0
 
     def commit(self):
@@ -153,19 +283,46 @@ class BkLibraryDb:
             if self.has_changed:
                 if prefs['backup'] and not self.has_backup:
                     for filename in ['dbbookcatalog']:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Backing up " + filename)
+                        log.debug("Backing up %s", filename)
                         copy2(prefs[filename], prefs[filename] + ".bkp")
                     self.has_backup = True
+                self.merge_staged()
                 update_pks(self.__session, self.__base)
                 self.__session.flush()
-                self.__session.commit()
+                if not self.deferred_commit:
+                    self.__session.commit()
+                    if self.streaming:
+                        self.__session.expunge_all()
+                        self.forget_keys()
                 self.has_changed = 0
 
         except Exception:
+            # The batch is only written by merge_staged(), the caller must not go on as if it was
             print (sys.exc_info()[0])
             self.__session.rollback()
+            self.forget_keys()
+            self.__staged_books.clear()
             self.has_changed=0
+            raise
+
+    def __keys(self, asset_id):
+        """Asset id -> Z_PK (None when absent) and (asset id, collection Z_PK) memberships, each asset is looked up
+        once per batch so the keys never hold more than the books of one batch"""
+        if asset_id not in self.__asset_keys:
+            asset = self.__base.classes.ZBKLIBRARYASSET
+            member = self.__base.classes.ZBKCOLLECTIONMEMBER
+            self.__asset_keys[asset_id] = self.__session.execute(
+                select(asset.Z_PK).where(asset.ZASSETID == asset_id).limit(1)
+            ).scalar()
+            self.__member_keys.update((asset_id, collection) for collection in self.__session.execute(
+                select(member.ZCOLLECTION).where(member.ZASSETID == asset_id)
+            ).scalars())
+        return self.__asset_keys, self.__member_keys
+
+    def forget_keys(self):
+        """Drop the streaming mode keys, after each commit and on rollback"""
+        self.__asset_keys = {}
+        self.__member_keys = set()
 
     def list_books(self):
         """List all books in iBooks"""
@@ -176,6 +333,18 @@ class BkLibraryDb:
             raise
 
 
+    def snapshot_calibre_books(self):
+        """Compact (asset id, comments, title, author, series id, series sort key, path) rows of calibre books"""
+        try:
+            asset = self.__base.classes.ZBKLIBRARYASSET
+            return self.__session.execute(
+                select(asset.ZASSETID, asset.ZCOMMENTS, asset.ZTITLE, asset.ZAUTHOR, asset.ZSERIESID,
+                       asset.ZSERIESSORTKEY, asset.ZPATH).where(asset.ZCOMMENTS.like("Calibre #%"))
+            ).all()
+        except Exception:
+            print (sys.exc_info()[0])
+            raise
+
     def add_book(self, book_id=None, title=None, filepath=None, author=None, collection_name=None,
                  asset_id=None, size=None, series_name=None, series_id=None, series_number=None, genre=None):
         """Add or update a book to the asset list in iBooks"""
@@ -224,15 +393,23 @@ class BkLibraryDb:
             )
 
             # Check if file already on catalog, if so check if it is on the same collection
-            result = self.__session.query(self.__base.classes.ZBKLIBRARYASSET).filter_by(
-                ZASSETID=asset_id
-            ).all()
+            if self.streaming:
+                asset_keys, member_keys = self.__keys(asset_id)
+                asset_pk = asset_keys.get(asset_id)
+                result = [] if asset_pk is None else \
+                    [self.__session.get(self.__base.classes.ZBKLIBRARYASSET, asset_pk)]
+            else:
+                result = self.__session.query(self.__base.classes.ZBKLIBRARYASSET).filter_by(
+                    ZASSETID=asset_id
+                ).all()
 
             if len(result):
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Book already exists, updating database")
+                log.debug("Book already exists, updating database")
                 new_book = result[0]
+                new_book.ZTITLE = title
+                new_book.ZSORTTITLE = title
                 new_book.ZAUTHOR = author
+                new_book.ZSORTAUTHOR = author
                 new_book.ZSERIESID = series_id
                 new_book.ZCOMMENTS = 'Calibre #' + str(book_id)
                 new_book.ZSERIESSORTKEY = series_number
@@ -241,8 +418,7 @@ class BkLibraryDb:
                 self.__session.flush()
 
             else:
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Book is new, adding to database")
+                log.debug("Book is new, adding to database")
                 new_book = self.__base.classes.ZBKLIBRARYASSET(
                     Z_OPT=1,
                     Z_ENT=5,
@@ -276,7 +452,7 @@ class BkLibraryDb:
                     ZASSETID=asset_id if asset_id is not None else 
                         uuid5(NAMESPACE_X500, (title + author)),
                     ZGENRE=genre,
-                    ZDATASOURCEIDENTIFIER='com.apple.ibooks.plugin.Bookshelf.platformDataSource.BookKit',
+                    ZDATASOURCEIDENTIFIER=DATA_SOURCE_IDENTIFIER,
                     ZAUTHOR=author,
                     ZSORTAUTHOR=author,
                     ZPATH=filepath,
@@ -302,19 +478,23 @@ class BkLibraryDb:
                 self.__session.add(new_book)
                 self.__session.flush()
                 self.has_changed=1
+                if self.streaming:
+                    asset_keys[new_book.ZASSETID] = new_book.Z_PK
 
                 # pk_bklibraryasset.Z_MAX = new_book.Z_PK
                 # self.__session.add(pk_bklibraryasset)
                 # self.__session.flush()
 
             for collection in collections:
-                if prefs['debug']:
-                    print (str(datetime.now()) + ": Adding book to collection: " + collection.ZTITLE)
-                collection_membership = self.__session.query(self.__base.classes.ZBKCOLLECTIONMEMBER).filter_by(
-                    ZASSETID=asset_id,
-                    ZCOLLECTION=collection.Z_PK
-                ).all()
-                if not len(collection_membership):
+                log.debug("Adding book to collection: %s", collection.ZTITLE)
+                if self.streaming:
+                    is_member = (asset_id, collection.Z_PK) in member_keys
+                else:
+                    is_member = len(self.__session.query(self.__base.classes.ZBKCOLLECTIONMEMBER).filter_by(
+                        ZASSETID=asset_id,
+                        ZCOLLECTION=collection.Z_PK
+                    ).all())
+                if not is_member:
                     new_collection_member = self.__base.classes.ZBKCOLLECTIONMEMBER(
                         Z_OPT=1,
                         Z_ENT=3,
@@ -328,6 +508,8 @@ class BkLibraryDb:
                     self.__session.add(new_collection_member)
                     self.__session.flush()
                     self.has_changed=1
+                    if self.streaming:
+                        member_keys.add((asset_id, collection.Z_PK))
                     #
                     # pk_bkcollectionmember.Z_MAX = new_collection_member.Z_PK
                     # self.__session.add(pk_bkcollectionmember)
@@ -337,82 +519,239 @@ class BkLibraryDb:
             return new_book
         except Exception:
             self.__session.rollback()
+            self.forget_keys()
             print (sys.exc_info()[0])
             raise
 
-    def del_all_books_from_calibre(self):
+    def stage_book(self, book_id=None, title=None, filepath=None, author=None, collection_name=None,
+                   asset_id=None, size=None, series_name=None, series_id=None, series_number=None, genre=None):
+        """Queue a book for merge_staged(), the set based add_book run by the next commit"""
+        if asset_id is None:
+            asset_id = str(uuid5(NAMESPACE_X500, (title + author)))
+        self.__staged_books[asset_id] = {
+            'asset_id': asset_id,
+            'comments': 'Calibre #' + str(book_id),
+            'title': title,
+            'author': author,
+            'series_id': series_id,
+            'series_number': series_number,
+            'sort_key': int(10000 + (0 if series_number is None else series_number)),
+            'size': size,
+            'path': filepath,
+            'genre': genre,
+            'creation_date': (datetime.fromtimestamp(path.getmtime(filepath)) - MyEpochType.epoch).total_seconds(),
+            'collection_name': collection_name,
+            'series_name': series_name,
+            'default_collection_id': u'Pdfs_Collection_ID' if ".pdf" in filepath.lower() else u'Books_Collection_ID',
+        }
+        self.has_changed = 1
+
+    def merge_staged(self):
+        """Add or update the staged books as add_book does, with a few set based statements
+
+        The books and their collections are bulk loaded into TEMP tables, then the collections, assets and
+        collection memberships are reconciled by INSERT ... SELECT and UPDATE statements (correlated subqueries,
+        UPDATE ... FROM needs SQLite 3.33). A book staged twice is merged with its last values."""
+        if not self.__staged_books:
+            return 0
         try:
-            books = self.__session.query(self.__base.classes.ZBKLIBRARYASSET).filter(
-                self.__base.classes.ZBKLIBRARYASSET.ZCOMMENTS.like("Calibre #%")
-            )
-
-            asset_ids = [book.ZASSETID for book in books]
-            series_ids = [book.ZSERIESID for book in books] if\
-                hasattr(self.__base.classes.ZBKLIBRARYASSET,'ZSERIESID') else []
-            collection_ids = [book.ZCOLLECTIONID for book in books] if\
-                hasattr(self.__base.classes.ZBKLIBRARYASSET, 'ZCOLLECTIONID') else []
-
-            count=0
-            for book in books:
-                self.__session.delete(book)
-                count+=1
-
-            for asset_id in asset_ids:
-                books = self.__session.query(self.__base.classes.ZBKCOLLECTIONMEMBER).filter_by(
-                    ZASSETID=asset_id
+            assets = self.__base.classes.ZBKLIBRARYASSET.__table__
+            members = self.__base.classes.ZBKCOLLECTIONMEMBER.__table__
+            collections = self.__base.classes.ZBKCOLLECTION.__table__
+            now = (datetime.now() - MyEpochType.epoch).total_seconds()
+
+            staged_collections = {u"Calibre": u'All_Calibre_ID'}
+            for book in self.__staged_books.values():
+                for name in (book['series_name'], book['collection_name']):
+                    if name is not None and name not in staged_collections:
+                        staged_collections[name] = str(uuid5(NAMESPACE_X500, name)).upper()
+            books = stage_rows(self.__session, 'calibre_staged_books', STAGED_BOOK_COLUMNS,
+                               list(self.__staged_books.values()))
+            titles = stage_rows(self.__session, 'calibre_staged_collections', ('title', 'collection_id'),
+                                [{'title': title, 'collection_id': collection_id}
+                                 for title, collection_id in staged_collections.items()])
+
+            # Collections: restore the logically deleted ones, create the missing ones
+            collections_count = self.__session.execute(
+                update(collections).where(collections.c.ZTITLE.in_(select(titles.c.title)),
+                                          collections.c.ZDELETEDFLAG == 1).values(ZDELETEDFLAG=0)
+            ).rowcount
+            collections_count += self.__session.execute(
+                insert(collections).from_select(
+                    ['Z_OPT', 'Z_ENT', 'ZTITLE', 'ZCOLLECTIONID', 'ZLASTMODIFICATION', 'ZDELETEDFLAG', 'ZSORTKEY'],
+                    select(literal(1), literal(1), titles.c.title, titles.c.collection_id, literal(now), literal(0),
+                           literal(10000)).where(~exists().where(collections.c.ZTITLE == titles.c.title))
                 )
-                for book in books:
-                    collections = self.__session.query(self.__base.classes.ZBKCOLLECTION).filter_by(
-                        Z_PK=book.ZCOLLECTION,
-                        Z_ENT=1
-                    )
+            ).rowcount
+
+            # Books already in the library: metadata only
+            def staged(staged_column):
+                return select(staged_column).where(books.c.asset_id == assets.c.ZASSETID).scalar_subquery()
+
+            updated = self.__session.execute(
+                update(assets).where(assets.c.ZASSETID.in_(select(books.c.asset_id))).values(
+                    ZTITLE=staged(books.c.title),
+                    ZSORTTITLE=staged(books.c.title),
+                    ZAUTHOR=staged(books.c.author),
+                    ZSORTAUTHOR=staged(books.c.author),
+                    ZSERIESID=staged(books.c.series_id),
+                    ZCOMMENTS=staged(books.c.comments),
+                    ZSERIESSORTKEY=staged(books.c.series_number),
+                )
+            ).rowcount
+
+            # New books
+            new_book = {
+                'Z_OPT': literal(1),
+                'Z_ENT': literal(5),
+                'ZCONTENTTYPE': literal(1),
+                'ZCOMMENTS': books.c.comments,
+                'ZTITLE': books.c.title,
+                'ZSORTTITLE': books.c.title,
+                'ZFILESIZE': books.c.size,
+                'ZGENERATION': literal(1),
+                'ZISNEW': literal(1),
+                'ZSERIESID': books.c.series_id,
+                'ZSERIESSORTKEY': books.c.series_number,
+                'ZSORTKEY': books.c.sort_key,
+                'ZSTATE': literal(1),
+                'ZBOOKHIGHWATERMARKPROGRESS': literal('0.0'),
+                'ZCREATIONDATE': books.c.creation_date,
+                'ZMODIFICATIONDATE': literal(now),
+                'ZLASTOPENDATE': literal(-63114076800),
+                'ZVERSIONNUMBER': literal('0.0'),
+                'ZASSETID': books.c.asset_id,
+                'ZGENRE': books.c.genre,
+                'ZDATASOURCEIDENTIFIER': literal(DATA_SOURCE_IDENTIFIER),
+                'ZAUTHOR': books.c.author,
+                'ZSORTAUTHOR': books.c.author,
+                'ZPATH': books.c.path,
+            }
+            if 'ZBOOKTYPE' in assets.c:
+                new_book['ZBOOKTYPE'] = literal(1)
+            if 'ZSERIESCONTAINER' in assets.c:
+                new_book['ZSERIESCONTAINER'] = books.c.series_id
+            if 'ZSTOREID' in assets.c:
+                new_book['ZSTOREID'] = literal(0)
+            if 'ZCOLLECTIONID' in assets.c:
+                new_book['ZCOLLECTIONID'] = select(collections.c.ZCOLLECTIONID).where(
+                    collections.c.ZTITLE == books.c.collection_name
+                ).order_by(collections.c.Z_PK).limit(1).scalar_subquery()
+            count = self.__session.execute(
+                insert(assets).from_select(list(new_book), select(*new_book.values()).where(
+                    ~exists().where(assets.c.ZASSETID == books.c.asset_id)
+                ))
+            ).rowcount
+
+            # Memberships of the library, default, calibre, collection and series collections
+            new_member = {
+                'Z_OPT': literal(1),
+                'Z_ENT': literal(3),
+                'ZSORTKEY': books.c.sort_key,
+                'ZCOLLECTION': collections.c.Z_PK,
+                'ZASSETID': books.c.asset_id,
+            }
+            if 'ZASSET' in members.c:
+                new_member['ZASSET'] = assets.c.Z_PK
+            members_count = self.__session.execute(
+                insert(members).from_select(list(new_member), select(*new_member.values()).distinct().select_from(
+                    books.join(assets, assets.c.ZASSETID == books.c.asset_id).join(collections, or_(
+                        collections.c.ZCOLLECTIONID.in_([u'All_Collection_ID', u'All_Calibre_ID']),
+                        collections.c.ZCOLLECTIONID == books.c.default_collection_id,
+                        collections.c.ZTITLE == books.c.collection_name,
+                        collections.c.ZTITLE == books.c.series_name,
+                    ))
+                ).where(
+                    ~exists().where(members.c.ZASSETID == books.c.asset_id, members.c.ZCOLLECTION == collections.c.Z_PK)
+                ))
+            ).rowcount
+
+            staged_count = len(self.__staged_books)
+            self.__staged_books.clear()
+            self.forget_keys()
+            if count or updated or members_count or collections_count:
+                self.has_changed = 1
 
-                    self.__session.delete(book)
-                    self.has_changed = 1
+            log.debug("Merged %s staged books: %s added, %s updated, %s collection members, %s collections",
+                      staged_count, count, updated, members_count, collections_count)
+            return count
 
-                    # Delete empty collections
-                    for collection in collections:
-                        book_count = self.__session.query(self.__base.classes.ZBKCOLLECTIONMEMBER).filter_by(
-                            ZCOLLECTION=collection.Z_PK
-                        ).count()
+        except Exception:
+            self.__session.rollback()
+            self.forget_keys()
+            print (sys.exc_info()[0])
+            raise
 
-                        if book_count == 0:
-                            if prefs['debug']:
-                                print (str(datetime.now()) + ": Delete Empty collection " + collection.ZTITLE)
-                            self.__session.delete(collection)
+    def del_all_books_from_calibre(self):
+        """Delete all books added by calibre with a few set based statements"""
+        return self.__delete_assets(self.__base.classes.ZBKLIBRARYASSET.ZCOMMENTS.like("Calibre #%"))
+
+    def del_books(self, asset_ids=None, calibre_ids=None):
+        """Delete the given books, looked up by asset id and by the calibre id stored on the comments"""
+        asset = self.__base.classes.ZBKLIBRARYASSET
+        asset_filter = asset.ZASSETID.in_(stage_keys(self.__session, 'calibre_doomed_assets', asset_ids or []))
+        if calibre_ids:
+            asset_filter = or_(asset_filter, asset.ZCOMMENTS.in_(
+                stage_keys(self.__session, 'calibre_doomed_comments',
+                           ['Calibre #' + str(calibre_id) for calibre_id in calibre_ids])
+            ))
+        return self.__delete_assets(asset_filter)
+
+    def __delete_assets(self, asset_filter):
+        """Delete the assets matching asset_filter, their collection memberships and the collections left empty"""
+        try:
+            asset = self.__base.classes.ZBKLIBRARYASSET
+            member = self.__base.classes.ZBKCOLLECTIONMEMBER
+            collection = self.__base.classes.ZBKCOLLECTION
 
-            # Delete empty collections
-            for collection_id in collection_ids:
-                collections = self.__session.query(self.__base.classes.ZBKCOLLECTION).filter_by(
-                    ZCOLLECTIONID=collection_id,
-                    Z_ENT=1
-                )
+            doomed_asset_ids = select(asset.ZASSETID).where(asset_filter)
 
-                for collection in collections:
-                    book_count = self.__session.query(self.__base.classes.ZBKCOLLECTIONMEMBER).filter_by(
-                        ZCOLLECTION=collection.Z_PK,
-                    ).count()
+            # Collections the books belong to, candidates to be removed once empty
+            touched = collection.Z_PK.in_(
+                select(member.ZCOLLECTION).where(member.ZASSETID.in_(doomed_asset_ids))
+            )
+            if hasattr(asset, 'ZCOLLECTIONID'):
+                touched = or_(touched, collection.ZCOLLECTIONID.in_(
+                    select(asset.ZCOLLECTIONID).where(asset_filter)
+                ))
+            touched_collections = stage_keys(self.__session, 'calibre_doomed_collections',
+                                             select(collection.Z_PK).where(collection.Z_ENT == 1, touched))
+
+            members_count = self.__session.execute(
+                delete(member).where(member.ZASSETID.in_(doomed_asset_ids)).
+                execution_options(synchronize_session=False)
+            ).rowcount
+
+            count = self.__session.execute(
+                delete(asset).where(asset_filter).execution_options(synchronize_session=False)
+            ).rowcount
 
-                    if book_count==0:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Delete Empty collection " + collection.ZTITLE)
-                        self.__session.delete(collection)
-                        self.has_changed = 1
+            # Delete empty collections
+            collections_count = self.__session.execute(
+                delete(collection).where(
+                    collection.Z_PK.in_(touched_collections),
+                    ~exists().where(member.ZCOLLECTION == collection.Z_PK)
+                ).execution_options(synchronize_session=False)
+            ).rowcount
+
+            if count or members_count or collections_count:
+                self.has_changed = 1
+                self.forget_keys()
 
             # Todo: reset primary keys to max of remaining itens
 
             self.__session.flush()
-            if prefs['debug']:
-                print (str(datetime.now()) + ": Books in library assets table: " + str(count))
-                print (str(datetime.now()) + ": Books in collection member table: " + str(len(asset_ids)))
-            return len(asset_ids)
+            log.debug("Books in library assets table: %s", count)
+            log.debug("Books in collection member table: %s", members_count)
+            log.debug("Empty collections deleted: %s", collections_count)
+            return count
 
         except Exception:
             self.__session.rollback()
+            self.forget_keys()
             print (sys.exc_info()[0])
             raise
 
-
     def list_colections(self):
         """List all collections in iBooks"""
         try:
@@ -436,7 +775,7 @@ class BkLibraryDb:
                     self.__session.commit()
                 return result[0]
             else:
-                print (collection_name, type(collection_name))
+                log.debug("Creating collection %s", collection_name)
                 new = self.__base.classes.ZBKCOLLECTION(
                     Z_OPT=1,
                     Z_ENT=1,
@@ -463,6 +802,7 @@ class BkLibraryDb:
 
         except Exception:
             self.__session.rollback()
+            self.forget_keys()
             print (sys.exc_info()[0])
             raise
 
@@ -494,6 +834,7 @@ class BkLibraryDb:
 
         except Exception:
             self.__session.rollback()
+            self.forget_keys()
             print (sys.exc_info()[0])
             raise
 
@@ -501,19 +842,23 @@ class BkLibraryDb:
 class BkSeriesDb:
     """Create class to access BKSeries DB"""
 
-    def __init__(self):
+    def __init__(self, session=None, schema=None, deferred_commit=False):
         try:
             """ Todo: Create autodetection of BKSeries sqlite file """
             #IBOOKS_BKSERIES_CATALOG = "BKSeriesDatabase/BKSeries-1-012820141020.sqlite"
             #IBOOKS_BKSERIES_CATALOG_FILE = path.join(IBOOKS_BKLIBRARY_PATH, IBOOKS_BKSERIES_CATALOG)
             IBOOKS_BKSERIES_CATALOG_FILE = prefs['dbseriescatalog']
 
-            self.__engine = create_engine("sqlite:///" + IBOOKS_BKSERIES_CATALOG_FILE) #, echo='debug')
-            metadata = MetaData()
-            metadata.reflect(self.__engine)
-
-            self.__base = automap_base(metadata=metadata)
-            self.__base.prepare()
+            if session is None:
+                self.__engine = create_engine("sqlite:///" + IBOOKS_BKSERIES_CATALOG_FILE) #, echo='debug')
+            else:
+                # Sync side of an AsyncSession (see ibooks_asyncsql), used from its run_sync() calls
+                self.__engine = session.get_bind()
+            self.profiler = SqlProfiler('series')
+            # Attached to the BKLibrary connection its statements are profiled with the library ones
+            if SqlProfiler.enabled() and schema is None:
+                self.profiler.attach(self.__engine)
+            self.__base = automap_schema(self.__engine, IBOOKS_BKSERIES_CATALOG_FILE, schema)
 
             # """ Auto detect relationships """
             # fkeys = {}
@@ -534,7 +879,13 @@ class BkSeriesDb:
             #     relations = inspect(mapped_class).relationships.items()
             #     print (relations)
 
-            self.__session = Session(self.__engine)
+            # Streaming mode, see BkLibraryDb
+            self.streaming = prefs['streaming_sync']
+            self.__session = Session(self.__engine, expire_on_commit=not self.streaming) if session is None else session
+            self.__check_keys = {}
+            self.__item_keys = {}
+            # See BkLibraryDb
+            self.deferred_commit = deferred_commit
             self.has_changed = 0
             self.has_backup = False
         except Exception:
@@ -550,18 +901,23 @@ class BkSeriesDb:
     def rollback(self):
         try:
             self.__session.rollback()
-            update_pks(self.__session, self.__base)
+            self.forget_keys()
+            try:
+                update_pks(self.__session, self.__base)
+            except Exception:
+                # Still restore the backup below
+                self.__session.rollback()
             self.has_changed = 0
             if prefs['backup'] and self.has_backup:
-                for filename in ['dbbookcatalog']:
-                    if prefs['debug']:
-                        print (str(datetime.now()) + ": Rolling back " + filename)
+                for filename in ['dbseriescatalog']:
+                    log.debug("Rolling back %s", filename)
                     copy2(prefs[filename] + ".bkp", prefs[filename])
                     remove(prefs[filename] + ".bkp")
                 self.has_backup = False
         except Exception:
             print (sys.exc_info()[0])
             self.__session.rollback()
+            self.forget_keys()
             self.has_changed = 0
 
     def commit(self):
@@ -569,19 +925,46 @@ class BkSeriesDb:
             if self.has_changed:
                 if prefs['backup'] and not self.has_backup:
                     for filename in ['dbseriescatalog']:
-                        if prefs['debug']:
-                            print (str(datetime.now()) + ": Backing up " + filename)
+                        log.debug("Backing up %s", filename)
                         copy2(prefs[filename], prefs[filename] + ".bkp")
                     self.has_backup = True
                 update_pks(self.__session, self.__base)
                 self.__session.flush()
-                self.__session.commit()
+                if not self.deferred_commit:
+                    self.__session.commit()
+                    if self.streaming:
+                        self.__session.expunge_all()
+                        self.forget_keys()
                 self.has_changed=0
 
         except Exception:
+            # Attached, the session also holds the library writes: the caller must not go on as if they were kept
             print (sys.exc_info()[0])
-            self.has_changed=0
             self.__session.rollback()
+            self.forget_keys()
+            self.has_changed=0
+            raise
+
+    def __keys(self, adam_id):
+        """Adam id -> Z_PK of the series check (None when absent) and (adam id, is container, series adam id) ->
+        Z_PK of the series items, each adam id is looked up once per batch"""
+        key = str(adam_id)
+        if key not in self.__check_keys:
+            check = self.__base.classes.ZBKSERIESCHECK
+            item = self.__base.classes.ZBKSERIESITEM
+            self.__check_keys[key] = self.__session.execute(
+                select(check.Z_PK).where(check.ZADAMID == adam_id).limit(1)
+            ).scalar()
+            for is_container, series_adam_id, pk in self.__session.execute(
+                    select(item.ZISCONTAINER, item.ZSERIESADAMID, item.Z_PK).where(item.ZADAMID == adam_id)
+            ):
+                self.__item_keys.setdefault((key, is_container, str(series_adam_id)), pk)
+        return self.__check_keys, self.__item_keys
+
+    def forget_keys(self):
+        """Drop the streaming mode keys, after each commit and on rollback"""
+        self.__check_keys = {}
+        self.__item_keys = {}
 
     def list_series_items(self):
         """List all series in iBooks"""
@@ -602,9 +985,15 @@ class BkSeriesDb:
 
             for name in [series_name, series_name + str(series_number)]:
                 # Add or update series metadata
-                result = self.__session.query(self.__base.classes.ZBKSERIESCHECK).filter_by(
-                    ZADAMID=series_id
-                ).all()
+                if self.streaming:
+                    check_keys, item_keys = self.__keys(series_id)
+                    check_pk = check_keys.get(str(series_id))
+                    result = [] if check_pk is None else \
+                        [self.__session.get(self.__base.classes.ZBKSERIESCHECK, check_pk)]
+                else:
+                    result = self.__session.query(self.__base.classes.ZBKSERIESCHECK).filter_by(
+                        ZADAMID=series_id
+                    ).all()
                 if len(result):
                     new_series_checked = result[0]
                     new_series_checked.ZDATECHECKED = datetime.now()
@@ -616,11 +1005,16 @@ class BkSeriesDb:
                         ZADAMID=series_id,
                     )
 
-                result = self.__session.query(self.__base.classes.ZBKSERIESITEM).filter_by(
-                    ZADAMID=series_id,
-                    ZISCONTAINER=is_container,
-                    ZSERIESADAMID=parent_id
-                ).all()
+                if self.streaming:
+                    item_pk = item_keys.get((str(series_id), is_container, str(parent_id)))
+                    result = [] if item_pk is None else \
+                        [self.__session.get(self.__base.classes.ZBKSERIESITEM, item_pk)]
+                else:
+                    result = self.__session.query(self.__base.classes.ZBKSERIESITEM).filter_by(
+                        ZADAMID=series_id,
+                        ZISCONTAINER=is_container,
+                        ZSERIESADAMID=parent_id
+                    ).all()
                 if len(result):
                     new_series_item = result[0]
                     new_series_item.ZISCONTAINER = is_container
@@ -659,6 +1053,9 @@ class BkSeriesDb:
                 self.__session.add(new_series_item)
                 self.__session.flush()
                 self.has_changed = 1
+                if self.streaming:
+                    check_keys[str(series_id)] = new_series_checked.Z_PK
+                    item_keys[(str(series_id), is_container, str(parent_id))] = new_series_item.Z_PK
 
                 # Update indices
                 # pk_bkseriescheck = self.__session.query(self.__base.classes.Z_PRIMARYKEY).filter(
@@ -685,51 +1082,112 @@ class BkSeriesDb:
             return None
         except Exception:
             self.__session.rollback()
+            self.forget_keys()
             print (sys.exc_info()[0])
             raise
 
     def del_book_from_series(self, adam_id=None):
         """Delete a book from a series in iBooks"""
+        if (adam_id is None):
+            return None
+        return self.del_books_from_series([adam_id])
+
+    def del_books_from_series(self, adam_ids=None):
+        """Delete books from their series in iBooks with a few set based statements"""
         try:
-            if (adam_id is None):
+            if not adam_ids:
                 return None
-            else:
-                books = self.__session.query(self.__base.classes.ZBKSERIESITEM).filter_by(
-                    ZADAMID=adam_id
-                )
-                series_ids = [book.ZSERIESADAMID for book in books]
 
-                for book in books:
-                    self.__session.delete(book)
+            item = self.__base.classes.ZBKSERIESITEM
+            check = self.__base.classes.ZBKSERIESCHECK
 
-                books = self.__session.query(self.__base.classes.ZBKSERIESCHECK).filter_by(
-                    ZADAMID=adam_id
-                )
-                for book in books:
-                    if prefs['debug']:
-                        print(str(datetime.now()) + ": Deleting book " + book.ZADAMID + " from series DB")
-                    self.__session.delete(book)
-                    self.has_changed=1
+            doomed_adam_ids = stage_keys(self.__session, 'calibre_doomed_items', adam_ids)
+            doomed_series_ids = stage_keys(self.__session, 'calibre_doomed_series', select(item.ZSERIESADAMID).where(
+                item.ZADAMID.in_(doomed_adam_ids)
+            ).distinct())
 
-                # Delete empty series
-                for series_id in series_ids:
-                    series_itens = self.__session.query(self.__base.classes.ZBKSERIESITEM).filter_by(
-                        ZSERIESADAMID=series_id,
-                    ).all()
-                    if len (series_itens) == 1:
-                        for series_item in series_itens:
-                            series_checks = self.__session.query(self.__base.classes.ZBKSERIESCHECK).filter_by(
-                                ZADAMID = series_id
-                            ).all()
-                            for series_check in series_checks:
-                                self.__session.delete(series_check)
-                            self.__session.delete(series_item)
+            count = self.__session.execute(
+                delete(item).where(item.ZADAMID.in_(doomed_adam_ids)).
+                execution_options(synchronize_session=False)
+            ).rowcount
 
-                # Todo: reset primary keys to max of remaining itens / checks
+            count += self.__session.execute(
+                delete(check).where(check.ZADAMID.in_(doomed_adam_ids)).
+                execution_options(synchronize_session=False)
+            ).rowcount
 
-                self.__session.flush()
+            # Delete empty series, the ones where only the container item is left
+            empty_series_ids = select(item.ZSERIESADAMID).where(
+                item.ZSERIESADAMID.in_(doomed_series_ids)
+            ).group_by(item.ZSERIESADAMID).having(func.count() == 1)
+
+            count += self.__session.execute(
+                delete(check).where(check.ZADAMID.in_(empty_series_ids)).
+                execution_options(synchronize_session=False)
+            ).rowcount
+
+            count += self.__session.execute(
+                delete(item).where(item.ZSERIESADAMID.in_(empty_series_ids)).
+                execution_options(synchronize_session=False)
+            ).rowcount
+
+            if count:
+                self.has_changed = 1
+                self.forget_keys()
+                log.debug("Deleted %s rows from series DB", count)
+
+            # Todo: reset primary keys to max of remaining itens / checks
+
+            self.__session.flush()
         except Exception:
             self.__session.rollback()
+            self.forget_keys()
             print (sys.exc_info()[0])
             raise
 
+
+class AttachedDb:
+    """BkLibraryDb and BkSeriesDb sharing one session on one connection, BKSeries attached to BKLibrary
+
+    commit() flushes both and commits them in a single SQLite transaction: one commit instead of two, and no
+    crash window between them. Only used when can_attach(), with either file in WAL mode there is no such
+    transaction."""
+
+    def __init__(self):
+        try:
+            self.__engine = create_attached_engine(prefs['dbbookcatalog'], prefs['dbseriescatalog'])
+            self.streaming = prefs['streaming_sync']
+            self.__session = Session(self.__engine, expire_on_commit=not self.streaming)
+            self.library = BkLibraryDb(session=self.__session, deferred_commit=True)
+            self.series = BkSeriesDb(session=self.__session, schema=SERIES_SCHEMA, deferred_commit=True)
+        except Exception:
+            print (sys.exc_info()[0])
+            raise
+
+    def __del__(self):
+        del self.series
+        del self.library
+        del self.__session
+        del self.__engine
+
+    def commit(self):
+        try:
+            if self.library.has_changed or self.series.has_changed:
+                # Backups, primary keys and flush of each database, the transaction is still open
+                self.library.commit()
+                self.series.commit()
+                self.__session.commit()
+                if self.streaming:
+                    self.__session.expunge_all()
+                    self.library.forget_keys()
+                    self.series.forget_keys()
+
+        except Exception:
+            # Neither database was written, books.plist must not be either
+            print (sys.exc_info()[0])
+            self.__session.rollback()
+            self.library.forget_keys()
+            self.series.forget_keys()
+            self.library.has_changed = 0
+            self.series.has_changed = 0
+            raise
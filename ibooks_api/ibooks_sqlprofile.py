@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import re
+from threading import Lock
+from time import perf_counter_ns
+
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import CacheStats
+
+from calibre_plugins.apple_ibooks.config import prefs
+
+# Expanded IN lists and literals vary per call, fold them so the same query aggregates under one key
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r"\s+")
+_SELECT_LIST = re.compile(r"^SELECT .+? FROM ")
+
+
+def normalize_statement(statement):
+    """Statement text with IN lists, literals and whitespace folded"""
+    statement = _SPACES.sub(' ', statement.strip())
+    statement = _LITERALS.sub('?', statement)
+    return _IN_LIST.sub('(?...)', statement)
+
+
+def _short_statement(statement, size=200):
+    """Statement for the dialog log, with the select column list elided"""
+    return _SELECT_LIST.sub('SELECT ... FROM ', statement, count=1)[:size]
+
+
+class SqlProfiler:
+    """Per normalized statement execution count, total/max time, rows and compiled cache hits of an engine
+
+    Listeners are only registered by attach(), so a disabled profiler costs nothing per statement."""
+
+    def __init__(self, name):
+        self.name = name
+        self.engine = None
+        self.__lock = Lock()
+        self.reset()
+
+    @staticmethod
+    def enabled():
+        return prefs['sql_profile']
+
+    def attach(self, engine):
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self.__before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.__after_cursor_execute)
+
+    def detach(self):
+        if self.engine is not None:
+            event.remove(self.engine, 'before_cursor_execute', self.__before_cursor_execute)
+            event.remove(self.engine, 'after_cursor_execute', self.__after_cursor_execute)
+            self.engine = None
+
+    def reset(self):
+        with self.__lock:
+            self.__statements = {}
+
+    def __before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('calibre_query_start', []).append(perf_counter_ns())
+
+    def __after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter_ns() - conn.info['calibre_query_start'].pop()
+        cache_hit = getattr(context, 'cache_hit', None)
+        rows = cursor.rowcount
+
+        with self.__lock:
+            stats = self.__statements.get(statement)
+            if stats is None:
+                stats = self.__statements[statement] = [0, 0, 0, 0, 0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+            # sqlite only reports rows for DML, selects are -1
+            if rows is not None and rows > 0:
+                stats[3] += rows
+            if cache_hit is CacheStats.CACHE_HIT:
+                stats[4] += 1
+            elif cache_hit is CacheStats.CACHE_MISS:
+                stats[5] += 1
+
+    def statements(self):
+        """Aggregated stats per normalized statement, slowest total first"""
+        with self.__lock:
+            raw = list(self.__statements.items())
+
+        # Normalize once per distinct statement text at report time, not on every execution
+        merged = {}
+        for statement, (count, total, max_ns, rows, hits, misses) in raw:
+            key = normalize_statement(statement)
+            stats = merged.setdefault(key, {'engine': self.name, 'statement': key, 'count': 0, 'total_ms': 0.0,
+                                            'max_ms': 0.0, 'rows': 0, 'cache_hits': 0, 'cache_misses': 0})
+            stats['count'] += count
+            stats['total_ms'] += total / 1000000.0
+            stats['max_ms'] = max(stats['max_ms'], max_ns / 1000000.0)
+            stats['rows'] += rows
+            stats['cache_hits'] += hits
+            stats['cache_misses'] += misses
+        return sorted(merged.values(), key=lambda stats: -stats['total_ms'])
+
+    def cache_size(self):
+        """Entries and capacity of the engine compiled statement LRU cache"""
+        cache = getattr(self.engine, '_compiled_cache', None)
+        if cache is None:
+            return None
+        return len(cache), getattr(cache, 'capacity', None)
+
+
+def sql_report(profilers, top=None):
+    """Top statements of all profilers by total time, as dialog log lines"""
+    top = prefs['sql_profile_top'] if top is None else top
+    statements = sorted([stats for profiler in profilers for stats in profiler.statements()],
+                        key=lambda stats: -stats['total_ms'])
+
+    lines = []
+    for profiler in profilers:
+        total = sum(stats['count'] for stats in profiler.statements())
+        cache_size = profiler.cache_size()
+        lines.append("SQL " + profiler.name + ": " + str(total) + " statements" +
+                     ("" if cache_size is None else
+                      ", compiled cache " + str(cache_size[0]) + "/" + str(cache_size[1]) + " entries"))
+    for stats in statements[:top]:
+        lines.append("SQL %s: %d x %.1f ms total, %.2f ms max, %d rows, cache %d hit/%d miss: %s" % (
+            stats['engine'], stats['count'], stats['total_ms'], stats['max_ms'], stats['rows'],
+            stats['cache_hits'], stats['cache_misses'], _short_statement(stats['statement'])))
+    return lines
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+import json
+from os import path
+from array import array
+from threading import Lock
+from contextlib import contextmanager
+from time import perf_counter_ns
+from datetime import datetime
+
+from calibre_plugins.apple_ibooks.config import prefs
+
+# Timed sync phases, commit includes the process kill and DB/plist writes it does
+PHASES = ('hash', 'extract', 'copy', 'library_db', 'series_db', 'plist', 'commit', 'kill')
+
+PERCENTILES = (50, 90, 99)
+
+
+def timings_path():
+    """JSON file next to the plugin preferences, None when prefs are not backed by a file"""
+    prefs_file = getattr(prefs, 'file_path', None)
+    if not prefs_file:
+        return None
+    return path.join(path.dirname(prefs_file), path.splitext(path.basename(prefs_file))[0] + '_timings.json')
+
+
+def _percentile(ordered, percent):
+    """Nearest rank percentile of an ordered list"""
+    rank = max(0, min(len(ordered) - 1, int(round(percent / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class PhaseTimers:
+    """Per sync phase timings, one perf_counter_ns sample per timed call
+
+    Cheap enough to stay always on: a sample is two clock reads and an append to an array of 64 bit ints, 8 bytes
+    a sample however many books are synced."""
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__samples = dict((phase, array('q')) for phase in PHASES)
+            self.started = datetime.now()
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter_ns() - start)
+
+    def add(self, name, elapsed_ns):
+        with self.__lock:
+            self.__samples.setdefault(name, array('q')).append(elapsed_ns)
+
+    def summary(self):
+        """Count, total, mean, percentiles and max in ms of each phase that ran"""
+        with self.__lock:
+            samples = dict((phase, list(values)) for phase, values in self.__samples.items() if values)
+
+        summary = {}
+        for phase, values in samples.items():
+            values.sort()
+            total = sum(values)
+            stats = {
+                'count': len(values),
+                'total_ms': total / 1000000.0,
+                'mean_ms': total / len(values) / 1000000.0,
+                'max_ms': values[-1] / 1000000.0,
+            }
+            for percent in PERCENTILES:
+                stats['p' + str(percent) + '_ms'] = _percentile(values, percent) / 1000000.0
+            summary[phase] = stats
+        return summary
+
+    def report(self):
+        """One line per phase, slowest first, for the dialog log"""
+        summary = self.summary()
+        return [
+            "Phase " + phase + ": " + str(stats['count']) + " calls, " +
+            "%.0f ms total, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+                stats['total_ms'], stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['max_ms'])
+            for phase, stats in sorted(summary.items(), key=lambda item: -item[1]['total_ms'])
+        ]
+
+    def write(self, file_path=None):
+        """Save the summary as JSON, next to the plugin prefs by default; returns the file written or None"""
+        file_path = file_path or timings_path()
+        if file_path is None:
+            return None
+        try:
+            with open(file_path, 'w') as fp:
+                json.dump({'started': str(self.started), 'finished': str(datetime.now()),
+                           'phases': self.summary()}, fp, indent=2, sort_keys=True)
+            return file_path
+        except (IOError, OSError):
+            print (sys.exc_info()[0])
+            return None
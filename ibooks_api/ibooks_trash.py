@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+import json
+from os import path, listdir, makedirs, rename, remove, rmdir
+from shutil import rmtree
+from threading import Thread, Lock
+from uuid import uuid4
+
+from calibre_plugins.apple_ibooks.config import prefs
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_log import log
+
+# Files of a batch folder: one JSON [entry, original path] line per discarded book, and the mark of a committed batch
+MANIFEST_FILE = '.manifest'
+COMMITTED_FILE = '.committed'
+
+
+class BookTrash:
+    """Deferred deletion of book files
+
+    Doomed books are renamed into a batch folder of the trash directory, which lives in the
+    BKAgent container so the rename is atomic. Once the removals are committed the batch is marked
+    and purged by a background sweeper, along with any marked batch left by a previous run. Until
+    then restore() puts the books discarded since the last commit back where they were, and the
+    batches of a run that ended before its commit are sorted out by recover()."""
+
+    def __init__(self, trash_path):
+        self.trash_path = trash_path
+        self.__batch_path = None
+        self.__count = 0
+        # (trash path, original path) of the books of the current batch
+        self.__discarded = []
+
+    def discard(self, file_path):
+        """Move a book file or folder to the trash, returns False if it has to be deleted in place"""
+        if not path.lexists(file_path):
+            return True
+        try:
+            if self.__batch_path is None:
+                self.__batch_path = path.join(self.trash_path, uuid4().hex)
+                makedirs(self.__batch_path)
+            self.__count += 1
+            entry = str(self.__count) + '-' + path.basename(file_path)
+            trashed_path = path.join(self.__batch_path, entry)
+            with open(path.join(self.__batch_path, MANIFEST_FILE), 'a') as manifest:
+                manifest.write(json.dumps([entry, file_path]) + '\n')
+            rename(file_path, trashed_path)
+            self.__discarded.append((trashed_path, file_path))
+            return True
+        except OSError:
+            log.debug("Cannot move %s to trash", file_path)
+            return False
+
+    def purge(self, workers=None):
+        """Commit the current batch and start a background sweep of the committed ones, returns the sweeper thread"""
+        self.commit()
+        if not path.isdir(self.trash_path):
+            return None
+
+        # Only the batches committed now, a batch started meanwhile is kept for restore() or the next purge
+        batches = [batch for batch in listdir(self.trash_path)
+                   if path.isfile(path.join(self.trash_path, batch, COMMITTED_FILE))]
+        sweeper = Thread(target=self.__sweep, args=(batches, prefs['trash_workers'] if workers is None else workers),
+                         name='calibre-ibooks-trash')
+        sweeper.daemon = True
+        sweeper.start()
+        return sweeper
+
+    def commit(self):
+        """The removals so far are final, their books are left in the trash for the next purge"""
+        if self.__batch_path is not None:
+            try:
+                open(path.join(self.__batch_path, COMMITTED_FILE), 'w').close()
+            except (IOError, OSError):
+                print (sys.exc_info()[0])
+        self.__batch_path = None
+        self.__discarded = []
+
+    def recover(self, referenced):
+        """Sort out the batches a previous run left uncommitted (crash, calibre killed): books whose original
+        path is in referenced (the paths books.plist still lists) go back there when it is free, the others are
+        final and the batch is marked for the next purge. Returns how many books were restored.
+
+        A batch without manifest is left alone."""
+        restored = 0
+        if not path.isdir(self.trash_path):
+            return restored
+
+        for batch in listdir(self.trash_path):
+            batch_path = path.join(self.trash_path, batch)
+            if batch_path == self.__batch_path or not path.isfile(path.join(batch_path, MANIFEST_FILE)) or \
+                    path.isfile(path.join(batch_path, COMMITTED_FILE)):
+                continue
+            try:
+                with open(path.join(batch_path, MANIFEST_FILE), 'r') as manifest:
+                    entries = [json.loads(line) for line in manifest if line.strip()]
+                for entry, file_path in reversed(entries):
+                    trashed_path = path.join(batch_path, entry)
+                    if file_path in referenced and path.lexists(trashed_path) and not path.lexists(file_path):
+                        rename(trashed_path, file_path)
+                        restored += 1
+                open(path.join(batch_path, COMMITTED_FILE), 'w').close()
+            except (IOError, OSError, ValueError):
+                print (sys.exc_info()[0])
+        return restored
+
+    def restore(self):
+        """Move the books discarded since the last commit back to where they were, returns how many were"""
+        restored = 0
+        for trashed_path, file_path in reversed(self.__discarded):
+            try:
+                # A book placed since at the same path is replaced by the former one
+                if path.isdir(file_path) and not path.islink(file_path):
+                    rmtree(file_path)
+                elif path.lexists(file_path):
+                    remove(file_path)
+                rename(trashed_path, file_path)
+                restored += 1
+            except OSError:
+                print (sys.exc_info()[0])
+        if self.__batch_path is not None:
+            try:
+                remove(path.join(self.__batch_path, MANIFEST_FILE))
+                rmdir(self.__batch_path)
+            except OSError:
+                pass
+        self.__batch_path = None
+        self.__discarded = []
+        return restored
+
+    def __sweep(self, batches, workers):
+        try:
+            entries = [path.join(self.trash_path, batch, entry)
+                       for batch in batches for entry in listdir(path.join(self.trash_path, batch))
+                       if entry not in (MANIFEST_FILE, COMMITTED_FILE)]
+        except OSError:
+            print (sys.exc_info()[0])
+            return
+
+        log.debug("Purging %d books from trash", len(entries))
+
+        lock = Lock()
+
+        def purge_entries():
+            while True:
+                with lock:
+                    if not entries:
+                        return
+                    entry = entries.pop()
+                if path.isdir(entry) and not path.islink(entry):
+                    rmtree(entry, ignore_errors=True)
+                else:
+                    try:
+                        remove(entry)
+                    except OSError:
+                        pass
+
+        threads = [Thread(target=purge_entries) for _ in range(max(1, int(workers)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Remove the now empty batch folders, the mark last so an interrupted sweep is resumed by the next one
+        for batch in batches:
+            try:
+                remove(path.join(self.trash_path, batch, MANIFEST_FILE))
+            except OSError:
+                pass
+            try:
+                remove(path.join(self.trash_path, batch, COMMITTED_FILE))
+                rmdir(path.join(self.trash_path, batch))
+            except OSError:
+                pass
+
+        log.debug("Trash purged")
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+from threading import Thread, Event
+
+import pypsutil as psutil
+
+from calibre_plugins.apple_ibooks.ibooks_api.ibooks_log import log
+
+
+class AppLaunched(Exception):
+    """Raised by a commit when iBooks (or its agent) was started again since the sync began"""
+
+    def __init__(self, name):
+        Exception.__init__(self, name + " was launched during the sync, stopped before committing")
+        self.name = name
+
+
+class LaunchWatcher:
+    """Watches for processes starting during a sync, from a process table snapshot every interval seconds
+
+    match(snapshot, pid) tells whether a process started (or exec()ed into another program) since the previous
+    snapshot is one to react to, the first one matching stops the watch and sets launched to its name. Between
+    two snapshots the thread only sleeps, a snapshot costs one read of the process table."""
+
+    def __init__(self, match, interval=1.0):
+        self.__match = match
+        self.interval = interval
+        self.launched = None
+        self.__stop = Event()
+        self.__thread = None
+
+    def start(self):
+        """Start watching, processes running now are not reported"""
+        if self.__thread is not None:
+            return
+        first = psutil.ProcessTableSnapshot()
+        self.__thread = Thread(target=self.__run, args=(first,), name='ibooks-launch-watch', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop watching, launched keeps the process found if any"""
+        self.__stop.set()
+        if self.__thread is not None and self.__thread.is_alive():
+            self.__thread.join()
+
+    def __run(self, prev):
+        try:
+            while not self.__stop.wait(self.interval):
+                snapshot = psutil.ProcessTableSnapshot()
+                diff = snapshot.diff(prev)
+                for pid in diff.started + diff.renamed:
+                    if self.__match(snapshot, pid):
+                        self.launched = snapshot.name(pid)
+                        log.debug("%s launched during the sync (pid %s)", self.launched, pid)
+                        return
+                prev = snapshot
+        except Exception:
+            # Not watching is no worse than before the watcher existed
+            print (sys.exc_info()[0])
@@ -14,35 +14,79 @@ if False:
 
 from math import ceil
 from traceback import print_exc
-from datetime import datetime
 from PyQt5.Qt import QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QMessageBox, QLabel, QApplication, QEventLoop
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from calibre_plugins.apple_ibooks import InterfacePluginAppleBooks
 from calibre_plugins.apple_ibooks.config import prefs
-from calibre_plugins.apple_ibooks.ibooks_api import IbooksApi
+from calibre_plugins.apple_ibooks.ibooks_api import IbooksApi, SyncPipeline, prefetch_books, log, setup_logging, \
+    flush_logging, CooperativeTask, cooperate
 
 from pprint import pprint
 
 
+class LogModel(QtCore.QAbstractListModel):
+    """Log lines for the dialog list view, appended in batches and capped to the latest max_rows"""
+
+    def __init__(self, max_rows, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.max_rows = max_rows
+        self.lines = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return self.lines[index.row()]
+        return None
+
+    def append_lines(self, lines):
+        lines = lines[-self.max_rows:]
+        if not lines:
+            return
+
+        overflow = len(self.lines) + len(lines) - self.max_rows
+        if overflow > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, overflow - 1)
+            del self.lines[:overflow]
+            self.endRemoveRows()
+
+        first = len(self.lines)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
+
+
 class MainDialog(QDialog):
-    def __init__(self, gui, icon, do_user_config, selected_book_ids, is_sync_selected):
+    def __init__(self, gui, icon, do_user_config, selected_book_ids, is_sync_selected, mode='sync'):
         # Hard code some preferences for now
         prefs['backup'] = True
         prefs['debug'] = True
         prefs['remove_last_synced'] = False
 
+        # Log lines are buffered and shown in one batch every log_flush_ms, the full log goes to a file
+        self.log_buffer = setup_logging()
+        self.log_buffer.drain()
+
         # Instance variables
         self.is_syncing = 0
         self.has_synced = 0
+        # Sync running as a cooperative task, resumed by sync_timer whenever the event loop is idle
+        self.sync_task = None
 
         # Dialog
         QDialog.__init__(self, gui)
+        # Parented to the dialog, so only after its Qt object exists
+        self.sync_timer = QtCore.QTimer(self)
+        self.sync_timer.timeout.connect(self.resume_sync)
         self.qDialog = QDialog
         self.gui = gui
         self.db = gui.current_db.new_api
         self.do_user_config = do_user_config
         self.is_sync_selected = is_sync_selected
+        # One of 'sync', 'remove_selected' or 'remove_all'
+        self.mode = mode
         self.selected_book_ids = selected_book_ids if is_sync_selected else self.db.all_book_ids()
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
 
@@ -129,10 +173,16 @@ class MainDialog(QDialog):
         self.gb_log.setMinimumSize(562, 260)
         # self.gb_log.setGeometry(QtCore.QRect(10, 190, 571, 421))
         self.gb_log.setObjectName("gb_log")
-        self.lw_log = QtWidgets.QListWidget(self.gb_log)
-        self.lw_log.setGeometry(QtCore.QRect(10, 30, 541, 220))
-        # self.lw_log.setMinimumSize(522, 210)
-        self.lw_log.setObjectName("lw_log")
+        self.log_model = LogModel(prefs['log_view_rows'], self)
+        self.lv_log = QtWidgets.QListView(self.gb_log)
+        self.lv_log.setGeometry(QtCore.QRect(10, 30, 541, 220))
+        # self.lv_log.setMinimumSize(522, 210)
+        self.lv_log.setObjectName("lv_log")
+        self.lv_log.setUniformItemSizes(True)
+        self.lv_log.setModel(self.log_model)
+        self.log_timer = QtCore.QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(prefs['log_flush_ms'])
         self.l.addWidget(self.gb_log)
 
         self.fr_url = QtWidgets.QFrame(self)
@@ -182,7 +232,7 @@ class MainDialog(QDialog):
         if self.is_syncing:
             if prefs['debug']:
                 print ("Sync in progress, force closing")
-            self.lw_log.addItem(str(datetime.now()) + ": Interrupt Sync")
+            log.info("Interrupt Sync")
             try:
                 books.rollback()
                 del books
@@ -211,7 +261,12 @@ class MainDialog(QDialog):
         # self.ck_cleanlast.setText(_translate("qWidget", "Remove last synced books"))
         # self.ck_debug.setChecked(prefs['debug'])
         # self.ck_debug.setText(_translate("qWidget", "Debug information on log"))
-        if (self.is_sync_selected):
+        if self.mode == 'remove_selected':
+            self.ck_syncSelected.setText(_translate("qWidget", "Remove selected books from iBooks (" +
+                                                str(len(self.selected_book_ids)) + " books)"))
+        elif self.mode == 'remove_all':
+            self.ck_syncSelected.setText(_translate("qWidget", "Remove all calibre books from iBooks"))
+        elif (self.is_sync_selected):
             self.ck_syncSelected.setText(_translate("qWidget", "Sync selected books only (" +
                                                 str(len(self.selected_book_ids)) + " books)"))
         else:
@@ -243,6 +298,26 @@ class MainDialog(QDialog):
         # prefs['remove_last_synced'] = self.ck_cleanlast.isChecked()
 
     def sync(self):
+        if self.sync_task is not None and not self.sync_task.done:
+            return
+        if not prefs['cooperative_sync']:
+            self.run_sync()
+            return
+
+        # The event loop runs between two time slices of the sync, processEvents between two slices without greenlet
+        self.sync_task = CooperativeTask(self.run_sync, idle=QtCore.QCoreApplication.instance().processEvents)
+        self.sync_timer.start(0)
+
+    def resume_sync(self):
+        if not self.sync_task.resume():
+            self.sync_timer.stop()
+            if prefs['debug']:
+                print ("Sync ran in " + str(self.sync_task.slices) + " time slices")
+
+    def run_sync(self):
+        # Inside a cooperative task the books are synced on this thread and the event loop gets its turns from
+        # cooperate(), else from processEvents every 0.1% of the books
+        cooperative = self.sync_task is not None and not self.sync_task.done
         try:
             if self.has_synced or self.is_syncing:
                 self.buttonBox.setEnabled(True)
@@ -250,92 +325,83 @@ class MainDialog(QDialog):
             else:
                 self.buttonBox.setEnabled(False)
                 self.pb_progressBar.setProperty("value", 0)
-                self.lw_log.addItem(str(datetime.now()) + ": Starting Sync")
-                self.lw_log.addItem(str(datetime.now()) + ": Finishing iBooks and its agent processes")
+                log.info("Starting Sync")
+                log.info("Finishing iBooks and its agent processes")
                 books = IbooksApi()
                 self.is_syncing = 1
+
+                if self.mode != 'sync':
+                    self.remove(books)
+                    return
+
                 total = len(self.selected_book_ids)
                 self.pb_progressBar.setMinimum(0)
                 self.pb_progressBar.setMaximum(total)
 
-                if prefs['remove_last_synced']:
-                    self.lw_log.addItem(str(datetime.now()) + ": Removing calibre books from iBooks")
-                    count = books.del_all_books_from_calibre()
-                    self.lw_log.addItem(str(datetime.now()) + ": Removed " + str (count) + " calibre books from iBooks")
-
-                for i, book_id in enumerate(list(self.selected_book_ids)):
-                    if self.is_syncing == 0 or not self.isVisible():
-                        self.lw_log.addItem(str(datetime.now()) + ": Must interrupt")
-                        self.pb_progressBar.repaint()
-                        self.lw_log.repaint()
-                        QtCore.QCoreApplication.instance().processEvents()
-                        books.commit()
-                        self.is_syncing = 0
-                        break
-
-                    mi = self.db.get_metadata(book_id, get_cover=False, cover_as_data=False)
-                    fmts = self.db.formats(book_id)
-
-                    # self.lw_log.addItem(str(datetime.now()) + ": Syncing book id " +
-                    #                        str(book_id) + ": " + str(i + 1) + "/" + str(len(self.selected_book_ids)) +
-                    #                        " - " + mi.title)
-
-                    # Update for each 1% completed
-                    if i % ceil(total / 1000) == 0:
+                if prefs['remove_last_synced'] and not prefs['dry_run']:
+                    log.info("Removing calibre books from iBooks")
+                    count = books.del_all_books_from_calibre(commit=False)
+                    log.info("Removed %d calibre books from iBooks", count)
+
+                log.info("Fetching calibre metadata")
+                records = prefetch_books(self.db, self.selected_book_ids)
+
+                # Calibre books missing from this library are only removed on request, they may come from another one
+                plan = books.plan(records, known_ids=self.db.all_book_ids() if prefs['prune_deleted'] else None)
+                log.info("Sync plan: %s", plan)
+                if prefs['dry_run']:
+                    log.info("Dry run, iBooks was not changed")
+                    records = []
+                else:
+                    records = books.remove_planned(plan)
+                total = len(records)
+                self.pb_progressBar.setMaximum(max(total, 1))
+
+                pipeline = SyncPipeline(books)
+                for i, item in enumerate(pipeline.run_inline(records) if cooperative else pipeline.run(records)):
+                    if (self.is_syncing == 0 or not self.isVisible()) and not pipeline.stop_event.is_set():
+                        log.info("Must interrupt")
+                        pipeline.stop()
+                    elif books.app_launched() is not None and not pipeline.stop_event.is_set():
+                        log.error("%s was launched during the sync, interrupting it", books.app_launched())
+                        pipeline.stop()
+
+                    # Update for each 1% completed, the log view refreshes on its timer
+                    if cooperative:
+                        cooperate()
+                    elif i % ceil(total / 1000) == 0:
                         self.pb_progressBar.repaint()
-                        self.lw_log.repaint()
                         QtCore.QCoreApplication.instance().processEvents()
 
-                    if fmts is not None:
-                        if 'EPUB' in fmts or 'PDF' in fmts:
-                            mi = self.db.get_metadata(book_id, get_cover=False, cover_as_data=False)
-                            fmt = 'EPUB' if 'EPUB' in fmts else 'PDF'
-                            file_path = self.db.format_abspath(book_id, fmt)
-
-                            if prefs['debug']:
-                                print(str(datetime.now()) + ": Calling Ibooks Api to add book with id# "
-                                      + str(book_id) + " to calibre")
-
-                            books.add_book(
-                                book_id=book_id,
-                                title=mi.title,
-                                author=', '.join(map(str,mi.authors)),
-                                input_path=file_path,
-                                collection=mi.series if mi.series is not None else
-                                    (u"Books" if fmt == "EPUB" else u"PDFs"),
-                                # genre=mi.genre,
-                                series_name=mi.series,
-                                series_number=mi.series_index
-                            )
-
-                            # self.lw_log.addItem(str(datetime.now()) + ": Done syncing book id " +
-                            #                        str(book_id) + ": " + str(i + 1) + "/" + str(len(self.selected_book_ids)) +
-                            #                        " - " + mi.title)
-
-                        else:
-                            self.lw_log.addItem(str(datetime.now()) + ": Book id " +
-                                                   str(book_id) + ": " + str(i + 1) + "/" + str(len(self.selected_book_ids)) +
-                                                   " - " + mi.title + " - has no compatible formats, skipping")
-                    else:
-                        self.lw_log.addItem(str(datetime.now()) + ": Book id " +
-                                               str(book_id) + ": " + str(i + 1) + "/" + str(len(self.selected_book_ids)) +
-                                               " - " + mi.title + " - has no compatible formats, skipping")
+                    record = item['record']
+                    if 'skipped' in item and item['skipped'] != 'interrupted':
+                        log.warning("Book id %s: %d/%d - %s - %s, skipping",
+                                    record.book_id, i + 1, total, record.title, item['skipped'])
 
                     self.pb_progressBar.setProperty("value", i+1)
                     # self.pb_progressBar.repaint()
-                    # self.lw_log.repaint()
                     # QtCore.QCoreApplication.instance().processEvents()
 
+                for stage in pipeline.stats():
+                    log.info("Stage %s: %d books, %d workers, %.0f ms busy, max queue %d", stage['stage'],
+                             stage['items'], stage['workers'], stage['busy_ms'], stage['max_queue_depth'])
+                log.info("Slowest stage: %s", pipeline.slowest_stage())
+
                 # End sync
                 self.has_synced = 1
-                self.lw_log.addItem(str(datetime.now()) + ": Finished Sync")
+                log.info("Finished Sync")
                 self.buttonBox.setEnabled(True)
 
                 self.pb_progressBar.repaint()
-                self.lw_log.repaint()
-                QtCore.QCoreApplication.instance().processEvents()
+                self.flush_log()
+                if cooperative:
+                    cooperate()
+                else:
+                    QtCore.QCoreApplication.instance().processEvents()
 
                 books.commit()
+                books.purge_trash()
+                self.log_timings(books)
                 del books
                 self.is_syncing = 0
 
@@ -347,13 +413,47 @@ class MainDialog(QDialog):
             print_exc()
             pass
 
+    def remove(self, books):
+        if self.mode == 'remove_selected':
+            log.info("Removing %d selected books from iBooks", len(self.selected_book_ids))
+            count = books.remove_books(self.selected_book_ids)
+        else:
+            log.info("Removing calibre books from iBooks")
+            count = books.del_all_books_from_calibre()
+        log.info("Removed %d calibre books from iBooks", count)
+
+        books.commit()
+        self.log_timings(books)
+        del books
+        self.pb_progressBar.setProperty("value", self.pb_progressBar.maximum())
+        self.has_synced = 1
+        self.is_syncing = 0
+        self.buttonBox.setEnabled(True)
+
+    def log_timings(self, books):
+        books.memory.stop()
+        for line in books.timers.report() + books.sql_report() + books.memory.report():
+            log.info(line)
+        timings_file = books.timers.write()
+        if timings_file is not None:
+            log.info("Timings saved to %s", timings_file)
+        flush_logging()
+        self.flush_log()
+
+    def flush_log(self):
+        """Show the lines logged since the last refresh in one batch"""
+        lines = self.log_buffer.drain()
+        if lines:
+            self.log_model.append_lines(lines)
+            self.lv_log.scrollToBottom()
+
     def keyPressEvent(self, event):
         if event.key() == QtCore.Qt.Key_Escape:
             self.buttonBox.setEnabled(True)
             if self.is_syncing:
                 if prefs['debug']:
                     print("Sync in progress, force closing")
-                self.lw_log.addItem(str(datetime.now()) + ": Interrupt Sync")
+                log.info("Interrupt Sync")
                 try:
                     books.rollback()
                     del books
@@ -377,7 +477,7 @@ class MainDialog(QDialog):
         if self.is_syncing:
             if prefs['debug']:
                 print ("Sync in progress, force closing")
-            self.lw_log.addItem(str(datetime.now()) + ": Interrupt Sync")
+            log.info("Interrupt Sync")
 
             try:
                 books.rollback()
@@ -387,4 +487,8 @@ class MainDialog(QDialog):
                 pass
 
             self.is_syncing = 0
+        # Nothing resumes the sync once the dialog is gone, let it stop the pipeline and commit now
+        if self.sync_task is not None and not self.sync_task.done and not self.sync_task.inside():
+            self.sync_timer.stop()
+            self.sync_task.finish()
         event.accept()
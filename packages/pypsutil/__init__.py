@@ -1,53 +1,145 @@
-import socket
-from typing import cast
+import importlib
+from typing import TYPE_CHECKING, Any, List
 
-from . import _process, _system
 from ._detect import BSD, FREEBSD, LINUX, MACOS, NETBSD, OPENBSD
 from ._errors import AccessDenied, Error, NoSuchProcess, TimeoutExpired, ZombieProcess
-from ._process import (
-    Connection,
-    ConnectionStatus,
-    Gids,
-    Popen,
-    Process,
-    ProcessCPUTimes,
-    ProcessFd,
-    ProcessFdType,
-    ProcessMemoryInfo,
-    ProcessOpenFile,
-    ProcessSignalMasks,
-    ProcessStatus,
-    ThreadInfo,
-    Uids,
-    pid_exists,
-    pids,
-    process_iter,
-    process_iter_available,
-    wait_procs,
-)
-from ._system import (
-    ACPowerInfo,
-    BatteryInfo,
-    BatteryStatus,
-    CPUFrequencies,
-    CPUStats,
-    DiskUsage,
-    NetIOCounts,
-    NICAddr,
-    PowerSupplySensorInfo,
-    SwapInfo,
-    VirtualMemoryInfo,
-    boot_time,
-    disk_usage,
-    physical_cpu_count,
-    swap_memory,
-    time_since_boot,
-    virtual_memory,
-)
+
+# The process and system functions, and the platform backend they sit on, are imported on first
+# use through __getattr__() below: "import pypsutil" alone only costs the platform flags.
+_LAZY_ATTRS = {
+    "_process": (
+        "Connection",
+        "ConnectionStatus",
+        "Gids",
+        "Popen",
+        "Process",
+        "ProcessCPUTimes",
+        "ProcessFd",
+        "ProcessFdType",
+        "ProcessMemoryInfo",
+        "ProcessOpenFile",
+        "ProcessSignalMasks",
+        "ProcessStatus",
+        "ProcessTableDiff",
+        "ProcessTableSnapshot",
+        "ThreadInfo",
+        "Uids",
+        "find_processes",
+        "pid_exists",
+        "pids",
+        "process_iter",
+        "process_iter_available",
+        "wait_procs",
+    ),
+    "_system": (
+        "ACPowerInfo",
+        "BatteryInfo",
+        "BatteryStatus",
+        "CPUFrequencies",
+        "CPUStats",
+        "DiskUsage",
+        "NetIOCounts",
+        "NICAddr",
+        "PowerSupplySensorInfo",
+        "SwapInfo",
+        "VirtualMemoryInfo",
+        "boot_time",
+        "disk_usage",
+        "physical_cpu_count",
+        "swap_memory",
+        "time_since_boot",
+        "virtual_memory",
+    ),
+}
+
+# Only defined where the platform backend supports them (also listed in __all__ only then)
+_OPTIONAL_ATTRS = {
+    "_system": (
+        "uptime",
+        "cpu_freq",
+        "percpu_freq",
+        "cpu_stats",
+        "cpu_times",
+        "percpu_times",
+        "sensors_power",
+        "sensors_battery",
+        "sensors_battery_total",
+        "sensors_is_on_ac_power",
+        "sensors_temperatures",
+        "net_connections",
+        "net_if_addrs",
+        "net_if_stats",
+        "net_io_counters",
+        "pernic_net_io_counters",
+        "CPUTimes",
+        "TempSensorInfo",
+    ),
+    "_process": (
+        "ProcessMemoryMap",
+        "ProcessMemoryMapGrouped",
+    ),
+}
+
+_ATTR_MODULES = {
+    name: module
+    for attrs in (_LAZY_ATTRS, _OPTIONAL_ATTRS)
+    for module, names in attrs.items()
+    for name in names
+}
+
+if TYPE_CHECKING:
+    import socket
+
+    from . import _process, _system
+    from ._process import (
+        Connection,
+        ConnectionStatus,
+        Gids,
+        Popen,
+        Process,
+        ProcessCPUTimes,
+        ProcessFd,
+        ProcessFdType,
+        ProcessMemoryInfo,
+        ProcessOpenFile,
+        ProcessSignalMasks,
+        ProcessStatus,
+        ProcessTableDiff,
+        ProcessTableSnapshot,
+        ThreadInfo,
+        Uids,
+        find_processes,
+        pid_exists,
+        pids,
+        process_iter,
+        process_iter_available,
+        wait_procs,
+    )
+    from ._system import (
+        ACPowerInfo,
+        BatteryInfo,
+        BatteryStatus,
+        CPUFrequencies,
+        CPUStats,
+        DiskUsage,
+        NetIOCounts,
+        NICAddr,
+        PowerSupplySensorInfo,
+        SwapInfo,
+        VirtualMemoryInfo,
+        boot_time,
+        disk_usage,
+        physical_cpu_count,
+        swap_memory,
+        time_since_boot,
+        virtual_memory,
+    )
+
+    AF_LINK: socket.AddressFamily
 
 __version__ = "0.2.0"
 
-__all__ = [
+_ALL = [
     "PROCFS_PATH",
     "LINUX",
     "MACOS",
@@ -70,8 +162,11 @@ __all__ = [
     "ProcessSignalMasks",
     "ProcessStatus",
     "Popen",
+    "ProcessTableDiff",
+    "ProcessTableSnapshot",
     "ThreadInfo",
     "pid_exists",
+    "find_processes",
     "pids",
     "process_iter",
     "process_iter_available",
@@ -99,81 +194,51 @@ __all__ = [
     "TimeoutExpired",
 ]
 
-if hasattr(_system, "uptime"):
-    uptime = _system.uptime
-    __all__.append("uptime")
-if hasattr(_system, "cpu_freq"):
-    cpu_freq = _system.cpu_freq
-    __all__.append("cpu_freq")
-if hasattr(_system, "percpu_freq"):
-    percpu_freq = _system.percpu_freq
-    __all__.append("percpu_freq")
-if hasattr(_system, "cpu_stats"):
-    cpu_stats = _system.cpu_stats
-    __all__.append("cpu_stats")
-if hasattr(_system, "cpu_times"):
-    cpu_times = _system.cpu_times
-    __all__.append("cpu_times")
-if hasattr(_system, "percpu_times"):
-    percpu_times = _system.percpu_times
-    __all__.append("percpu_times")
-if hasattr(_system, "sensors_power"):
-    sensors_power = _system.sensors_power
-    __all__.append("sensors_power")
-if hasattr(_system, "sensors_battery"):
-    sensors_battery = _system.sensors_battery
-    __all__.append("sensors_battery")
-if hasattr(_system, "sensors_battery_total"):
-    sensors_battery_total = _system.sensors_battery_total
-    __all__.append("sensors_battery_total")
-if hasattr(_system, "sensors_is_on_ac_power"):
-    sensors_is_on_ac_power = _system.sensors_is_on_ac_power
-    __all__.append("sensors_is_on_ac_power")
-if hasattr(_system, "sensors_temperatures"):
-    sensors_temperatures = _system.sensors_temperatures
-    __all__.append("sensors_temperatures")
-if hasattr(_system, "net_connections"):
-    net_connections = _system.net_connections
-    __all__.append("net_connections")
-if hasattr(_system, "net_if_addrs"):
-    net_if_addrs = _system.net_if_addrs
-    __all__.append("net_if_addrs")
-if hasattr(_system, "net_if_stats"):
-    net_if_stats = _system.net_if_stats
-    __all__.append("net_if_stats")
-if hasattr(_system, "net_io_counters"):
-    net_io_counters = _system.net_io_counters
-    __all__.append("net_io_counters")
-if hasattr(_system, "pernic_net_io_counters"):
-    pernic_net_io_counters = _system.pernic_net_io_counters
-    __all__.append("pernic_net_io_counters")
-if hasattr(_system, "CPUTimes"):
-    CPUTimes = _system.CPUTimes
-    __all__.append("CPUTimes")
-if hasattr(_system, "TempSensorInfo"):
-    TempSensorInfo = _system.TempSensorInfo
-    __all__.append("TempSensorInfo")
-
-if hasattr(_process, "ProcessMemoryMap"):
-    ProcessMemoryMap = _process.ProcessMemoryMap
-    __all__.append("ProcessMemoryMap")
-if hasattr(_process, "ProcessMemoryMapGrouped"):
-    ProcessMemoryMapGrouped = _process.ProcessMemoryMapGrouped
-    __all__.append("ProcessMemoryMapGrouped")
-
-
-# Alias to help with net_if_addrs()
-# pylint: disable=no-member
-if hasattr(socket, "AF_LINK"):
-    AF_LINK = socket.AF_LINK
-else:
-    AF_LINK = cast(socket.AddressFamily, socket.AF_PACKET)  # type: ignore
-# pylint: enable=no-member
-
 DEVFS_PATH = "/dev"
 
 PROCFS_PATH = "/proc"
 
 if LINUX:
     SYSFS_PATH = "/sys"
-    __all__.append("SYSFS_PATH")
+    _ALL.append("SYSFS_PATH")
+
+
+def _build_all() -> List[str]:
+    # __all__ lists the optional attributes the backend supports, which takes importing it
+    names = list(_ALL)
+    for module, optional in _OPTIONAL_ATTRS.items():
+        names.extend(name for name in optional if hasattr(_load(module), name))
+    return names
+
+
+def _load(module: str) -> Any:
+    return importlib.import_module("." + module, __name__)
+
+
+def __getattr__(name: str) -> Any:
+    if name in _ATTR_MODULES and hasattr(_load(_ATTR_MODULES[name]), name):
+        value = getattr(_load(_ATTR_MODULES[name]), name)
+    elif name in ("_process", "_system"):
+        value = _load(name)
+    elif name == "__all__":
+        value = _build_all()
+    elif name == "AF_LINK":
+        # Alias to help with net_if_addrs()
+        import socket  # pylint: disable=import-outside-toplevel
+
+        # pylint: disable=no-member
+        if hasattr(socket, "AF_LINK"):
+            value = socket.AF_LINK
+        else:
+            value = socket.AF_PACKET  # type: ignore
+        # pylint: enable=no-member
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # Later lookups find it in the module dict without coming back here
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_ATTR_MODULES) | {"AF_LINK", "__all__"})
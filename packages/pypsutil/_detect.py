@@ -1,4 +1,6 @@
+import importlib
 import sys
+from typing import TYPE_CHECKING, Any
 
 LINUX = False
 MACOS = False
@@ -7,38 +9,51 @@ NETBSD = False
 OPENBSD = False
 BSD = False
 
+# The platform flags are set at import, the backend module (and its FFI setup) is only imported
+# by the first "from ._detect import _psimpl"
 if sys.platform.startswith("linux"):
-    from . import _pslinux
-
-    _psimpl = _pslinux
+    _BACKEND = "_pslinux"
 
     LINUX = True
 elif sys.platform.startswith("freebsd"):
-    from . import _psfreebsd
-
-    _psimpl = _psfreebsd
+    _BACKEND = "_psfreebsd"
 
     FREEBSD = True
     BSD = True
 elif sys.platform.startswith("netbsd"):
-    from . import _psnetbsd
-
-    _psimpl = _psnetbsd
+    _BACKEND = "_psnetbsd"
 
     NETBSD = True
     BSD = True
 elif sys.platform.startswith("openbsd"):
-    from . import _psopenbsd
-
-    _psimpl = _psopenbsd
+    _BACKEND = "_psopenbsd"
 
     OPENBSD = True
     BSD = True
 elif sys.platform.startswith("darwin"):
-    from . import _psmacosx
-
-    _psimpl = _psmacosx
+    _BACKEND = "_psmacosx"
 
     MACOS = True
 else:
     raise RuntimeError("Unsupported platform")
+
+if TYPE_CHECKING:
+    if sys.platform.startswith("linux"):
+        from . import _pslinux as _psimpl
+    elif sys.platform.startswith("freebsd"):
+        from . import _psfreebsd as _psimpl
+    elif sys.platform.startswith("netbsd"):
+        from . import _psnetbsd as _psimpl
+    elif sys.platform.startswith("openbsd"):
+        from . import _psopenbsd as _psimpl
+    elif sys.platform.startswith("darwin"):
+        from . import _psmacosx as _psimpl
+
+
+def __getattr__(name: str) -> Any:
+    if name == "_psimpl":
+        psimpl = importlib.import_module("." + _BACKEND, __package__)
+        globals()["_psimpl"] = psimpl
+        return psimpl
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
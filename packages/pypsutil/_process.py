@@ -681,6 +681,24 @@ class Process:  # pylint: disable=too-many-instance-attributes
         else:
             yield
 
+    def as_dict(
+        self, attrs: Optional[Iterable[str]] = None, ad_value: Any = None
+    ) -> Dict[str, Any]:
+        # psutil compatible: the given getters (all of them when attrs is None or empty), read in
+        # one oneshot(); getters that fail with AccessDenied or ZombieProcess give ad_value.
+        names = _check_as_dict_attrs(attrs)
+
+        info: Dict[str, Any] = {}
+        with self.oneshot():
+            for name in names:
+                try:
+                    value = getattr(self, name)
+                    info[name] = value() if callable(value) else value
+                except (AccessDenied, ZombieProcess, NotImplementedError):
+                    info[name] = ad_value
+
+        return info
+
     def _check_running(self) -> None:
         if not self.is_running():
             raise NoSuchProcess(pid=self._pid)
@@ -741,6 +759,60 @@ class Process:  # pylint: disable=too-many-instance-attributes
         )
 
 
+# Getters as_dict() and process_iter(attrs=...) accept, those the platform backend supports
+_AS_DICT_ATTRS = tuple(
+    name
+    for name in (
+        "pid",
+        "ppid",
+        "name",
+        "exe",
+        "cmdline",
+        "cwd",
+        "root",
+        "environ",
+        "uids",
+        "gids",
+        "getgroups",
+        "fsuid",
+        "fsgid",
+        "username",
+        "umask",
+        "sigmasks",
+        "status",
+        "create_time",
+        "pgid",
+        "sid",
+        "terminal",
+        "has_terminal",
+        "num_fds",
+        "num_threads",
+        "threads",
+        "open_files",
+        "num_ctx_switches",
+        "cpu_num",
+        "cpu_times",
+        "cpu_getaffinity",
+        "memory_info",
+        "memory_percent",
+        "getpriority",
+    )
+    if hasattr(Process, name)
+)
+
+
+def _check_as_dict_attrs(attrs: Optional[Iterable[str]]) -> Tuple[str, ...]:
+    if not attrs:
+        return _AS_DICT_ATTRS
+
+    names = tuple(attrs)
+    invalid = [name for name in names if name not in _AS_DICT_ATTRS]
+    if invalid:
+        raise ValueError(f"invalid attr name(s): {', '.join(map(repr, invalid))}")
+
+    return names
+
+
 class Popen(Process):
     def __init__(
         self,
@@ -811,63 +883,87 @@ def pids() -> List[int]:
     return list(_psimpl.iter_pids())
 
 
-def process_iter() -> Iterator[Process]:
-    return _process_iter_impl(skip_perm_error=False)
+def process_iter(
+    attrs: Optional[Iterable[str]] = None, ad_value: Any = None
+) -> Iterator[Process]:
+    return _process_iter_impl(skip_perm_error=False, attrs=attrs, ad_value=ad_value)
 
 
-def process_iter_available() -> Iterator[Process]:
-    return _process_iter_impl(skip_perm_error=True)
+def process_iter_available(
+    attrs: Optional[Iterable[str]] = None, ad_value: Any = None
+) -> Iterator[Process]:
+    return _process_iter_impl(skip_perm_error=True, attrs=attrs, ad_value=ad_value)
 
 
 _process_iter_cache: Dict[int, Process] = {}
 _process_iter_cache_lock = threading.RLock()
 
 
+def _cached_process(pid: int, raw_create_time: float) -> Process:
+    # The Process object process_iter() returned for this process before, so it keeps its identity
+    # (and its cached create time) across calls; PID reuse is told apart by the create time
+    try:
+        # Check the cache
+        with _process_iter_cache_lock:
+            proc = _process_iter_cache[pid]
+    except KeyError:
+        # Cache failure
+        pass
+    else:
+        # Cache hit
+        if proc.raw_create_time() == raw_create_time:  # pylint: disable=protected-access
+            # It's the same process
+            return proc
+        else:
+            # Different process
+            with _process_iter_cache_lock:
+                # There's a potential race condition here.
+                # Between the time when we first checked the cache and now,
+                # another thread might have also checked the cache, found
+                # this process doesn't exist, and removed it.
+                # We handle that by using pop() instead of 'del' to remove
+                # the entry, so we don't get an error if it's not present.
+                _process_iter_cache.pop(pid, None)
+
+    proc = Process._create(pid, raw_create_time)  # pylint: disable=protected-access
+    with _process_iter_cache_lock:
+        # There's also a potential race condition here.
+        # Another thread might have already populated the cache entry, and we
+        # may be overwriting it.
+        # However, the only cost is a small increase in memory because we're
+        # keeping track of an extra Process object. That's not enough
+        # to be concerned about.
+        _process_iter_cache[pid] = proc
+
+    return proc
+
+
 def _process_iter_impl(
-    *, ppids: Optional[Set[int]] = None, skip_perm_error: bool = False
+    *,
+    ppids: Optional[Set[int]] = None,
+    skip_perm_error: bool = False,
+    attrs: Optional[Iterable[str]] = None,
+    ad_value: Any = None,
 ) -> Iterator[Process]:
+    # With attrs (psutil compatible) each process gets an info dict of those getters, read in one
+    # oneshot(); processes that exit meanwhile are skipped. An empty attrs means every getter.
+    if attrs is not None:
+        attrs = _check_as_dict_attrs(attrs)
+        for proc in _process_iter_impl(ppids=ppids, skip_perm_error=skip_perm_error):
+            try:
+                proc.info = proc.as_dict(attrs, ad_value)
+            except NoSuchProcess:
+                continue
+            yield proc
+        return
+
     seen_pids = set()
 
     for (pid, raw_create_time) in _psimpl.iter_pid_raw_create_time(
         ppids=ppids, skip_perm_error=skip_perm_error
     ):
         seen_pids.add(pid)
-
-        try:
-            # Check the cache
-            with _process_iter_cache_lock:
-                proc = _process_iter_cache[pid]
-        except KeyError:
-            # Cache failure
-            pass
-        else:
-            # Cache hit
-            if proc.raw_create_time() == raw_create_time:  # pylint: disable=protected-access
-                # It's the same process
-                yield proc
-                continue
-            else:
-                # Different process
-                with _process_iter_cache_lock:
-                    # There's a potential race condition here.
-                    # Between the time when we first checked the cache and now,
-                    # another thread might have also checked the cache, found
-                    # this process doesn't exist, and removed it.
-                    # We handle that by using pop() instead of 'del' to remove
-                    # the entry, so we don't get an error if it's not present.
-                    _process_iter_cache.pop(pid, None)
-
-        proc = Process._create(pid, raw_create_time)  # pylint: disable=protected-access
-        with _process_iter_cache_lock:
-            # There's also a potential race condition here.
-            # Another thread might have already populated the cache entry, and we
-            # may be overwriting it.
-            # However, the only cost is a small increase in memory because we're
-            # keeping track of an extra Process object. That's not enough
-            # to be concerned about.
-            _process_iter_cache[pid] = proc
-
-        yield proc
+        yield _cached_process(pid, raw_create_time)
 
     # If we got to the end, clean up the cache
 
@@ -885,6 +981,140 @@ def _process_iter_impl(
             _process_iter_cache.pop(bad_pid, None)
 
 
+def _iter_proc_snapshot(
+    *, uids: bool = False, skip_perm_error: bool = False
+) -> Iterator[Tuple[int, float, int, str, Optional[Tuple[int, int, int]]]]:
+    # (pid, raw create time, ppid, name, uids or None) of every process, from one read of the
+    # process table where the backend supports it
+    if hasattr(_psimpl, "iter_proc_snapshot"):
+        yield from _psimpl.iter_proc_snapshot(uids=uids, skip_perm_error=skip_perm_error)
+        return
+
+    for (pid, raw_create_time) in _psimpl.iter_pid_raw_create_time(skip_perm_error=skip_perm_error):
+        proc = Process._create(pid, raw_create_time)  # pylint: disable=protected-access
+        try:
+            with proc.oneshot():
+                yield pid, raw_create_time, proc.ppid(), proc.name(), (
+                    tuple(proc.uids()) if uids else None
+                )
+        except NoSuchProcess:
+            continue
+        except AccessDenied:
+            if not skip_perm_error:
+                raise
+
+
+@dataclasses.dataclass
+class ProcessTableDiff:
+    started: List[int]
+    exited: List[int]
+    # Same process under another name, it exec()ed another program
+    renamed: List[int]
+
+
+class ProcessTableSnapshot:
+    """PID, start time, parent and name of every process, from one read of the process table
+    (skipping the processes that cannot be read).
+
+    Cheap enough to take every second: no Process object is created unless process() is called,
+    and that returns the one process_iter() returns for the same process."""
+
+    def __init__(self) -> None:
+        self.timestamp = time.monotonic()
+        self._table: Dict[int, Tuple[float, int, str]] = {
+            pid: (raw_create_time, ppid, name)
+            for (pid, raw_create_time, ppid, name, _) in _iter_proc_snapshot(skip_perm_error=True)
+        }
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __contains__(self, pid: object) -> bool:
+        return pid in self._table
+
+    def pids(self) -> List[int]:
+        return list(self._table)
+
+    def name(self, pid: int) -> str:
+        return self._table[pid][2]
+
+    def ppid(self, pid: int) -> int:
+        return self._table[pid][1]
+
+    def process(self, pid: int) -> Process:
+        return _cached_process(pid, self._table[pid][0])
+
+    def diff(self, prev: "ProcessTableSnapshot") -> ProcessTableDiff:
+        """PIDs of the processes started, exited and renamed since prev, a reused PID (a different
+        start time) is both exited and started. Exited processes are dropped from the process_iter()
+        cache."""
+
+        started = []
+        exited = []
+        renamed = []
+        for pid, (raw_create_time, _, name) in self._table.items():
+            prev_entry = prev._table.get(pid)  # pylint: disable=protected-access
+            if prev_entry is None:
+                started.append(pid)
+            elif prev_entry[0] != raw_create_time:
+                exited.append(pid)
+                started.append(pid)
+            elif prev_entry[2] != name:
+                renamed.append(pid)
+
+        exited.extend(
+            pid for pid in prev._table if pid not in self._table  # pylint: disable=protected-access
+        )
+
+        with _process_iter_cache_lock:
+            for pid in exited:
+                proc = _process_iter_cache.get(pid)
+                if proc is not None and (
+                    pid not in self._table
+                    or proc.raw_create_time() != self._table[pid][0]
+                ):
+                    _process_iter_cache.pop(pid, None)
+
+        return ProcessTableDiff(started=started, exited=exited, renamed=renamed)
+
+
+def find_processes(
+    *,
+    name: Union[str, Iterable[str], None] = None,
+    uid: Optional[int] = None,
+    cmdline_contains: Optional[str] = None,
+) -> List[Process]:
+    """Processes matching every given filter, with name one name or several (exact match, as
+    Process.name() returns it), uid the effective user ID and cmdline_contains a substring of the
+    space joined command line.
+
+    Names and users are filtered from one snapshot of the process table, Process objects are only
+    created (and command lines only read) for the processes that pass them."""
+
+    names = None if name is None else {name} if isinstance(name, str) else set(name)
+
+    found = []
+    for (pid, raw_create_time, _, proc_name, proc_uids) in _iter_proc_snapshot(
+        uids=uid is not None, skip_perm_error=True
+    ):
+        if names is not None and proc_name not in names:
+            continue
+        if uid is not None and proc_uids[1] != uid:
+            continue
+
+        proc = Process._create(pid, raw_create_time)  # pylint: disable=protected-access
+        if cmdline_contains is not None:
+            try:
+                if cmdline_contains not in " ".join(proc.cmdline()):
+                    continue
+            except (NoSuchProcess, AccessDenied):
+                continue
+
+        found.append(proc)
+
+    return found
+
+
 def pid_exists(pid: int) -> bool:
     if pid < 0:
         return False
@@ -902,6 +1132,88 @@ def pid_exists(pid: int) -> bool:
         return True
 
 
+class _ExitWatcher:
+    # Waits for any of several processes to exit in one call: their pidfds in one poll() on Linux
+    # 5.3+ (and Python 3.9+), or one EVFILT_PROC/NOTE_EXIT event each in one kqueue on macOS and
+    # the BSDs. A process is watched once; after its exit is reported it may linger as a zombie
+    # that is not ours to reap, and the caller must go back to polling for it.
+
+    def __init__(self) -> None:
+        self._poll: Optional["select.poll"] = None
+        self._kqueue: Optional["select.kqueue"] = None
+        self._pidfds: Dict[int, int] = {}
+        self._watched: Set[int] = set()
+        self._reported: Set[int] = set()
+        self._gone: Set[int] = set()
+        self.supported = hasattr(os, "pidfd_open") or hasattr(select, "kqueue")
+
+    def watch(self, pid: int) -> None:
+        if not self.supported or pid <= 0 or pid in self._watched or pid in self._reported:
+            return
+
+        try:
+            if hasattr(os, "pidfd_open"):
+                pidfd = os.pidfd_open(pid)  # pylint: disable=no-member
+                if self._poll is None:
+                    self._poll = select.poll()
+                self._poll.register(pidfd, select.POLLIN)
+                self._pidfds[pidfd] = pid
+            else:
+                # pylint: disable=no-member
+                if self._kqueue is None:
+                    self._kqueue = select.kqueue()
+                self._kqueue.control(
+                    [
+                        select.kevent(
+                            pid,
+                            select.KQ_FILTER_PROC,
+                            select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                            select.KQ_NOTE_EXIT,
+                        )
+                    ],
+                    0,
+                )
+        except ProcessLookupError:
+            # Exited (and was reaped) before it could be watched
+            self._gone.add(pid)
+        except OSError:
+            # pidfd_open() unsupported by the kernel, out of file descriptors, ...
+            self.supported = False
+            return
+
+        self._watched.add(pid)
+
+    def covers(self, pids: Iterable[int]) -> bool:
+        return self.supported and all(
+            pid in self._watched and pid not in self._reported for pid in pids
+        )
+
+    def wait(self, timeout: Optional[float]) -> Set[int]:
+        # PIDs that exited since the last call; empty if the timeout expired first
+        exited = self._gone
+        self._gone = set()
+
+        if not exited and self._poll is not None:
+            for pidfd, _ in self._poll.poll(None if timeout is None else timeout * 1000):
+                self._poll.unregister(pidfd)
+                os.close(pidfd)
+                exited.add(self._pidfds.pop(pidfd))
+
+        elif not exited and self._kqueue is not None:
+            pending = len(self._watched) - len(self._reported)
+            exited.update(event.ident for event in self._kqueue.control(None, pending, timeout))
+
+        self._reported.update(exited)
+        return exited
+
+    def close(self) -> None:
+        for pidfd in self._pidfds:
+            os.close(pidfd)
+        self._pidfds.clear()
+        if self._kqueue is not None:
+            self._kqueue.close()
+
+
 def wait_procs(
     procs: Iterable[Process],
     timeout: Union[int, float, None] = None,
@@ -931,14 +1243,37 @@ def wait_procs(
         return gone, alive
 
     nonchildren = set()
+    watcher = _ExitWatcher()
 
+    try:
+        _wait_procs_loop(gone, alive, nonchildren, watcher, start_time, timeout, callback)
+    finally:
+        watcher.close()
+
+    return gone, alive
+
+
+def _wait_procs_loop(
+    gone: List[Process],
+    alive: List[Process],
+    nonchildren: Set[Process],
+    watcher: _ExitWatcher,
+    start_time: float,
+    timeout: Union[int, float, None],
+    callback: Optional[Callable[[Process], None]],
+) -> None:
     while True:
         if len(alive) == 1:
             # Only one process left; Process.wait() may be able to optimize.
             proc = alive[0]
 
+            # With the time already spent waiting for the others taken off the timeout
+            remaining_time = timeout
+            if timeout is not None and timeout > 0:
+                remaining_time = max((start_time + timeout) - time.monotonic(), 0)
+
             try:
-                res = proc.wait(timeout=timeout)
+                res = proc.wait(timeout=remaining_time)
             except TimeoutExpired:
                 pass
             else:
@@ -951,7 +1286,7 @@ def wait_procs(
                 alive.remove(proc)
                 gone.append(proc)
 
-            return gone, alive
+            return
 
         for proc in list(alive):
             res = None
@@ -1011,6 +1346,7 @@ def wait_procs(
             break
 
         interval = 0.01
+        remaining_time = None
         if timeout is not None:
             remaining_time = (start_time + timeout) - time.monotonic() if timeout > 0 else 0
             if remaining_time <= 0:
@@ -1018,6 +1354,10 @@ def wait_procs(
 
             interval = min(interval, remaining_time)
 
-        time.sleep(interval)
-
-    return gone, alive
+        # Sleep until one of them exits when all of them can be watched, instead of polling
+        for proc in alive:
+            watcher.watch(proc.pid)
+        if watcher.covers(proc.pid for proc in alive):
+            watcher.wait(remaining_time)
+        else:
+            time.sleep(interval)
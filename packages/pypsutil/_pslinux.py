@@ -1213,38 +1213,149 @@ def group_memory_maps(maps: List[ProcessMemoryMap]) -> ProcessMemoryMapGrouped:
     return ProcessMemoryMapGrouped(**kwargs)  # type: ignore[arg-type]
 
 
-def iter_pids() -> Iterator[int]:
-    for name in os.listdir(_util.get_procfs_path()):
-        try:
-            yield int(name)
-        except ValueError:
-            pass
+_SCAN_READ_SIZE = 4096
 
 
-def iter_pid_raw_create_time(
-    *, ppids: Optional[Set[int]] = None, skip_perm_error: bool = False
-) -> Iterator[Tuple[int, float]]:
-    for name in os.listdir(_util.get_procfs_path()):
+class ProcScanRecord:
+    # What one scan read about one process, each file read and parsed at most once
+    __slots__ = ("pid", "name", "ppid", "_scanner", "_stat_tail", "_status_text")
+
+    def __init__(self, scanner: "ProcfsScanner", pid: int, stat_line: str) -> None:
+        # Only the fields up to the start time are split, the name is the text between the first
+        # "(" and the last ")" (it may contain both)
+        rparen = stat_line.rindex(")")
+
+        self.pid = pid
+        self.name = stat_line[stat_line.index("(") + 1: rparen]
+        self._stat_tail = stat_line[rparen + 2:].split(" ", 20)
+        self.ppid = int(self._stat_tail[1])
+        self._scanner = scanner
+        self._status_text: Optional[str] = None
+
+    @property
+    def raw_create_time(self) -> float:
+        return int(self._stat_tail[19]) / _util.CLK_TCK
+
+    def status_entry(self, name: str) -> str:
+        # An entry of /proc/<pid>/status, the file is read on first access; looking the one line up
+        # costs less than splitting the 50 odd lines of the file
+        if self._status_text is None:
+            self._status_text = "\n" + self._scanner.read(self.pid, "status")
+
+        start = self._status_text.find("\n" + name + ":")
+        if start < 0:
+            raise KeyError(name)
+        start += len(name) + 2
+        end = self._status_text.find("\n", start)
+        return self._status_text[start:end if end >= 0 else None].strip()
+
+    @property
+    def uids(self) -> Tuple[int, int, int]:
+        ruid, euid, suid, _ = map(int, self.status_entry("Uid").split())
+        return ruid, euid, suid
+
+
+class ProcfsScanner:
+    # Whole-table scans of procfs: the PIDs are listed with os.scandir() and each per-PID file is
+    # opened relative to a file descriptor of the procfs directory, so the kernel does not resolve
+    # the full path for every file
+    def __init__(self) -> None:
+        self._dir_fd = os.open(_util.get_procfs_path(), os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    def close(self) -> None:
+        if self._dir_fd >= 0:
+            os.close(self._dir_fd)
+            self._dir_fd = -1
+
+    def __enter__(self) -> "ProcfsScanner":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def iter_pids(self) -> Iterator[int]:
+        with os.scandir(self._dir_fd) as entries:
+            for entry in entries:
+                if entry.name.isdigit():
+                    yield int(entry.name)
+
+    def read(self, pid: int, name: str) -> str:
+        # Raises ProcessLookupError if the process is gone
         try:
-            pid = int(name)
-        except ValueError:
-            continue
+            fd = os.open(f"{pid}/{name}", os.O_RDONLY | os.O_CLOEXEC, dir_fd=self._dir_fd)
+        except FileNotFoundError as ex:
+            raise ProcessLookupError from ex
 
         try:
-            stat_fields = _get_pid_stat_fields(pid)
-        except ProcessLookupError:
-            continue
-        except PermissionError as ex:
-            if skip_perm_error:
+            # procfs fills the whole buffer unless the end of the file was reached, so a short
+            # read saves the read() that would return b""
+            data = os.read(fd, _SCAN_READ_SIZE)
+            if len(data) == _SCAN_READ_SIZE:
+                chunks = [data]
+                while data:
+                    data = os.read(fd, _SCAN_READ_SIZE)
+                    chunks.append(data)
+                data = b"".join(chunks)
+        finally:
+            os.close(fd)
+
+        return data.decode("utf8", errors="surrogateescape")
+
+    def scan(
+        self, *, ppids: Optional[Set[int]] = None, skip_perm_error: bool = False
+    ) -> Iterator[ProcScanRecord]:
+        # Processes that exit during the scan are skipped, as are those whose files cannot be read
+        # if skip_perm_error is set; only the first read of each record raises that error
+        for pid in self.iter_pids():
+            try:
+                record = ProcScanRecord(self, pid, self.read(pid, "stat"))
+            except ProcessLookupError:
                 continue
-            else:
-                raise AccessDenied(pid=pid) from ex
+            except PermissionError as ex:
+                if skip_perm_error:
+                    continue
+                else:
+                    raise AccessDenied(pid=pid) from ex
 
-        if ppids is not None and int(stat_fields[3]) not in ppids:
-            continue
+            if ppids is not None and record.ppid not in ppids:
+                continue
+
+            yield record
+
+
+def iter_pids() -> Iterator[int]:
+    with ProcfsScanner() as scanner:
+        yield from scanner.iter_pids()
+
+
+def iter_pid_raw_create_time(
+    *, ppids: Optional[Set[int]] = None, skip_perm_error: bool = False
+) -> Iterator[Tuple[int, float]]:
+    with ProcfsScanner() as scanner:
+        for record in scanner.scan(ppids=ppids, skip_perm_error=skip_perm_error):
+            yield (record.pid, record.raw_create_time)
+
+
+def iter_proc_snapshot(
+    *, uids: bool = False, skip_perm_error: bool = False
+) -> Iterator[Tuple[int, float, int, str, Optional[Tuple[int, int, int]]]]:
+    # One pass over /proc: the stat line has the name, parent and start time, status is only
+    # read when the user IDs are asked for
+    with ProcfsScanner() as scanner:
+        for record in scanner.scan(skip_perm_error=skip_perm_error):
+            pid_uids = None
+            if uids:
+                try:
+                    pid_uids = record.uids
+                except ProcessLookupError:
+                    continue
+                except PermissionError as ex:
+                    if skip_perm_error:
+                        continue
+                    else:
+                        raise AccessDenied(pid=record.pid) from ex
 
-        ctime = _extract_create_time(stat_fields)
-        yield (pid, ctime)
+            yield record.pid, record.raw_create_time, record.ppid, record.name, pid_uids
 
 
 def _iter_procfs_cpuinfo_entries() -> Iterator[Tuple[str, str]]:
@@ -1097,6 +1097,26 @@ def iter_pid_raw_create_time(
         yield kinfo.kp_proc.p_pid, kinfo.kp_proc.p_un.p_starttime.to_float()
 
 
+def iter_proc_snapshot(
+    *,
+    uids: bool = False,  # pylint: disable=unused-argument
+    skip_perm_error: bool = False,  # pylint: disable=unused-argument
+) -> Iterator[Tuple[int, float, int, str, Optional[Tuple[int, int, int]]]]:
+    # One sysctl returns the whole process table, names and credentials included
+    for kinfo in _list_kinfo_procs():
+        yield (
+            kinfo.kp_proc.p_pid,
+            kinfo.kp_proc.p_un.p_starttime.to_float(),
+            kinfo.kp_eproc.e_ppid,
+            os.fsdecode(kinfo.kp_proc.p_comm),
+            (
+                kinfo.kp_eproc.e_pcred.p_ruid,
+                kinfo.kp_eproc.e_ucred.cr_uid,
+                kinfo.kp_eproc.e_pcred.p_svuid,
+            ),
+        )
+
+
 def iter_pids() -> Iterator[int]:
     while True:
         max_nprocs = _proc_listpids(PROC_ALL_PIDS, 0, None, allow_zero=True) // ctypes.sizeof(
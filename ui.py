@@ -16,7 +16,7 @@ from PyQt5.Qt import QMenu
 
 # The class that all interface action plugins must inherit from
 from calibre.gui2.actions import InterfaceAction
-from calibre_plugins.apple_ibooks.main import MainDialog
+from calibre_plugins.apple_ibooks.warmup import start_warmup
 
 class InterfacePlugin(InterfaceAction):
 
@@ -55,16 +55,22 @@ class InterfacePlugin(InterfaceAction):
         )
         self.sync_all_action.triggered.connect(self.sync_all)
 
+        self.remove_selected_action = self.create_action(
+            spec=('Remove selected books', None, None, None),
+            attr='Remove selected books'
+        )
+        self.remove_selected_action.triggered.connect(self.remove_selected)
+
         self.remove_all_action = self.create_action(
-            spec=(Remove all calibre books', None, None, None),
+            spec=('Remove all calibre books', None, None, None),
             attr='Remove all calibre books'
         )
         self.remove_all_action.triggered.connect(self.remove_all)
 
-
         self.menu = QMenu(self.gui)
         self.menu.addAction(self.sync_selected_action)
         self.menu.addAction(self.sync_all_action)
+        self.menu.addAction(self.remove_selected_action)
         self.menu.addAction(self.remove_all_action)
         self.menu.aboutToShow.connect(self.update_menu)
 
@@ -76,13 +82,25 @@ class InterfacePlugin(InterfaceAction):
         self.qaction.setIcon(icon)
         self.qaction.triggered.connect(self.sync_selected)
 
+        # The dialog, SQLAlchemy and the databases are loaded on a background thread instead of on first use
+        start_warmup()
+
     def sync_all(self):
         self.show_dialog(is_sync_selected=False)
 
     def sync_selected(self):
         self.show_dialog()
 
-    def show_dialog(self, is_sync_selected=True):
+    def remove_selected(self):
+        self.show_dialog(mode='remove_selected')
+
+    def remove_all(self):
+        self.show_dialog(is_sync_selected=False, mode='remove_all')
+
+    def show_dialog(self, is_sync_selected=True, mode='sync'):
+        # Imported here so calibre starts without the sync stack, the warm-up usually loaded it by now
+        from calibre_plugins.apple_ibooks.main import MainDialog
+
         # The base plugin object defined in __init__.py
         base_plugin_object = self.interface_action_base_plugin
         # Show the config dialog
@@ -100,11 +118,12 @@ class InterfacePlugin(InterfaceAction):
         for row in rows:
             selected_book_ids.append(self.gui.library_view.model().db.id(row.row()))
 
-        MainDialog(self.gui, self.qaction.icon(), do_user_config, selected_book_ids, is_sync_selected).show()
+        MainDialog(self.gui, self.qaction.icon(), do_user_config, selected_book_ids, is_sync_selected, mode).show()
 
     def update_menu(self):
         rows = self.gui.library_view.selectionModel().selectedRows()
         self.sync_selected_action.setEnabled(len(rows) > 0)
+        self.remove_selected_action.setEnabled(len(rows) > 0)
 
     def apply_settings(self):
         from calibre_plugins.apple_ibooks.config import prefs
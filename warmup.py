@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding=utf-8 -*-
+import sys
+from time import sleep, perf_counter
+from datetime import datetime
+from threading import Thread
+from importlib import import_module
+
+from calibre_plugins.apple_ibooks.config import prefs
+
+
+def start_warmup(delay=None):
+    """Warm the sync stack up on a daemon thread, returns the thread or None when the warmup preference is off
+
+    Kept free of the heavy imports itself, so calling it from genesis costs nothing to calibre startup."""
+    if not prefs['warmup']:
+        return None
+    thread = Thread(target=warm_up, args=(prefs['warmup_delay'] if delay is None else delay,),
+                    name='apple_ibooks_warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def warm_up(delay=0):
+    """Import the sync modules and prepare the schema and catalog caches, after delay seconds"""
+    # Let calibre finish starting first, the import competes with the GUI thread for the GIL
+    sleep(delay)
+    try:
+        start = perf_counter()
+        import_module('calibre_plugins.apple_ibooks.ibooks_api').prepare_caches()
+        import_module('calibre_plugins.apple_ibooks.main')
+        if prefs['debug']:
+            print (str(datetime.now()) + ": Warm-up finished in %.0f ms" % ((perf_counter() - start) * 1000))
+    except Exception:
+        # The sync prepares everything itself when the warm-up did not
+        print (sys.exc_info()[0])